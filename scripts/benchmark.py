@@ -0,0 +1,346 @@
+import json
+import os
+import platform
+import random
+import statistics
+import sys
+import time
+from collections.abc import Callable
+from functools import partial
+from typing import Literal
+
+import numpy as np
+
+from kanasim import (
+    MemoCache,
+    WordIndex,
+    clear_kana_distance_table_cache,
+    create_kana_distance_calculator,
+)
+
+# Moras of the synthetic lexicons, including two-letter moras, long vowels and
+# non-syllabic moras.
+MORAS = (
+    list(
+        "アイウエオカキクケコサシスセソタチツテトナニヌネノハヒフヘホマミムメモヤユヨラリルレロワ"
+    )
+    + list("ガギグゲゴザジズゼゾダデドバビブベボパピプペポンッ")
+    + ["キャ", "シュ", "チョ", "ニャ", "リュ", "ジョ", "ティ", "ファ", "カー", "ソー"]
+)
+
+# The valid phoneme_unit / consonant_distance combinations.
+TABLE_VARIANTS = [
+    {"phoneme_unit": "biphone", "consonant_distance": "acoustic"},
+    {"phoneme_unit": "mono", "consonant_distance": "acoustic"},
+    {"phoneme_unit": "mono", "consonant_distance": "features"},
+]
+
+DISTANCE_TYPES: list[Literal["levenshtein", "hamming"]] = ["levenshtein", "hamming"]
+
+
+def random_words(seed: int, count: int, min_length: int = 2, max_length: int = 8):
+    """Returns count reproducible random words of min_length to max_length moras."""
+    rng = random.Random(seed)
+    return [
+        "".join(rng.choices(MORAS, k=rng.randint(min_length, max_length)))
+        for _ in range(count)
+    ]
+
+
+def measure(
+    func: Callable[[], object], repeat: int, setup: Callable[[], object] | None = None
+) -> list[float]:
+    """Returns the times of repeat runs of func in seconds; setup runs untimed before each."""
+    times = []
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return times
+
+
+def calculate_pairs(calculator, word_pairs: list[tuple[str, str]]):
+    for word1, word2 in word_pairs:
+        calculator.calculate(word1, word2)
+
+
+def get_topn_all(calculator, words: list[str], wordlist, kwargs: dict):
+    for word in words:
+        calculator.get_topn(word, wordlist, n=10, **kwargs)
+
+
+class Suite:
+    """Collects benchmark results as JSON-serializable records."""
+
+    def __init__(self, repeat: int, verbose: bool = True):
+        self.repeat = repeat
+        self.verbose = verbose
+        self.results: list[dict] = []
+
+    def run(
+        self,
+        name: str,
+        func: Callable[[], object],
+        params: dict,
+        setup: Callable[[], object] | None = None,
+        repeat: int | None = None,
+        operations: int = 1,
+    ):
+        times = measure(func, repeat or self.repeat, setup)
+        result = {
+            "name": name,
+            "params": params,
+            "best": min(times),
+            "median": statistics.median(times),
+            "repeat": len(times),
+            "operations": operations,
+            "operations_per_second": operations / min(times) if min(times) else None,
+        }
+        self.results.append(result)
+        if self.verbose:
+            print(f"{name}: {result['best'] * 1000:.2f} ms", file=sys.stderr)
+
+
+def bench_construction(suite: Suite):
+    for variant in TABLE_VARIANTS:
+        for distance_type in DISTANCE_TYPES:
+            # Cold: the tables are rebuilt from the CSVs, without a cache dir.
+            suite.run(
+                "construction/"
+                f"{variant['phoneme_unit']}-{variant['consonant_distance']}/"
+                f"{distance_type}",
+                partial(
+                    create_kana_distance_calculator,
+                    distance_type=distance_type,
+                    cache_dir=None,
+                    **variant,
+                ),
+                {**variant, "distance_type": distance_type},
+                setup=clear_kana_distance_table_cache,
+            )
+
+
+def bench_calculate(suite: Suite, pairs: int):
+    for distance_type in DISTANCE_TYPES:
+        calculator = create_kana_distance_calculator(
+            distance_type=distance_type, memo=False
+        )
+        for length in [2, 4, 8, 16]:
+            words1 = random_words(length, pairs, length, length)
+            words2 = random_words(length + 100, pairs, length, length)
+            suite.run(
+                f"calculate/{distance_type}/length={length}",
+                partial(calculate_pairs, calculator, list(zip(words1, words2))),
+                {"distance_type": distance_type, "length": length, "pairs": pairs},
+                operations=pairs,
+            )
+
+
+def bench_memo(suite: Suite, pairs: int):
+    words1 = random_words(1, pairs)
+    words2 = random_words(2, pairs)
+    word_pairs = list(zip(words1, words2))
+    for distance_type in DISTANCE_TYPES:
+        memo = MemoCache(max_entries=None)
+        calculator = create_kana_distance_calculator(
+            distance_type=distance_type, memo=memo
+        )
+        func = partial(calculate_pairs, calculator, word_pairs)
+        params = {"distance_type": distance_type, "pairs": pairs}
+        suite.run(
+            f"memo/{distance_type}/cold",
+            func,
+            params,
+            setup=memo.clear,
+            operations=pairs,
+        )
+        suite.run(f"memo/{distance_type}/warm", func, params, operations=pairs)
+
+
+def bench_lexicons(suite: Suite, sizes: list[int], queries: int, batch_cells: int):
+    query_words = random_words(0, queries, 3, 6)
+    for size in sizes:
+        wordlist = random_words(size, size)
+        for distance_type in DISTANCE_TYPES:
+            calculator = create_kana_distance_calculator(distance_type=distance_type)
+            table = calculator.distance_table
+            if table is None:
+                raise ValueError(
+                    "the benchmark requires a calculator with a distance table"
+                )
+            index = WordIndex.build(wordlist, table, calculator.preprocess_func)
+            # fewer query rows for large lexicons, to bound the time
+            batch_queries = query_words[: max(1, min(queries, batch_cells // size))]
+            params = {"distance_type": distance_type, "words": size}
+            suite.run(
+                f"calculate_batch/{distance_type}/words={size}",
+                partial(
+                    calculator.calculate_batch, batch_queries, index, as_array=True
+                ),
+                {**params, "queries": len(batch_queries)},
+                operations=len(batch_queries) * size,
+            )
+            methods = ["bounds", "trie"] if distance_type == "levenshtein" else [None]
+            for method in methods:
+                kwargs = {} if method is None else {"method": method}
+                suffix = "" if method is None else f"/{method}"
+                suite.run(
+                    f"get_topn/{distance_type}{suffix}/words={size}",
+                    partial(get_topn_all, calculator, query_words, index, kwargs),
+                    {**params, "queries": queries, **kwargs},
+                    operations=queries,
+                )
+
+
+def metadata(args) -> dict:
+    from importlib.metadata import PackageNotFoundError, version
+
+    try:
+        kanasim_version = version("kanasim")
+    except PackageNotFoundError:
+        kanasim_version = None
+    return {
+        "kanasim": kanasim_version,
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "platform": platform.platform(),
+        "processor": platform.processor(),
+        "cpu_count": os.cpu_count(),
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "arguments": vars(args),
+    }
+
+
+def compare(results: list[dict], baseline: list[dict], tolerance: float) -> list[dict]:
+    """
+    Compares the best times with those of a baseline run.
+
+    Returns the rows of the comparison: the name, both times, their ratio and
+    whether the case is slower than the baseline by more than tolerance.
+    """
+    baseline_by_name = {result["name"]: result for result in baseline}
+    rows = []
+    for result in results:
+        base = baseline_by_name.get(result["name"])
+        if base is None:
+            continue
+        ratio = result["best"] / base["best"] if base["best"] else float("inf")
+        rows.append(
+            {
+                "name": result["name"],
+                "baseline": base["best"],
+                "current": result["best"],
+                "ratio": ratio,
+                "regression": ratio > 1 + tolerance,
+            }
+        )
+    return rows
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description="Benchmark the kanasim calculators and write the results as JSON."
+    )
+    parser.add_argument(
+        "-o", "--output", type=str, default=None, help="Path of the JSON results"
+    )
+    parser.add_argument(
+        "-b",
+        "--baseline",
+        type=str,
+        default=None,
+        help="Path of the JSON results of a previous run to compare with",
+    )
+    parser.add_argument(
+        "-s",
+        "--sizes",
+        type=str,
+        default="1000,10000,100000",
+        help="Comma-separated lexicon sizes, e.g. 1000,10000,100000,1000000",
+    )
+    parser.add_argument(
+        "-q", "--queries", type=int, default=20, help="Number of query words"
+    )
+    parser.add_argument(
+        "-p",
+        "--pairs",
+        type=int,
+        default=1000,
+        help="Number of word pairs of the calculate and memo cases",
+    )
+    parser.add_argument(
+        "--batch_cells",
+        type=int,
+        default=2_000_000,
+        help="Largest number of distances of one calculate_batch case",
+    )
+    parser.add_argument(
+        "-r", "--repeat", type=int, default=5, help="Number of runs of each case"
+    )
+    parser.add_argument(
+        "-t",
+        "--tolerance",
+        type=float,
+        default=0.2,
+        help="Relative slowdown against the baseline reported as a regression",
+    )
+    parser.add_argument(
+        "--only",
+        type=str,
+        default="construction,calculate,memo,lexicons",
+        help="Comma-separated groups of cases to run",
+    )
+    parser.add_argument(
+        "--fail_on_regression",
+        action="store_true",
+        help="Exit with status 1 if a case regressed",
+    )
+    args = parser.parse_args()
+
+    # Fixed seeds make the lexicons identical between runs. The table cache
+    # is disabled so that construction is measured from the CSVs.
+    os.environ.pop("KANASIM_CACHE_DIR", None)
+    suite = Suite(args.repeat)
+    groups = set(args.only.split(","))
+    if "construction" in groups:
+        bench_construction(suite)
+    if "calculate" in groups:
+        bench_calculate(suite, args.pairs)
+    if "memo" in groups:
+        bench_memo(suite, args.pairs)
+    if "lexicons" in groups:
+        sizes = [int(size) for size in args.sizes.split(",")]
+        bench_lexicons(suite, sizes, args.queries, args.batch_cells)
+
+    report = {"metadata": metadata(args), "results": suite.results}
+    regressions = []
+    if args.baseline is not None:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+        rows = compare(suite.results, baseline["results"], args.tolerance)
+        report["comparison"] = {
+            "baseline": args.baseline,
+            "tolerance": args.tolerance,
+            "rows": rows,
+        }
+        for row in rows:
+            mark = "REGRESSION" if row["regression"] else ""
+            print(
+                f"{row['name']}: {row['baseline'] * 1000:.2f} ms -> "
+                f"{row['current'] * 1000:.2f} ms ({row['ratio']:.2f}x) {mark}",
+                file=sys.stderr,
+            )
+        regressions = [row for row in rows if row["regression"]]
+
+    output = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output is None:
+        print(output)
+    else:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(output + "\n")
+    if regressions and args.fail_on_regression:
+        sys.exit(1)
@@ -0,0 +1,116 @@
+import time
+
+from kanasim import MemoCache, create_kana_distance_calculator
+from kanasim.kanasim import WeightedHamming
+
+
+def load_wordlist(path: str) -> list[str]:
+    with open(path, "r", encoding="utf-8") as f:
+        return f.read().splitlines()
+
+
+def measure(func, repeat: int) -> float:
+    """Returns the best time of func over repeat runs, in milliseconds."""
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    return best * 1000
+
+
+if __name__ == "__main__":
+    import argparse
+    import os
+
+    default_wordlist = os.path.join(
+        os.path.dirname(__file__), "../data/sample/pronunciation.txt"
+    )
+
+    parser = argparse.ArgumentParser(
+        description="Compare the flat weighted Hamming kernel with the memoized path."
+    )
+    parser.add_argument(
+        "-w",
+        "--wordlist",
+        type=str,
+        default=default_wordlist,
+        help="Path to the word list file",
+    )
+    parser.add_argument(
+        "-q",
+        "--queries",
+        type=int,
+        default=100,
+        help="Number of words of the list used as queries",
+    )
+    parser.add_argument(
+        "-r", "--repeat", type=int, default=3, help="Number of runs of each case"
+    )
+    args = parser.parse_args()
+
+    calculator = create_kana_distance_calculator(distance_type="hamming")
+    wordlist = load_wordlist(args.wordlist)
+    queries = wordlist[: args.queries]
+    # Split the words into moras beforehand, so that only the distance
+    # calculation is measured; preprocessing becomes a dict lookup.
+    moras = {word: calculator.preprocess_func(word) for word in wordlist}
+    kernel = WeightedHamming(
+        preprocess_func=moras.__getitem__, distance_table=calculator.distance_table
+    )
+    # The previous path: a cost function call per mora pair and one memo
+    # entry per word pair.
+    memoized = WeightedHamming(
+        replace_cost_func=calculator.replace_cost_func,
+        preprocess_func=moras.__getitem__,
+        memo=MemoCache(max_entries=None),
+    )
+    pairs = [(word1, word2) for word1 in queries for word2 in wordlist]
+    # Pairs of different lengths return inf before any cost is looked up.
+    same_length_pairs = [
+        (word1, word2)
+        for word1, word2 in pairs
+        if len(moras[word1]) == len(moras[word2])
+    ]
+
+    def memoized_batch():
+        memoized.calculate_batch(queries, wordlist)
+
+    def memoized_pairs():
+        for word1, word2 in pairs:
+            memoized.calculate(word1, word2)
+
+    def memoized_same_length_pairs():
+        for word1, word2 in same_length_pairs:
+            memoized.calculate(word1, word2)
+
+    def kernel_batch():
+        kernel.calculate_batch(queries, wordlist)
+
+    def kernel_pairs():
+        for word1, word2 in pairs:
+            kernel.calculate(word1, word2)
+
+    def kernel_same_length_pairs():
+        for word1, word2 in same_length_pairs:
+            kernel.calculate(word1, word2)
+
+    print(f"{len(queries)} x {len(wordlist)} pairs, best of {args.repeat} runs")
+    for name, memoized_func, kernel_func in [
+        ("calculate_batch", memoized_batch, kernel_batch),
+        ("calculate", memoized_pairs, kernel_pairs),
+        (
+            f"calculate ({len(same_length_pairs)} same-length pairs)",
+            memoized_same_length_pairs,
+            kernel_same_length_pairs,
+        ),
+    ]:
+        assert memoized.memo is not None
+        memoized.memo.clear()
+        cold = measure(memoized_func, 1)
+        warm = measure(memoized_func, args.repeat)
+        flat = measure(kernel_func, args.repeat)
+        print(
+            f"{name}: memoized cold {cold:.1f} ms, memoized warm {warm:.1f} ms, "
+            f"flat kernel {flat:.1f} ms"
+        )
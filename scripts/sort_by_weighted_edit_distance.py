@@ -1,4 +1,4 @@
-from kanasim import create_kana_distance_calculator
+from kanasim import WordIndex, create_kana_distance_calculator
 
 
 def load_wordlist(path: str) -> list[str]:
@@ -39,6 +39,14 @@ if __name__ == "__main__":
             default=default_wordlist,
             help="Path to the word list file",
         )
+        parser.add_argument(
+            "-i",
+            "--index",
+            type=str,
+            required=False,
+            default=None,
+            help="Path to a preprocessed word index file. Built from the word list if it does not exist",
+        )
         parser.add_argument(
             "-k",
             "--kana2phonome",
@@ -159,9 +167,22 @@ if __name__ == "__main__":
         same_phonome_offset=not args.disable_same_phonome_offset,
     )
 
-    wordlist = load_wordlist(wordlist_path)
-    distances = weighted_levenshtein.calculate_batch([word], wordlist)[0]
-    wordlist_with_distance = [(row, distances[i]) for i, row in enumerate(wordlist)]
-    sorted_wordlist = sorted(wordlist_with_distance, key=lambda x: x[1])
-    for word, distance in sorted_wordlist[: args.topn]:
+    if args.index is None:
+        # Read the word list in chunks, so that it need not fit in memory.
+        topn = weighted_levenshtein.get_topn_stream(word, wordlist_path, n=args.topn)
+    else:
+        if os.path.exists(args.index):
+            wordlist = WordIndex.load(args.index, mmap=True)
+        else:
+            table = weighted_levenshtein.distance_table
+            if table is None:
+                raise ValueError("--index requires a calculator with a distance table")
+            wordlist = WordIndex.build(
+                load_wordlist(wordlist_path),
+                table,
+                weighted_levenshtein.preprocess_func,
+            )
+            wordlist.save(args.index)
+        topn = weighted_levenshtein.get_topn(word, wordlist, n=args.topn)
+    for word, distance in topn:
         print(word, distance)
@@ -1,11 +1,49 @@
-from .kanasim import WeightedLevenshtein
-from .kanasim import extend_long_vowel_moras
-from .kanasim import create_kana_distance_calculator
-from .kanasim import create_kana_distance_list
+import importlib
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from .kanasim import CalculatorStats
+    from .kanasim import KanaDistanceTable
+    from .kanasim import MemoCache
+    from .kanasim import MetricIndex
+    from .kanasim import NeighborGraph
+    from .kanasim import WeightedLevenshtein
+    from .kanasim import WordIndex
+    from .kanasim import extend_long_vowel_moras
+    from .kanasim import extend_long_vowel_moras_batch
+    from .kanasim import clear_kana_distance_table_cache
+    from .kanasim import create_kana_distance_calculator
+    from .kanasim import create_kana_distance_list
+    from .kanasim import create_kana_distance_table
 
 __all__ = [
+    "CalculatorStats",
+    "KanaDistanceTable",
+    "MemoCache",
+    "MetricIndex",
+    "NeighborGraph",
     "WeightedLevenshtein",
+    "WordIndex",
     "extend_long_vowel_moras",
+    "extend_long_vowel_moras_batch",
+    "clear_kana_distance_table_cache",
     "create_kana_distance_calculator",
     "create_kana_distance_list",
+    "create_kana_distance_table",
 ]
+
+
+# The names are loaded from kanasim.kanasim on first use, so that importing
+# the package does not import NumPy.
+def __getattr__(name: str):
+    if name in __all__:
+        value = getattr(importlib.import_module(".kanasim", __name__), name)
+        globals()[name] = value
+        return value
+    if name == "kanasim":
+        return importlib.import_module(".kanasim", __name__)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def __dir__() -> list[str]:
+    return sorted({*globals(), *__all__})
@@ -1,8 +1,30 @@
 import csv
+import hashlib
+import heapq
+import json
 import os
-from typing import Callable, Literal
+import re
+import struct
+import sys
+import tempfile
+import threading
+import time
+from array import array
+from collections import OrderedDict
+from collections.abc import Hashable, Iterable, Iterator, Sequence
+from functools import cache, cached_property, lru_cache
+from itertools import islice, pairwise
+from typing import TYPE_CHECKING, Callable, Literal, Self, TypeVar, cast
 
-import jamorasep
+import numpy as np
+
+# jamorasep and the process pool are imported where they are used,
+# so that loading the module only costs NumPy.
+if TYPE_CHECKING:
+    from concurrent.futures import ProcessPoolExecutor
+    from multiprocessing import shared_memory
+
+_T = TypeVar("_T")
 
 
 def load_csv(path: str) -> list[dict[str, str]]:
@@ -34,7 +56,97 @@ def load_phonome_distance_csv(path: str) -> dict[tuple[str, str], float]:
     return distance_dict
 
 
-def create_kana_distance_list(
+def _load_phoneme_distance_matrix(
+    path: str,
+) -> tuple[dict[str, int], np.ndarray, np.ndarray]:
+    """
+    Loads a phoneme distance CSV into a dense matrix.
+
+    Args:
+        path (str): The path of a CSV with "phonome1", "phonome2" and "distance" columns.
+
+    Returns:
+        tuple[dict[str, int], np.ndarray, np.ndarray]: The index of every
+            phoneme label, the distances, and a mask of the pairs present in
+            the CSV. As in load_phonome_distance_csv, a repeated pair keeps its
+            last distance.
+    """
+    with open(path, "r", encoding="utf-8", newline="") as f:
+        reader = csv.reader(f)
+        header = next(reader)
+        rows = [row for row in reader if row]
+    column1 = header.index("phonome1")
+    column2 = header.index("phonome2")
+    distance_column = header.index("distance")
+    label_ids: dict[str, int] = {}
+    pairs = np.array(
+        [
+            (
+                label_ids.setdefault(row[column1], len(label_ids)),
+                label_ids.setdefault(row[column2], len(label_ids)),
+            )
+            for row in rows
+        ],
+        dtype=np.intp,
+    ).reshape(-1, 2)
+    distances = np.zeros((len(label_ids), len(label_ids)), dtype=np.float64)
+    distances[pairs[:, 0], pairs[:, 1]] = [float(row[distance_column]) for row in rows]
+    present = np.zeros(distances.shape, dtype=bool)
+    present[pairs[:, 0], pairs[:, 1]] = True
+    return label_ids, distances, present
+
+
+def _kana_phoneme_distances(
+    phoneme_distances: tuple[dict[str, int], np.ndarray, np.ndarray],
+    labels: list[str],
+    binary_class: Callable[[str], str] | None,
+    same_phonome_offset: bool,
+    normalize: bool,
+) -> np.ndarray:
+    """
+    Computes the distances between the phonemes of every pair of kanas.
+
+    Args:
+        phoneme_distances (tuple[dict[str, int], np.ndarray, np.ndarray]): The output of _load_phoneme_distance_matrix.
+        labels (list[str]): The phoneme label of every kana.
+        binary_class (Optional[Callable[[str], str]]): If given, the distance of a pair is 0 if the classes of its labels are equal and 1 otherwise.
+        same_phonome_offset (bool): Whether to subtract the distance of each phoneme to itself from its row, clipping at 0.
+        normalize (bool): Whether to scale the distances to [0, 1].
+
+    Returns:
+        np.ndarray: The distances, where [i, j] is the distance from the phoneme of labels[i] to that of labels[j].
+    """
+    label_ids, distances, present = phoneme_distances
+    if binary_class is not None:
+        _, classes = np.unique(
+            [binary_class(label) for label in label_ids], return_inverse=True
+        )
+        distances = (classes[:, None] != classes[None, :]).astype(np.float64)
+    if same_phonome_offset:
+        missing = present.any(axis=1) & ~np.diagonal(present)
+        if missing.any():
+            label = list(label_ids)[int(np.argmax(missing))]
+            raise KeyError((label, label))
+        distances = np.maximum(0.0, distances - np.diagonal(distances)[:, None])
+    if normalize:
+        # Scale consonant and vowel distances to [0, 1] each, so that the two
+        # are combined on a comparable scale. Without this, mixing a binary
+        # table (0/1) with raw acoustic distances (tens) makes the binary side
+        # nearly irrelevant regardless of vowel_ratio.
+        max_distance = distances[present].max()
+        if max_distance > 0:
+            distances = distances / max_distance
+
+    ids = np.array([label_ids.get(label, -1) for label in labels], dtype=np.intp)
+    found = ids >= 0
+    needed = present[ids[:, None], ids[None, :]] & found[:, None] & found[None, :]
+    if not needed.all():
+        i, j = np.argwhere(~needed)[0].tolist()
+        raise KeyError((labels[i], labels[j]))
+    return distances[ids[:, None], ids[None, :]]
+
+
+def _kana_distance_matrix(
     *,
     kana2phonome_csv: str,
     distance_consonants_csv: str,
@@ -49,392 +161,4671 @@ def create_kana_distance_list(
     vowel_binary: bool,
     normalize: bool = False,
     phoneme_unit: Literal["biphone", "mono"] = "biphone",
-) -> list[dict]:
+) -> tuple[list[str], np.ndarray, np.ndarray]:
+    """
+    Computes the kana distance matrix with array operations.
+
+    The consonant and vowel distances of all kana pairs are gathered from
+    dense phoneme distance matrices at once, and the penalties are applied
+    through masks of the "sp" and non-syllabic rows and columns.
+
+    Returns:
+        tuple[list[str], np.ndarray, np.ndarray]: The kanas in the order of the
+            kana2phonome table, the distances, where [i, j] is the distance from
+            kanas[i] to kanas[j], and the vowel part of the distances.
+    """
     if not (0 <= vowel_ratio <= 1):
         raise ValueError("vowel_ratio must be between 0 and 1 inclusive")
     consonant_column = "consonant" if phoneme_unit == "biphone" else "consonant_mono"
     vowel_column = "vowel" if phoneme_unit == "biphone" else "vowel_mono"
-    kana2phonome = load_csv(kana2phonome_csv)
-    distance_consonants_raw = load_phonome_distance_csv(distance_consonants_csv)
-    distance_vowels_raw = load_phonome_distance_csv(distance_vowels_csv)
-
-    if consonant_binary:
-        distance_consonants_raw = {
-            phoneme: 0 if phoneme[0].split("+")[0] == phoneme[1].split("+")[0] else 1
-            for phoneme in distance_consonants_raw
-        }
-    if vowel_binary:
-        distance_vowels_raw = {
-            phoneme: 0 if phoneme[0].split("-")[-1] == phoneme[1].split("-")[-1] else 1
-            for phoneme in distance_vowels_raw
-        }
+    # The parsed CSVs are shared between tables and are not modified below.
+    kana2phonome = _load_shared("kana2phonome", load_csv, kana2phonome_csv)
+    # A repeated kana keeps its last row.
+    rows = {row["kana"]: row for row in kana2phonome}
+    kanas = list(rows)
 
-    distance_consonants = {}
-    distance_vowels = {}
-    if same_phonome_offset:
-        for phoneme1, phoneme2 in distance_consonants_raw.keys():
-            offset = distance_consonants_raw[(phoneme1, phoneme1)]
-            distance_consonants[(phoneme1, phoneme2)] = max(
-                0, distance_consonants_raw[(phoneme1, phoneme2)] - offset
-            )
-        for phoneme1, phoneme2 in distance_vowels_raw.keys():
-            offset = distance_vowels_raw[(phoneme1, phoneme1)]
-            distance_vowels[(phoneme1, phoneme2)] = max(
-                0, distance_vowels_raw[(phoneme1, phoneme2)] - offset
-            )
-    else:
-        distance_consonants = distance_consonants_raw
-        distance_vowels = distance_vowels_raw
+    distance_consonant = _kana_phoneme_distances(
+        _load_shared(
+            "phoneme_distances", _load_phoneme_distance_matrix, distance_consonants_csv
+        ),
+        [rows[kana][consonant_column] for kana in kanas],
+        (lambda label: label.split("+")[0]) if consonant_binary else None,
+        same_phonome_offset,
+        normalize,
+    )
+    distance_vowel = _kana_phoneme_distances(
+        _load_shared(
+            "phoneme_distances", _load_phoneme_distance_matrix, distance_vowels_csv
+        ),
+        [rows[kana][vowel_column] for kana in kanas],
+        (lambda label: label.split("-")[-1]) if vowel_binary else None,
+        same_phonome_offset,
+        normalize,
+    )
+    distance = distance_consonant * (1 - vowel_ratio) + distance_vowel * vowel_ratio
 
-    if normalize:
-        # Scale consonant and vowel distances to [0, 1] each, so that the two
-        # are combined on a comparable scale. Without this, mixing a binary
-        # table (0/1) with raw acoustic distances (tens) makes the binary side
-        # nearly irrelevant regardless of vowel_ratio.
-        max_consonant = max(distance_consonants.values())
-        if max_consonant > 0:
-            distance_consonants = {
-                key: value / max_consonant for key, value in distance_consonants.items()
-            }
-        max_vowel = max(distance_vowels.values())
-        if max_vowel > 0:
-            distance_vowels = {
-                key: value / max_vowel for key, value in distance_vowels.items()
-            }
+    sp = np.array([kana == "sp" for kana in kanas])
+    non_syllabic = np.array([kana in ("ン", "ッ", "sp") for kana in kanas])
+    penalties = np.select(
+        [
+            sp[:, None] & sp[None, :],
+            # non-syllabic insert, delete or replace penalty
+            non_syllabic[:, None] & non_syllabic[None, :],
+            # other insert penalty
+            sp[:, None],
+            # other delete penalty
+            sp[None, :],
+        ],
+        [1.0, non_syllabic_penalty, insert_penalty, delete_penalty],
+        # other replace penalty
+        default=replace_penalty,
+    )
+    return kanas, distance * penalties, distance_vowel * vowel_ratio * penalties
 
-    results = []
-    for row1 in kana2phonome:
-        for row2 in kana2phonome:
-            kana1 = row1["kana"]
-            kana2 = row2["kana"]
-            consonant1 = row1[consonant_column]
-            consonant2 = row2[consonant_column]
-            vowel1 = row1[vowel_column]
-            vowel2 = row2[vowel_column]
 
-            distance_consonant = distance_consonants[(consonant1, consonant2)]
-            distance_vowel = distance_vowels[(vowel1, vowel2)]
+class _KanaDistanceList(Sequence[dict]):
+    """
+    A read-only view of a kana distance matrix as the rows of
+    create_kana_distance_list: one dict with "kana1", "kana2" and "distance"
+    keys per pair, in row-major order. The dicts are made on access.
+    """
 
-            distance = (
-                distance_consonant * (1 - vowel_ratio) + distance_vowel * vowel_ratio
-            )
+    def __init__(self, kanas: list[str], matrix: np.ndarray):
+        self.kanas = kanas
+        self.matrix = matrix
 
-            # non-syllabic insert, delete or replace penalty
-            if row1["kana"] == "sp" and row2["kana"] == "sp":
-                pass
-            elif row1["kana"] in ["ン", "ッ", "sp"] and row2["kana"] in [
-                "ン",
-                "ッ",
-                "sp",
-            ]:
-                distance *= non_syllabic_penalty
-            # other insert penalty
-            elif row1["kana"] == "sp" and row2["kana"] != "sp":
-                distance *= insert_penalty
-            # other delete penalty
-            elif row1["kana"] != "sp" and row2["kana"] == "sp":
-                distance *= delete_penalty
-            # other replace penalty
-            else:
-                distance *= replace_penalty
+    def __len__(self) -> int:
+        return len(self.kanas) ** 2
 
-            results.append({"kana1": kana1, "kana2": kana2, "distance": distance})
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError("kana distance list index out of range")
+        row, column = divmod(i, len(self.kanas))
+        return {
+            "kana1": self.kanas[row],
+            "kana2": self.kanas[column],
+            "distance": float(self.matrix[row, column]),
+        }
 
-    return results
+    def __iter__(self) -> Iterator[dict]:
+        for kana1, distances in zip(self.kanas, self.matrix.tolist()):
+            for kana2, distance in zip(self.kanas, distances):
+                yield {"kana1": kana1, "kana2": kana2, "distance": distance}
 
+    def __eq__(self, other) -> bool:
+        if isinstance(other, _KanaDistanceList):
+            return self.kanas == other.kanas and np.array_equal(
+                self.matrix, other.matrix
+            )
+        return isinstance(other, list) and list(self) == other
 
-class MemoManager:
-    def __init__(self):
-        self.memo: dict[tuple[tuple[str, ...], tuple[str, ...]], float] = {}
 
-    def _make_key(
-        self, word1: str | list[str], word2: str | list[str]
-    ) -> tuple[tuple[str, ...], tuple[str, ...]]:
-        return tuple(word1), tuple(word2)
+def create_kana_distance_list(
+    *,
+    kana2phonome_csv: str,
+    distance_consonants_csv: str,
+    distance_vowels_csv: str,
+    vowel_ratio: float,
+    non_syllabic_penalty: float,
+    insert_penalty: float,
+    delete_penalty: float,
+    replace_penalty: float,
+    same_phonome_offset: bool,
+    consonant_binary: bool,
+    vowel_binary: bool,
+    normalize: bool = False,
+    phoneme_unit: Literal["biphone", "mono"] = "biphone",
+) -> Sequence[dict]:
+    """
+    Computes the distance between every pair of kanas.
+
+    Returns:
+        Sequence[dict]: One dict with "kana1", "kana2" and "distance" keys per pair, as a read-only view of the distance matrix.
+    """
+    kanas, matrix, _ = _kana_distance_matrix(
+        kana2phonome_csv=kana2phonome_csv,
+        distance_consonants_csv=distance_consonants_csv,
+        distance_vowels_csv=distance_vowels_csv,
+        vowel_ratio=vowel_ratio,
+        non_syllabic_penalty=non_syllabic_penalty,
+        insert_penalty=insert_penalty,
+        delete_penalty=delete_penalty,
+        replace_penalty=replace_penalty,
+        same_phonome_offset=same_phonome_offset,
+        consonant_binary=consonant_binary,
+        vowel_binary=vowel_binary,
+        normalize=normalize,
+        phoneme_unit=phoneme_unit,
+    )
+    return _KanaDistanceList(kanas, matrix)
 
-    def set(self, word1: str | list[str], word2: str | list[str], cost: float):
-        memo_key = self._make_key(word1, word2)
-        self.memo[memo_key] = cost
 
-    def get(self, word1: str | list[str], word2: str | list[str]) -> float | None:
-        memo_key = self._make_key(word1, word2)
-        return self.memo.get(memo_key)
+# The format version is part of the magic, so that files written by an
+# incompatible version are rejected (and rebuilt by the table cache).
+_TABLE_MAGIC = b"KANASIM3"
 
 
-# Class to calculate weighted Levenshtein distance
-class WeightedLevenshtein:
+class KanaDistanceTable:
     """
-    A class to calculate the weighted Levenshtein distance between two lists of strings.
-    The distance is calculated based on the costs of insertion, deletion, and replacement operations.
-    Custom cost functions and preprocessing functions can be provided to modify the behavior of the distance calculation.
+    A dense kana distance matrix indexed by integer mora IDs.
+
+    Every mora of the kana2phonome table gets an integer ID, and the distances
+    between all pairs of moras are stored in one contiguous 2-D float array.
+    The row and column of "sp" (silence) hold the insertion and deletion costs:
+    matrix[sp, kana] is the cost of inserting kana and matrix[kana, sp] the
+    cost of deleting it. Words are encoded once into ID lists with encode(),
+    so that distance calculations only index the matrix.
 
     Attributes:
-        insert_cost (float): The default cost of an insertion operation.
-        delete_cost (float): The default cost of a deletion operation.
-        replace_cost (float): The default cost of a replacement operation.
-        insert_cost_func (Optional[Callable[[str], float]]): A custom function to calculate the cost of an insertion operation.
-        delete_cost_func (Optional[Callable[[str], float]]): A custom function to calculate the cost of a deletion operation.
-        replace_cost_func (Optional[Callable[[str, str], float]]): A custom function to calculate the cost of a replacement operation.
-        preprocess_func (Optional[Callable[[str], List[str]]]): A custom function to preprocess the input lists before calculating the distance.
-        memo (Dict[Tuple[Tuple[str, ...], Tuple[str, ...]], float]): A dictionary to store memoized results of distance calculations.
+        kanas (list[str]): The moras in ID order.
+        kana2id (dict[str, int]): A mapping from a mora to its ID.
+        matrix (np.ndarray): A float64 array of shape (len(kanas), len(kanas)).
+        rows (list[list[float]]): The matrix as nested lists, for scalar indexing in Python loops.
+        sp_id (int): The ID of "sp".
+        vowel_matrix (Optional[np.ndarray]): The vowel part of every distance, or None if unknown. The consonant part is matrix - vowel_matrix.
     """
 
     def __init__(
         self,
-        insert_cost: float = 1.0,
-        delete_cost: float = 1.0,
-        replace_cost: float = 1.0,
-        insert_cost_func: Callable[[str], float] | None = None,
-        delete_cost_func: Callable[[str], float] | None = None,
-        replace_cost_func: Callable[[str, str], float] | None = None,
-        preprocess_func: Callable[[str], list[str]] = jamorasep.parse,
+        kanas: list[str],
+        matrix: np.ndarray,
+        vowel_matrix: np.ndarray | None = None,
     ):
         """
-        Initializes the WeightedLevenshtein class with the given costs and custom functions.
+        Initializes the KanaDistanceTable with the given moras and distance matrix.
 
         Args:
-            insert_cost (float): The default cost of an insertion operation.
-            delete_cost (float): The default cost of a deletion operation.
-            replace_cost (float): The default cost of a replacement operation.
-            insert_cost_func (Optional[Callable[[str], float]]): A custom function to calculate the cost of an insertion operation.
-            delete_cost_func (Optional[Callable[[str], float]]): A custom function to calculate the cost of a deletion operation.
-            replace_cost_func (Optional[Callable[[str, str], float]]): A custom function to calculate the cost of a replacement operation.
-            preprocess_func (Optional[Callable[[str], List[str]]]): A custom function to preprocess the input lists before calculating the distance.
+            kanas (list[str]): The moras in ID order. Must contain "sp".
+            matrix (np.ndarray): The distances, where matrix[i, j] is the distance from kanas[i] to kanas[j].
+            vowel_matrix (Optional[np.ndarray]): The vowel part of the distances, used by alignments to split costs. Defaults to None.
         """
-        self.insert_cost = insert_cost
-        self.delete_cost = delete_cost
-        self.replace_cost = replace_cost
-        self.insert_cost_func = insert_cost_func
-        self.delete_cost_func = delete_cost_func
-        self.replace_cost_func = replace_cost_func
-        self.preprocess_func = preprocess_func
-        self.memo = MemoManager()
+        for distances in (matrix, vowel_matrix):
+            if distances is not None and distances.shape != (len(kanas), len(kanas)):
+                raise ValueError(
+                    f"matrix shape {distances.shape} does not match the number of kanas "
+                    f"({len(kanas)})"
+                )
+        self.kanas = list(kanas)
+        self.kana2id = {kana: i for i, kana in enumerate(self.kanas)}
+        if "sp" not in self.kana2id:
+            raise ValueError('kanas must contain "sp"')
+        self.sp_id = self.kana2id["sp"]
+        # Tables are shared between calculators, so the matrix is read-only.
+        # The view keeps the flag from affecting the caller's array.
+        self.matrix = np.ascontiguousarray(matrix, dtype=np.float64).view()
+        self.matrix.flags.writeable = False
+        self.vowel_matrix = None
+        if vowel_matrix is not None:
+            self.vowel_matrix = np.ascontiguousarray(
+                vowel_matrix, dtype=np.float64
+            ).view()
+            self.vowel_matrix.flags.writeable = False
 
-    def calculate(self, word1: str, word2: str) -> float:
-        if self.preprocess_func:
-            processed_word1 = self.preprocess_func(word1)
-            processed_word2 = self.preprocess_func(word2)
-        return self._calculate(processed_word1, processed_word2)
+    @cached_property
+    def rows(self) -> list[list[float]]:
+        return self.matrix.tolist()
 
-    def calculate_batch(
-        self, words1: list[str], words2: list[str]
-    ) -> list[list[float]]:
-        if self.preprocess_func:
-            processed_words1 = [self.preprocess_func(word1) for word1 in words1]
-            processed_words2 = [self.preprocess_func(word2) for word2 in words2]
-        results = []
-        for word1 in processed_words1:
-            result = []
-            for word2 in processed_words2:
-                result.append(self._calculate(word1, word2))
-            results.append(result)
-        return results
+    @cached_property
+    def _cheapest_indels(self) -> tuple[float, float]:
+        """The cheapest insertion and deletion costs of any mora but "sp"."""
+        moras = np.arange(len(self.kanas)) != self.sp_id
+        return (
+            float(self.matrix[self.sp_id, moras].min(initial=np.inf)),
+            float(self.matrix[moras, self.sp_id].min(initial=np.inf)),
+        )
 
-    def get_topn(
-        self, word: str, wordlist: list[str], n: int = 10
-    ) -> list[tuple[str, float]]:
+    @classmethod
+    def from_distance_list(cls, distance_list: Sequence[dict]) -> "KanaDistanceTable":
         """
-        Get the top n similar lists from the given list.
+        Creates a table from the output of create_kana_distance_list.
 
         Args:
-            word (str): The word to compare with.
-            wordlist (list[str]): The list of words to compare.
-            n (int): The number of similar words to get.
+            distance_list (Sequence[dict]): Rows with "kana1", "kana2" and "distance" keys.
 
         Returns:
-            List[Tuple[Hashable, float]]: The top n similar lists and their distances.
+            KanaDistanceTable: The table. IDs follow the order of first appearance.
+
+        Raises:
+            ValueError: If the distance of a pair of the moras is missing.
         """
-        distances = self.calculate_batch([word], wordlist)[0]
-        return sorted(zip(wordlist, distances), key=lambda x: x[1])[:n]
+        if isinstance(distance_list, _KanaDistanceList):
+            return cls(distance_list.kanas, distance_list.matrix)
+        kana2id: dict[str, int] = {}
+        for row in distance_list:
+            kana2id.setdefault(row["kana1"], len(kana2id))
+            kana2id.setdefault(row["kana2"], len(kana2id))
+        matrix = np.full((len(kana2id), len(kana2id)), np.nan, dtype=np.float64)
+        for row in distance_list:
+            matrix[kana2id[row["kana1"]], kana2id[row["kana2"]]] = row["distance"]
+        missing = np.argwhere(np.isnan(matrix))
+        if len(missing):
+            kanas = list(kana2id)
+            pairs = ", ".join(f"({kanas[i]}, {kanas[j]})" for i, j in missing[:5])
+            raise ValueError(
+                f"The distances of {len(missing)} pairs are missing: {pairs}"
+                + (", ..." if len(missing) > 5 else "")
+            )
+        return cls(list(kana2id), matrix)
 
-    def _calculate(self, word1: list[str], word2: list[str]) -> float:
+    def save(self, path: str):
         """
-        Calculates the weighted Levenshtein distance between two lists of strings
-        with an iterative dynamic programming algorithm.
+        Saves the table to a binary file.
+
+        The file holds a small JSON header with the moras followed by the
+        matrix and, if known, the vowel matrix as raw little-endian float64,
+        so that load can read it with a single read or memory-map it. The file
+        is replaced atomically.
 
         Args:
-            word1 (str): The first word.
-            word2 (str): The second word.
+            path (str): The path of the file.
+        """
+        arrays = {"matrix": self.matrix}
+        if self.vowel_matrix is not None:
+            arrays["vowel_matrix"] = self.vowel_matrix
+        _save_arrays(path, _TABLE_MAGIC, {"kanas": self.kanas}, arrays)
+
+    @classmethod
+    def load(cls, path: str, mmap: bool = False) -> "KanaDistanceTable":
+        """
+        Loads a table saved with save.
+
+        Args:
+            path (str): The path of the file.
+            mmap (bool): If True, memory-map the matrix instead of reading it.
 
         Returns:
-            float: The calculated weighted Levenshtein distance.
+            KanaDistanceTable: The table.
+
+        Raises:
+            ValueError: If the file is not a kana distance table.
         """
-        # Check for memoized result
-        memo_value = self.memo.get(word1, word2)
-        if memo_value is not None:
-            return memo_value
+        header, arrays = _load_arrays(
+            path, _TABLE_MAGIC, mmap, description="kana distance table"
+        )
+        kanas = header["kanas"]
+        shape = (len(kanas), len(kanas))
+        if arrays["matrix"].size != shape[0] * shape[1]:
+            raise ValueError(f"{path} is truncated")
+        vowel_matrix = arrays.get("vowel_matrix")
+        return cls(
+            kanas,
+            arrays["matrix"].reshape(shape),
+            None if vowel_matrix is None else vowel_matrix.reshape(shape),
+        )
 
-        m, n = len(word1), len(word2)
-        insert_costs = [
-            self.insert_cost_func(c) if self.insert_cost_func else self.insert_cost
-            for c in word2
-        ]
-        delete_costs = [
-            self.delete_cost_func(c) if self.delete_cost_func else self.delete_cost
-            for c in word1
-        ]
+    def encode(self, moras: list[str]) -> list[int]:
+        """
+        Converts a mora list into a list of mora IDs.
 
-        # prev[j] holds the distance between word1[:i-1] and word2[:j]
-        prev = [0.0] * (n + 1)
-        for j in range(1, n + 1):
-            prev[j] = prev[j - 1] + insert_costs[j - 1]
+        Args:
+            moras (list[str]): The moras, e.g. the output of extend_long_vowel_moras.
 
-        replace_cost_func = self.replace_cost_func
-        for i in range(1, m + 1):
-            c1 = word1[i - 1]
-            delete_cost = delete_costs[i - 1]
-            curr = [prev[0] + delete_cost] + [0.0] * n
-            for j in range(1, n + 1):
-                replace_cost = (
-                    replace_cost_func(c1, word2[j - 1])
-                    if replace_cost_func
-                    else self.replace_cost
-                )
-                curr[j] = min(
-                    prev[j - 1] + replace_cost,
-                    prev[j] + delete_cost,
-                    curr[j - 1] + insert_costs[j - 1],
-                )
-            prev = curr
-        cost = prev[n]
+        Returns:
+            list[int]: The mora IDs.
 
-        # Memoize the result
-        self.memo.set(word1, word2, cost)
-        return cost
+        Raises:
+            ValueError: If a mora is not in the table.
+        """
+        kana2id = self.kana2id
+        try:
+            return [kana2id[mora] for mora in moras]
+        except KeyError as e:
+            raise ValueError(
+                f"Mora not found in the kana distance table: {e.args[0]!r}. "
+                "Input must consist of katakana convertible to phonemes."
+            ) from None
 
+    def triangle_violation(self) -> float:
+        """
+        Returns how much the table violates the triangle inequality.
 
-# Function to split Katakana into moras. However, it deviates from the original definition of moras by considering long vowels as one mora.
+        Every triple of moras, including "sp", is checked. If the table is
+        symmetric and the result is 0, the weighted Levenshtein distance
+        built on it satisfies the triangle inequality too, since composing an
+        alignment of a with b and one of b with c gives an alignment of a with
+        c that is no more expensive.
+
+        Returns:
+            float: The largest amount by which matrix[a, c] exceeds matrix[a, b] + matrix[b, c], or 0 if the inequality holds.
+        """
+        violation = 0.0
+        for b in range(len(self.kanas)):
+            via_b = self.matrix[:, b, None] + self.matrix[b]
+            violation = max(violation, float((self.matrix - via_b).max()))
+        return violation
 
+    def distance(self, kana1: str, kana2: str) -> float:
+        """
+        Returns the distance from kana1 to kana2.
 
-def extend_long_vowel_moras(text: str) -> list[str]:
-    # Whitespace (e.g. word separators in song lyrics) carries no phonetic
-    # information, and moras containing it are not in the distance table.
-    text = "".join(text.split())
-    parsed_moras = jamorasep.parse(text, output_format="katakana")
-    extended_moras: list[str] = []
-    for mora in parsed_moras:
-        if mora == "ー" and extended_moras:
-            extended_moras[-1] += mora
-        else:
-            extended_moras.append(mora)
-    return extended_moras
+        Args:
+            kana1 (str): The first mora. Use "sp" for an insertion.
+            kana2 (str): The second mora. Use "sp" for a deletion.
 
+        Returns:
+            float: The distance.
+        """
+        id1, id2 = self.encode([kana1, kana2])
+        return self.rows[id1][id2]
 
-# Class to calculate weighted Hamming distance
-class WeightedHamming:
+
+def _save_arrays(path: str, magic: bytes, header: dict, arrays: dict[str, np.ndarray]):
     """
-    A class to calculate the weighted Hamming distance between two strings.
-    The distance is calculated based on the costs of replacement operations.
-    Custom cost functions and preprocessing functions can be provided to modify the behavior of the distance calculation.
+    Writes a JSON header and little-endian arrays to a file atomically.
+
+    The arrays are flattened in C order. Every array starts at a multiple of
+    8 bytes, so that _load_arrays can memory-map the file.
+    """
+    header = dict(
+        header,
+        arrays=[
+            [name, array.dtype.newbyteorder("<").str, array.size]
+            for name, array in arrays.items()
+        ],
+    )
+    header_bytes = json.dumps(header, ensure_ascii=False).encode("utf-8")
+    header_bytes += b" " * (-(len(magic) + 4 + len(header_bytes)) % 8)
+    directory = os.path.dirname(os.path.abspath(path))
+    with tempfile.NamedTemporaryFile(dir=directory, delete=False) as f:
+        try:
+            f.write(magic)
+            f.write(len(header_bytes).to_bytes(4, "little"))
+            f.write(header_bytes)
+            for name, dtype, _ in header["arrays"]:
+                data = np.ascontiguousarray(arrays[name], dtype=dtype).tobytes()
+                f.write(data + b"\0" * (-len(data) % 8))
+            f.close()
+            os.replace(f.name, path)
+        finally:
+            # Only left behind if writing or replacing failed.
+            if os.path.exists(f.name):
+                os.unlink(f.name)
+
+
+def _load_arrays(
+    path: str, magic: bytes, mmap: bool = False, description: str | None = None
+) -> tuple[dict, dict[str, np.ndarray]]:
+    """
+    Reads a file written by _save_arrays.
+
+    Raises:
+        ValueError: If the file does not start with magic or is truncated.
+    """
+    if description is None:
+        description = magic.decode()
+    if mmap:
+        data = np.memmap(path, dtype=np.uint8, mode="r")
+    else:
+        with open(path, "rb") as f:
+            data = np.frombuffer(f.read(), dtype=np.uint8)
+    start = len(magic) + 4
+    if len(data) < start or data[: len(magic)].tobytes() != magic:
+        raise ValueError(f"{path} is not a {description} file")
+    header_length = int.from_bytes(data[len(magic) : start].tobytes(), "little")
+    header = json.loads(data[start : start + header_length].tobytes().decode("utf-8"))
+    if "arrays" not in header:
+        raise ValueError(f"{path} is not a {description} file")
+    arrays = {}
+    position = start + header_length
+    for name, dtype, count in header.pop("arrays"):
+        end = position + np.dtype(dtype).itemsize * count
+        if end > len(data):
+            raise ValueError(f"{path} is truncated")
+        arrays[name] = data[position:end].view(dtype)
+        position = end + (-end % 8)
+    return header, arrays
+
+
+_INDEX_MAGIC = b"KANAIDX1"
+
+
+class WordIndex(Sequence[str]):
+    """
+    A word list preprocessed and encoded once into flat arrays.
+
+    The moras of all words are concatenated into one array of mora IDs, and
+    offsets[i]:offsets[i + 1] is the slice of the i-th word. The surface
+    strings are stored the same way as one UTF-8 buffer. The index can be
+    saved to a file and memory-mapped, so that many processes share one large
+    lexicon without preprocessing it again. It behaves as a sequence of the
+    surface strings and can be passed to the search methods of the
+    calculators in place of a list of words.
+
+    The IDs depend on the kana distance table and on the preprocessing
+    function used to build the index; a calculator rejects an index built
+    with a table whose moras differ from its own.
 
     Attributes:
-        replace_cost (float): The default cost of a replacement operation.
-        replace_cost_func (Optional[Callable[[str, str], float]]): A custom function to calculate the cost of a replacement operation.
-        preprocess_func (Optional[Callable[[str], List[str]]]): A custom function to preprocess the input strings before calculating the distance.
-        memo (Dict[Tuple[Tuple[str, ...], Tuple[str, ...]], float]): A dictionary to store memoized results of distance calculations.
+        kanas (list[str]): The moras of the table used to encode the words, in ID order.
+        offsets (np.ndarray): An int64 array of shape (len(index) + 1,) with the start of each word in ids.
+        ids (np.ndarray): A uint16 array with the mora IDs of all words.
+        lengths (np.ndarray): The number of moras of each word.
     """
 
     def __init__(
         self,
-        replace_cost: float = 1.0,
-        replace_cost_func: Callable[[str, str], float] | None = None,
-        preprocess_func: Callable[[str], list[str]] = jamorasep.parse,
+        kanas: list[str],
+        offsets: np.ndarray,
+        ids: np.ndarray,
+        text_offsets: np.ndarray,
+        text: np.ndarray,
     ):
         """
-        Initializes the WeightedHamming class with the given costs and custom functions.
+        Initializes the WordIndex with already encoded arrays. Use build or load to create one.
 
         Args:
-            replace_cost (float): The default cost of a replacement operation.
-            replace_cost_func (Optional[Callable[[str, str], float]]): A custom function to calculate the cost of a replacement operation.
-            preprocess_func (Optional[Callable[[str], List[str]]]): A custom function to preprocess the input strings before calculating the distance.
+            kanas (list[str]): The moras of the table used to encode the words, in ID order.
+            offsets (np.ndarray): The start of each word in ids, followed by len(ids).
+            ids (np.ndarray): The mora IDs of all words.
+            text_offsets (np.ndarray): The start of each surface string in text, followed by len(text).
+            text (np.ndarray): The UTF-8 encoded surface strings as a uint8 array.
         """
-        self.replace_cost = replace_cost
-        self.replace_cost_func = replace_cost_func
-        self.preprocess_func = preprocess_func
-        self.memo = MemoManager()
+        if len(offsets) != len(text_offsets) or len(offsets) == 0:
+            raise ValueError("offsets and text_offsets must have the same length")
+        self.kanas = list(kanas)
+        self.offsets = offsets
+        self.ids = ids
+        self._text_offsets = text_offsets
+        self._text = text
 
-    def calculate(self, word1: str, word2: str) -> float:
-        if self.preprocess_func:
-            processed_word1 = self.preprocess_func(word1)
-            processed_word2 = self.preprocess_func(word2)
-        return self._calculate(processed_word1, processed_word2)
+    @classmethod
+    def build(
+        cls,
+        words: Sequence[str],
+        table: KanaDistanceTable,
+        preprocess_func: Callable[[str], list[str]] | None = None,
+    ) -> "WordIndex":
+        """
+        Preprocesses and encodes the words.
+
+        Args:
+            words (Sequence[str]): The words.
+            table (KanaDistanceTable): The kana distance table of the calculator that will use the index.
+            preprocess_func (Optional[Callable[[str], List[str]]]): The preprocessing function of that calculator. Defaults to extend_long_vowel_moras.
+
+        Returns:
+            WordIndex: The index.
+
+        Raises:
+            ValueError: If a word contains a mora that is not in the table.
+        """
+        if preprocess_func is None:
+            preprocess_func = extend_long_vowel_moras
+        ids = array("H")
+        offsets = [0]
+        text = bytearray()
+        text_offsets = [0]
+        for word, moras in zip(words, _preprocess_words(preprocess_func, words)):
+            ids.extend(table.encode(moras))
+            offsets.append(len(ids))
+            text += word.encode("utf-8")
+            text_offsets.append(len(text))
+        return cls(
+            table.kanas,
+            np.array(offsets, dtype=np.int64),
+            np.frombuffer(ids, dtype=np.uint16),
+            np.array(text_offsets, dtype=np.int64),
+            np.frombuffer(bytes(text), dtype=np.uint8),
+        )
+
+    def save(self, path: str):
+        """
+        Saves the index to a binary file.
+
+        The file holds a small JSON header followed by the offsets of the
+        words and of the surface strings (int64), the mora IDs (uint16) and
+        the surface strings, so that load can memory-map it. The file is
+        replaced atomically.
+
+        Args:
+            path (str): The path of the file.
+        """
+        _save_arrays(
+            path,
+            _INDEX_MAGIC,
+            {"kanas": self.kanas},
+            {
+                "offsets": self.offsets.astype(np.int64, copy=False),
+                "text_offsets": self._text_offsets.astype(np.int64, copy=False),
+                "ids": self.ids.astype(np.uint16, copy=False),
+                "text": self._text,
+            },
+        )
+
+    @classmethod
+    def load(cls, path: str, mmap: bool = False) -> "WordIndex":
+        """
+        Loads an index saved with save.
+
+        Args:
+            path (str): The path of the file.
+            mmap (bool): If True, memory-map the arrays instead of reading them.
+
+        Returns:
+            WordIndex: The index.
+
+        Raises:
+            ValueError: If the file is not a word index.
+        """
+        header, arrays = _load_arrays(path, _INDEX_MAGIC, mmap)
+        return cls(
+            header["kanas"],
+            arrays["offsets"],
+            arrays["ids"],
+            arrays["text_offsets"],
+            arrays["text"],
+        )
+
+    @property
+    def lengths(self) -> np.ndarray:
+        return np.diff(self.offsets)
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError("word index out of range")
+        start, end = self._text_offsets[i], self._text_offsets[i + 1]
+        return self._text[start:end].tobytes().decode("utf-8")
+
+    def _decode(self, positions: list[int]) -> list[str]:
+        # Faster than indexing one word at a time for many words.
+        positions_array = np.asarray(positions, dtype=np.intp)
+        starts = self._text_offsets[positions_array].tolist()
+        ends = self._text_offsets[positions_array + 1].tolist()
+        # a memoryview of the buffer, typed as such unlike the array itself
+        text = self._text.data
+        return [str(text[start:end], "utf-8") for start, end in zip(starts, ends)]
+
+    def _slice(self, start: int, stop: int) -> "WordIndex":
+        # A view of the words start:stop sharing the arrays; the offsets need
+        # not start at 0.
+        return WordIndex(
+            self.kanas,
+            self.offsets[start : stop + 1],
+            self.ids,
+            self._text_offsets[start : stop + 1],
+            self._text,
+        )
+
+    def encoded(self, i: int) -> list[int]:
+        """
+        Returns the mora IDs of the i-th word.
+
+        Args:
+            i (int): The position of the word.
+
+        Returns:
+            list[int]: The mora IDs.
+        """
+        return self.ids[self.offsets[i] : self.offsets[i + 1]].tolist()
+
+    @cached_property
+    def _groups(self) -> dict[int, tuple[np.ndarray, np.ndarray]]:
+        # Same layout as _group_by_length, gathered directly from the flat
+        # arrays.
+        lengths = self.lengths
+        starts = self.offsets[:-1]
+        groups = {}
+        for length in np.unique(lengths).tolist():
+            indices = np.flatnonzero(lengths == length)
+            ids_matrix = self.ids[starts[indices] + np.arange(length)[:, None]]
+            # intp indices gather several times faster than uint16 ones
+            groups[length] = (indices, ids_matrix.astype(np.intp))
+        return groups
+
+    @cached_property
+    def _trie(self) -> "_Trie":
+        return _Trie(self.offsets, self.ids.astype(np.int64), len(self.kanas))
+
+    def _check_table(self, table: KanaDistanceTable):
+        if self.kanas != table.kanas:
+            raise ValueError(
+                "The word index was encoded with a different kana distance table"
+            )
+
+
+def _encode_words(
+    table: KanaDistanceTable,
+    preprocess_func: Callable[[str], list[str]],
+    words: "Sequence[str] | WordIndex",
+) -> list[list[int]]:
+    if isinstance(words, WordIndex):
+        words._check_table(table)
+        return [words.encoded(i) for i in range(len(words))]
+    return [table.encode(moras) for moras in _preprocess_words(preprocess_func, words)]
+
+
+def _encode_groups(
+    table: KanaDistanceTable,
+    preprocess_func: Callable[[str], list[str]],
+    words: "Sequence[str] | WordIndex",
+) -> dict[int, tuple[np.ndarray, np.ndarray]]:
+    if isinstance(words, WordIndex):
+        words._check_table(table)
+        # a copy, since callers may pop groups
+        return dict(words._groups)
+    return _group_by_length(_encode_words(table, preprocess_func, words))
+
+
+# Approximate memory used per entry besides the key and the value: the dict
+# slot and the linked-list node of the OrderedDict.
+_MEMO_ENTRY_OVERHEAD = 100
+
+
+class MemoCache:
+    """
+    A bounded LRU cache of distance calculation results.
+
+    The least recently used entries are evicted once the number of entries
+    exceeds max_entries or their estimated size exceeds max_bytes. Keys are
+    built with make_key, or with make_encoded_key, which packs encoded words
+    into compact bytes.
+
+    Attributes:
+        max_entries (Optional[int]): The maximum number of entries, or None for no limit.
+        max_bytes (Optional[int]): The maximum estimated size in bytes, or None for no limit.
+        hits (int): The number of lookups that found an entry.
+        misses (int): The number of lookups that did not find an entry.
+        evictions (int): The number of entries evicted to stay within the budget.
+    """
+
+    def __init__(self, max_entries: int | None = 100_000, max_bytes: int | None = None):
+        """
+        Initializes the MemoCache with the given budget.
+
+        Args:
+            max_entries (Optional[int]): The maximum number of entries, or None for no limit.
+            max_bytes (Optional[int]): The maximum estimated size in bytes, or None for no limit.
+        """
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.nbytes = 0
+        self._entries: OrderedDict[Hashable, float] = OrderedDict()
+
+    @staticmethod
+    def make_key(word1: Sequence[str], word2: Sequence[str]) -> Hashable:
+        """
+        Makes a cache key for a pair of words given as sequences of strings.
+
+        Args:
+            word1 (Sequence[str]): The first word.
+            word2 (Sequence[str]): The second word.
+
+        Returns:
+            Hashable: The key.
+        """
+        return tuple(word1), tuple(word2)
+
+    @staticmethod
+    def make_encoded_key(ids1: Sequence[int], ids2: Sequence[int]) -> bytes:
+        """
+        Makes a compact cache key for a pair of encoded words.
+
+        The mora IDs are packed into a single bytes object with two bytes per
+        mora, prefixed by the length of the first word in four bytes, so that
+        words of any length get a key.
+
+        Args:
+            ids1 (Sequence[int]): The mora IDs of the first word.
+            ids2 (Sequence[int]): The mora IDs of the second word.
+
+        Returns:
+            bytes: The key.
+        """
+        return struct.pack("<I", len(ids1)) + array("H", [*ids1, *ids2]).tobytes()
+
+    def get(self, key: Hashable) -> float | None:
+        value = self._entries.get(key)
+        if value is None:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key: Hashable, value: float):
+        if key in self._entries:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            return
+        self._entries[key] = value
+        self.nbytes += self._entry_size(key)
+        while self._entries and (
+            (self.max_entries is not None and len(self._entries) > self.max_entries)
+            or (self.max_bytes is not None and self.nbytes > self.max_bytes)
+        ):
+            evicted_key, _ = self._entries.popitem(last=False)
+            self.nbytes -= self._entry_size(evicted_key)
+            self.evictions += 1
+
+    def clear(self):
+        """Removes all entries. The counters are kept; see reset_stats."""
+        self._entries.clear()
+        self.nbytes = 0
+
+    def reset_stats(self):
+        """Resets the hit, miss and eviction counters."""
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def stats(self) -> dict[str, int]:
+        """
+        Returns the cache statistics.
+
+        Returns:
+            dict[str, int]: The number of entries, their estimated size in bytes, and the hit, miss and eviction counters.
+        """
+        return {
+            "entries": len(self._entries),
+            "nbytes": self.nbytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    @staticmethod
+    def _entry_size(key: Hashable) -> int:
+        # The float value takes 24 bytes.
+        return sys.getsizeof(key) + 24 + _MEMO_ENTRY_OVERHEAD
+
+
+def _resolve_memo(memo: "MemoCache | bool") -> "MemoCache | None":
+    if memo is True:
+        return MemoCache()
+    if memo is False:
+        return None
+    return memo
+
+
+# The counters of CalculatorStats, in the order of snapshot.
+_STATS_COUNTERS = (
+    "calls",
+    "preprocess_time",
+    "dp_time",
+    "dp_cells",
+    "memo_hits",
+    "memo_misses",
+    "candidates",
+    "pruned",
+)
+
+
+class CalculatorStats:
+    """
+    Counters of the work done by a calculator, collected when stats are enabled.
+
+    Every call of calculate, calculate_batch, get_topn, get_within and
+    get_topn_stream is measured and added to the totals. The numbers of the
+    call itself are stored in last and passed to on_record, which can export
+    them to a metrics system. iter_distances is measured as the
+    calculate_batch calls of its chunks. The counters can be updated by
+    several threads, but then last is the record of any of their calls.
+
+    Attributes:
+        on_record (Optional[Callable[[dict], None]]): A function called with the record of every call: its operation name and its counts.
+        last (dict): The record of the last call.
+        calls (int): The number of calls.
+        preprocess_time (float): Seconds spent splitting the words into moras and encoding them.
+        dp_time (float): Seconds spent in the rest of the calls, mostly the DP.
+        dp_cells (int): The number of DP cells evaluated. A Hamming distance counts one cell per mora; distances found in the memo count none.
+        memo_hits (int): The number of memo lookups that found an entry.
+        memo_misses (int): The number of memo lookups that did not find an entry.
+        candidates (int): The number of words searched by get_topn, get_within and get_topn_stream.
+        pruned (int): The number of candidates pruned by the lower bounds or abandoned during the DP.
+    """
+
+    def __init__(self, on_record: Callable[[dict], None] | None = None):
+        """
+        Initializes the CalculatorStats with zero counters.
+
+        Args:
+            on_record (Optional[Callable[[dict], None]]): A function called with the record of every call.
+        """
+        self.on_record = on_record
+        self.last: dict = {}
+        self._lock = threading.Lock()
+        # DP cells of the scalar kernels, which do not know the current call
+        self._scalar_cells = 0
+        self.reset()
+
+    def reset(self):
+        """Resets the counters."""
+        self.calls = 0
+        self.preprocess_time = 0.0
+        self.dp_time = 0.0
+        self.dp_cells = 0
+        self.memo_hits = 0
+        self.memo_misses = 0
+        self.candidates = 0
+        self.pruned = 0
+
+    def snapshot(self) -> dict[str, float]:
+        """
+        Returns the counters.
+
+        Returns:
+            dict[str, float]: The value of every counter by name.
+        """
+        return {name: getattr(self, name) for name in _STATS_COUNTERS}
+
+    def _start(self, memo: "MemoCache | None") -> "_StatsCall":
+        return _StatsCall(self, memo)
+
+    def _add(self, operation: str, record: dict):
+        with self._lock:
+            self.calls += 1
+            for name, value in record.items():
+                setattr(self, name, getattr(self, name) + value)
+            self.last = {"operation": operation, **record}
+            last = self.last
+        if self.on_record is not None:
+            self.on_record(last)
+
+
+class _StatsCall:
+    """
+    The counts of one measured call. The time between marks goes to the
+    phase that just ended; the counts are added to the stats at the end.
+    """
+
+    __slots__ = ("mark", "memo", "memo_counts", "record", "scalar_cells", "stats")
+
+    def __init__(self, stats: CalculatorStats, memo: "MemoCache | None"):
+        self.stats = stats
+        self.memo = memo
+        self.memo_counts = (memo.hits, memo.misses) if memo is not None else (0, 0)
+        self.scalar_cells = stats._scalar_cells
+        self.record: dict = {
+            "preprocess_time": 0.0,
+            "dp_time": 0.0,
+            "dp_cells": 0,
+            "memo_hits": 0,
+            "memo_misses": 0,
+            "candidates": 0,
+            "pruned": 0,
+        }
+        self.mark = time.perf_counter()
+
+    def preprocessed(self):
+        """Ends the preprocessing phase."""
+        now = time.perf_counter()
+        self.record["preprocess_time"] += now - self.mark
+        self.mark = now
+
+    def count_cells(self, cells: int):
+        """Adds DP cells evaluated by the vectorized kernels."""
+        self.record["dp_cells"] += cells
+
+    def searched(self, pruning_stats: dict[str, int]):
+        """Adds the counts of a search."""
+        self.record["dp_cells"] += pruning_stats["dp_cells"]
+        self.record["candidates"] += pruning_stats["candidates"]
+        self.record["pruned"] += (
+            pruning_stats["candidates"]
+            - pruning_stats["evaluated"]
+            + pruning_stats["abandoned"]
+        )
+
+    def end(self, operation: str):
+        """Ends the DP phase and adds the counts of the call to the stats."""
+        record = self.record
+        record["dp_time"] += time.perf_counter() - self.mark
+        record["dp_cells"] += self.stats._scalar_cells - self.scalar_cells
+        if self.memo is not None:
+            record["memo_hits"] += self.memo.hits - self.memo_counts[0]
+            record["memo_misses"] += self.memo.misses - self.memo_counts[1]
+        self.stats._add(operation, record)
+
+
+def _resolve_stats(stats: "CalculatorStats | bool") -> "CalculatorStats | None":
+    if stats is True:
+        return CalculatorStats()
+    if stats is False:
+        return None
+    return stats
+
+
+def _group_by_length(
+    encoded_words: list[list[int]],
+) -> dict[int, tuple[np.ndarray, np.ndarray]]:
+    """
+    Groups encoded words by mora length.
+
+    Args:
+        encoded_words (list[list[int]]): The encoded words.
+
+    Returns:
+        dict[int, tuple[np.ndarray, np.ndarray]]: For each length n, the positions of
+            the words in encoded_words and an ID matrix of shape (n, k) whose
+            column i holds the IDs of the i-th word of the group.
+    """
+    positions: dict[int, list[int]] = {}
+    for i, ids in enumerate(encoded_words):
+        positions.setdefault(len(ids), []).append(i)
+    groups = {}
+    for length, indices in positions.items():
+        ids_matrix = np.array(
+            [encoded_words[i] for i in indices], dtype=np.intp
+        ).reshape(len(indices), length)
+        groups[length] = (np.array(indices, dtype=np.intp), ids_matrix.T.copy())
+    return groups
+
+
+def _levenshtein_group(
+    table: KanaDistanceTable,
+    ids1: list[int],
+    ids_matrix: np.ndarray,
+    cutoff: float | None = None,
+) -> np.ndarray:
+    """
+    Calculates the weighted Levenshtein distance from one encoded word to every
+    word of a same-length group at once.
+
+    The DP advances over the moras of ids1 as in WeightedLevenshtein, with
+    each cell holding a vector over the group, so the results are identical
+    to those of the scalar kernel. Costs are non-negative, so the minimum of
+    a row is a lower bound of the final distance: with a cutoff, words whose
+    whole row exceeds it are abandoned and get inf, and each row is limited
+    to the diagonal band of _levenshtein_band for the cheapest insertion and
+    deletion costs of the table. Distances above the cutoff
+    may then be overestimated, but those within it are exact.
+
+    Args:
+        table (KanaDistanceTable): The kana distance table.
+        ids1 (list[int]): The mora IDs of the first word.
+        ids_matrix (np.ndarray): The ID matrix of shape (n, k) of the group.
+        cutoff (Optional[float]): Abandon words whose distance certainly exceeds this value.
+
+    Returns:
+        np.ndarray: The k distances.
+    """
+    matrix = table.matrix
+    sp_id = table.sp_id
+    m = len(ids1)
+    n, k = ids_matrix.shape
+    insert_costs = matrix[sp_id][ids_matrix]
+    low, high = -m, n
+    if cutoff is not None:
+        band = _levenshtein_band(m, n, *table._cheapest_indels, cutoff)
+        if band is None:
+            return np.full(k, np.inf)
+        low, high = band
+    # The cells outside the band are never set and have to hold inf. A band
+    # that excludes no cell is dropped, so that the arrays need no filling.
+    banded = low > 1 - m or high < n - 1
+    if not banded:
+        low, high = -m, n
+
+    # prev[j] holds the distances between word1[:i-1] and word2[:j]
+    prev = np.empty((n + 1, k), dtype=np.float64)
+    if banded:
+        prev.fill(np.inf)
+    prev[0] = 0.0
+    for j in range(1, min(n, high) + 1):
+        np.add(prev[j - 1], insert_costs[j - 1], out=prev[j])
+    curr = np.empty_like(prev)
+    if banded:
+        curr.fill(np.inf)
+    # positions in the group of the words still evaluated, if some were abandoned
+    alive = None
+    for i, c1 in enumerate(ids1, 1):
+        delete_cost = matrix[c1, sp_id]
+        # Replacement and deletion only depend on the previous row, so they
+        # are computed for all columns (of the band) at once.
+        if banded:
+            # the columns of the band, besides column 0
+            start, stop = max(1, i + low), min(n, i + high)
+            replace_costs = matrix[c1][ids_matrix[start - 1 : stop]]
+            diagonal = np.minimum(
+                prev[start - 1 : stop] + replace_costs,
+                prev[start : stop + 1] + delete_cost,
+            )
+            curr[0] = prev[0] + delete_cost if i + low <= 0 else np.inf
+            if start > 1:
+                # The band moves right by one column per row, and the cells
+                # right of it are never set, so only the cells it left since
+                # curr last held a row have to be cleared.
+                curr[max(1, start - 2) : start] = np.inf
+        else:
+            start, stop = 1, n
+            replace_costs = matrix[c1][ids_matrix]
+            diagonal = np.minimum(prev[:-1] + replace_costs, prev[1:] + delete_cost)
+            curr[0] = prev[0] + delete_cost
+        for j in range(start, stop + 1):
+            np.minimum(
+                diagonal[j - start], curr[j - 1] + insert_costs[j - 1], out=curr[j]
+            )
+        prev, curr = curr, prev
+        if cutoff is not None:
+            keep = prev.min(axis=0) <= cutoff
+            if not keep.all():
+                alive = np.flatnonzero(keep) if alive is None else alive[keep]
+                prev = prev[:, keep]
+                curr = np.empty_like(prev)
+                if banded:
+                    curr.fill(np.inf)
+                ids_matrix = ids_matrix[:, keep]
+                insert_costs = insert_costs[:, keep]
+                if not len(alive):
+                    break
+    if alive is None:
+        return prev[n].copy()
+    distances = np.full(k, np.inf)
+    distances[alive] = prev[n]
+    return distances
+
+
+def _levenshtein_encoded(
+    table: KanaDistanceTable, ids1: Sequence[int], ids2: Sequence[int]
+) -> float:
+    """
+    Calculates the weighted Levenshtein distance between two encoded words
+    with scalar operations on the rows of the table.
+    """
+    rows = table.rows
+    sp_id = table.sp_id
+    insert_row = rows[sp_id]
+    n = len(ids2)
+    insert_costs = [insert_row[c] for c in ids2]
+
+    # prev[j] holds the distance between word1[:i-1] and word2[:j]
+    prev = [0.0] * (n + 1)
+    for j in range(1, n + 1):
+        prev[j] = prev[j - 1] + insert_costs[j - 1]
+
+    for c1 in ids1:
+        replace_row = rows[c1]
+        delete_cost = replace_row[sp_id]
+        curr = [prev[0] + delete_cost] + [0.0] * n
+        for j in range(1, n + 1):
+            curr[j] = min(
+                prev[j - 1] + replace_row[ids2[j - 1]],
+                prev[j] + delete_cost,
+                curr[j - 1] + insert_costs[j - 1],
+            )
+        prev = curr
+    return prev[n]
+
+
+def _levenshtein_band(
+    m: int, n: int, min_insert: float, min_delete: float, max_distance: float
+) -> tuple[int, int] | None:
+    """
+    Returns the diagonal band of the DP cells that an alignment within
+    max_distance can pass.
+
+    An alignment through cell (i, j) makes at least j - i more insertions
+    than deletions before it (or the reverse), and the length difference of
+    the rest forces more after it, each costing at least min_insert or
+    min_delete.
+
+    Args:
+        m (int): The length of the first word.
+        n (int): The length of the second word.
+        min_insert (float): The cheapest insertion cost of the moras of the second word.
+        min_delete (float): The cheapest deletion cost of the moras of the first word.
+        max_distance (float): The largest distance of interest.
+
+    Returns:
+        Optional[Tuple[int, int]]: The lowest and highest j - i of the band, or None if the length difference alone exceeds max_distance.
+    """
+    limit = max_distance + _BOUND_RTOL * max(1.0, abs(max_distance))
+
+    def forced(difference: int) -> float:
+        return difference * min_insert if difference > 0 else -difference * min_delete
+
+    diagonals = [d for d in range(-m, n + 1) if forced(d) + forced(n - m - d) <= limit]
+    if not diagonals:
+        return None
+    return diagonals[0], diagonals[-1]
+
+
+def _levenshtein_bounded(
+    table: KanaDistanceTable,
+    ids1: Sequence[int],
+    ids2: Sequence[int],
+    max_distance: float,
+) -> tuple[float, int]:
+    """
+    Calculates the weighted Levenshtein distance between two encoded words if
+    it is within max_distance.
+
+    The DP of _levenshtein_encoded is limited to the band of
+    _levenshtein_band and stops as soon as a whole row exceeds max_distance.
+    The cells on an optimal alignment within the band are computed with the
+    same additions, so distances within max_distance are exact.
+
+    Returns:
+        tuple[float, int]: The distance, or inf if it exceeds max_distance, and the number of DP cells evaluated.
+    """
+    rows = table.rows
+    sp_id = table.sp_id
+    insert_row = rows[sp_id]
+    m, n = len(ids1), len(ids2)
+    insert_costs = [insert_row[c] for c in ids2]
+    delete_costs = [rows[c][sp_id] for c in ids1]
+    band = _levenshtein_band(
+        m,
+        n,
+        min(insert_costs, default=0.0),
+        min(delete_costs, default=0.0),
+        max_distance,
+    )
+    inf = float("inf")
+    if band is None:
+        return inf, 0
+    low, high = band
+
+    # prev[j] holds the distance between word1[:i-1] and word2[:j], or inf
+    # outside the band
+    prev = [inf] * (n + 1)
+    prev[0] = 0.0
+    for j in range(1, min(n, high) + 1):
+        prev[j] = prev[j - 1] + insert_costs[j - 1]
+
+    cells = 0
+    for i, c1 in enumerate(ids1, 1):
+        replace_row = rows[c1]
+        delete_cost = delete_costs[i - 1]
+        start, stop = max(1, i + low), min(n, i + high)
+        curr = [inf] * (n + 1)
+        if i + low <= 0:
+            curr[0] = prev[0] + delete_cost
+        for j in range(start, stop + 1):
+            curr[j] = min(
+                prev[j - 1] + replace_row[ids2[j - 1]],
+                prev[j] + delete_cost,
+                curr[j - 1] + insert_costs[j - 1],
+            )
+        cells += max(0, stop - start + 1)
+        if min(curr) > max_distance:
+            return inf, cells
+        prev = curr
+    return (prev[n] if prev[n] <= max_distance else inf), cells
+
+
+def _levenshtein_last_row(
+    replace_costs: Callable[[int, range], list[float]],
+    delete_costs: list[float],
+    insert_costs: list[float],
+    rows: range,
+    columns: range,
+) -> list[float]:
+    """
+    Calculates the last row of the weighted Levenshtein DP between the moras
+    of the first word at rows and those of the second word at columns, in the
+    given orders, keeping only two rows in memory.
+
+    Args:
+        replace_costs (Callable[[int, range], list[float]]): Returns the costs of replacing mora i of the first word with each mora of the second word at the given columns.
+        delete_costs (list[float]): The deletion costs of the moras of the first word.
+        insert_costs (list[float]): The insertion costs of the moras of the second word.
+        rows (range): The positions in the first word, possibly reversed.
+        columns (range): The positions in the second word, possibly reversed.
+
+    Returns:
+        list[float]: The distances from the moras at rows to each prefix of the moras at columns.
+    """
+    n = len(columns)
+    column_insert_costs = [insert_costs[j] for j in columns]
+    prev = [0.0] * (n + 1)
+    for j in range(1, n + 1):
+        prev[j] = prev[j - 1] + column_insert_costs[j - 1]
+    for i in rows:
+        replace_row = replace_costs(i, columns)
+        delete_cost = delete_costs[i]
+        curr = [prev[0] + delete_cost] + [0.0] * n
+        for j in range(1, n + 1):
+            curr[j] = min(
+                prev[j - 1] + replace_row[j - 1],
+                prev[j] + delete_cost,
+                curr[j - 1] + column_insert_costs[j - 1],
+            )
+        prev = curr
+    return prev
+
+
+def _hirschberg(
+    replace_costs: Callable[[int, range], list[float]],
+    delete_costs: list[float],
+    insert_costs: list[float],
+    rows: range,
+    columns: range,
+    path: list[tuple[int | None, int | None]],
+):
+    """
+    Appends an optimal weighted Levenshtein alignment of the moras at rows and
+    columns to path with Hirschberg's algorithm.
+
+    The first word is split in half, and the forward DP of the first half and
+    the backward DP of the second half give the column where an optimal
+    alignment crosses the middle. Both halves are then aligned recursively,
+    so only O(len(rows) + len(columns)) cells are held at a time.
+
+    Args:
+        replace_costs (Callable[[int, range], list[float]]): As in _levenshtein_last_row.
+        delete_costs (list[float]): The deletion costs of the moras of the first word.
+        insert_costs (list[float]): The insertion costs of the moras of the second word.
+        rows (range): The positions in the first word, in ascending order.
+        columns (range): The positions in the second word, in ascending order.
+        path (list[tuple[int | None, int | None]]): The steps as pairs of positions, with None for the missing side of an insertion or a deletion.
+    """
+    if not rows or not columns:
+        path.extend((i, None) for i in rows)
+        path.extend((None, j) for j in columns)
+        return
+    if len(rows) == 1:
+        # The mora is either replaced with one of the moras, with the others
+        # inserted, or deleted, with all of them inserted.
+        i = rows[0]
+        column_insert_costs = [insert_costs[j] for j in columns]
+        total_insert_cost = sum(column_insert_costs)
+        costs = [
+            cost + total_insert_cost - insert_cost
+            for cost, insert_cost in zip(replace_costs(i, columns), column_insert_costs)
+        ]
+        best = min(range(len(costs)), key=costs.__getitem__)
+        if delete_costs[i] + total_insert_cost < costs[best]:
+            path.append((i, None))
+            path.extend((None, j) for j in columns)
+        else:
+            path.extend((None, j) for j in columns[:best])
+            path.append((i, columns[best]))
+            path.extend((None, j) for j in columns[best + 1 :])
+        return
+    middle = len(rows) // 2
+    forward = _levenshtein_last_row(
+        replace_costs, delete_costs, insert_costs, rows[:middle], columns
+    )
+    backward = _levenshtein_last_row(
+        replace_costs, delete_costs, insert_costs, rows[middle:][::-1], columns[::-1]
+    )
+    n = len(columns)
+    split = min(range(n + 1), key=lambda j: forward[j] + backward[n - j])
+    _hirschberg(
+        replace_costs, delete_costs, insert_costs, rows[:middle], columns[:split], path
+    )
+    _hirschberg(
+        replace_costs, delete_costs, insert_costs, rows[middle:], columns[split:], path
+    )
+
+
+# The largest number of DP cells that align_batch holds at a time; longer
+# words are aligned in linear space instead.
+_ALIGN_BATCH_CELLS = 1 << 22
+
+
+def _levenshtein_group_tables(
+    table: KanaDistanceTable, ids1: list[int], ids_matrix: np.ndarray
+) -> np.ndarray:
+    """
+    Calculates the full weighted Levenshtein DP tables from one encoded word
+    to every word of a same-length group at once, as _levenshtein_group does
+    with all rows kept, for tracing the alignments back.
+
+    Args:
+        table (KanaDistanceTable): The kana distance table.
+        ids1 (list[int]): The mora IDs of the first word.
+        ids_matrix (np.ndarray): The ID matrix of shape (n, k) of the group.
+
+    Returns:
+        np.ndarray: The tables of shape (len(ids1) + 1, n + 1, k), where [i, j, w] is the distance between the first i moras of the first word and the first j moras of word w.
+    """
+    matrix = table.matrix
+    sp_id = table.sp_id
+    n, k = ids_matrix.shape
+    insert_costs = matrix[sp_id][ids_matrix]
+    tables = np.empty((len(ids1) + 1, n + 1, k), dtype=np.float64)
+    tables[0, 0] = 0.0
+    for j in range(1, n + 1):
+        np.add(tables[0, j - 1], insert_costs[j - 1], out=tables[0, j])
+    for i, c1 in enumerate(ids1, 1):
+        prev, curr = tables[i - 1], tables[i]
+        replace_costs = matrix[c1][ids_matrix]
+        delete_cost = matrix[c1, sp_id]
+        diagonal = np.minimum(prev[:-1] + replace_costs, prev[1:] + delete_cost)
+        curr[0] = prev[0] + delete_cost
+        for j in range(1, n + 1):
+            np.minimum(diagonal[j - 1], curr[j - 1] + insert_costs[j - 1], out=curr[j])
+    return tables
+
+
+def _levenshtein_traceback(
+    table: KanaDistanceTable,
+    ids1: list[int],
+    ids2: list[int],
+    distances: list[list[float]],
+) -> list[tuple[int | None, int | None]]:
+    """
+    Traces an optimal alignment back through a full DP table.
+
+    Each step repeats the addition of the DP, so the costs of the steps add
+    up to the distance exactly.
+
+    Args:
+        table (KanaDistanceTable): The kana distance table.
+        ids1 (list[int]): The mora IDs of the first word.
+        ids2 (list[int]): The mora IDs of the second word.
+        distances (list[list[float]]): The DP table, where [i][j] is the distance between ids1[:i] and ids2[:j].
+
+    Returns:
+        list[tuple[int | None, int | None]]: The steps as in _hirschberg.
+    """
+    rows = table.rows
+    sp_id = table.sp_id
+    i, j = len(ids1), len(ids2)
+    path: list[tuple[int | None, int | None]] = []
+    while i or j:
+        distance = distances[i][j]
+        if (
+            i
+            and j
+            and distances[i - 1][j - 1] + rows[ids1[i - 1]][ids2[j - 1]] == distance
+        ):
+            i, j = i - 1, j - 1
+            path.append((i, j))
+        elif i and distances[i - 1][j] + rows[ids1[i - 1]][sp_id] == distance:
+            i -= 1
+            path.append((i, None))
+        else:
+            j -= 1
+            path.append((None, j))
+    path.reverse()
+    return path
+
+
+# The largest number of DP cells per text block of find_batch.
+_FIND_BATCH_CELLS = 1 << 20
+
+
+def _semiglobal_group(
+    table: KanaDistanceTable, ids1: list[int], ids_matrix: np.ndarray
+) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Calculates the semi-global weighted Levenshtein DP from a phrase to a
+    group of texts at once.
+
+    Leading and trailing moras of the texts are free: the first row is 0 for
+    every column, so an alignment may start anywhere, and every column of
+    the last row is a possible end. The start column is carried along with
+    each cell, preferring the replacement, then the deletion, then the
+    insertion on ties, so that the spans need no traceback. The cells are
+    computed with the same additions as _levenshtein_group, so the distance
+    of a span equals that of calculate on it.
+
+    Args:
+        table (KanaDistanceTable): The kana distance table.
+        ids1 (list[int]): The mora IDs of the phrase.
+        ids_matrix (np.ndarray): The ID matrix of shape (n, k) of the texts, padded at the end with any ID.
+
+    Returns:
+        tuple[np.ndarray, np.ndarray]: Arrays of shape (n + 1, k), where [j, w] is the smallest distance between the phrase and a span of text w ending at mora j, and the start of that span.
+    """
+    matrix = table.matrix
+    sp_id = table.sp_id
+    n, k = ids_matrix.shape
+    insert_costs = matrix[sp_id][ids_matrix]
+
+    # prev[j] holds the distances between phrase[:i-1] and the best span
+    # ending at j, and prev_starts[j] its start
+    prev = np.zeros((n + 1, k), dtype=np.float64)
+    prev_starts = np.repeat(np.arange(n + 1)[:, None], k, axis=1)
+    curr = np.empty_like(prev)
+    curr_starts = np.empty_like(prev_starts)
+    for c1 in ids1:
+        replace_costs = matrix[c1][ids_matrix]
+        delete_cost = matrix[c1, sp_id]
+        diagonal = prev[:-1] + replace_costs
+        vertical = prev[1:] + delete_cost
+        candidates = np.minimum(diagonal, vertical)
+        candidate_starts = np.where(
+            vertical < diagonal, prev_starts[1:], prev_starts[:-1]
+        )
+        curr[0] = prev[0] + delete_cost
+        curr_starts[0] = 0
+        for j in range(1, n + 1):
+            horizontal = curr[j - 1] + insert_costs[j - 1]
+            np.minimum(candidates[j - 1], horizontal, out=curr[j])
+            np.copyto(
+                curr_starts[j],
+                np.where(
+                    horizontal < candidates[j - 1],
+                    curr_starts[j - 1],
+                    candidate_starts[j - 1],
+                ),
+            )
+        prev, curr = curr, prev
+        prev_starts, curr_starts = curr_starts, prev_starts
+    return prev, prev_starts
+
+
+def _select_spans(
+    distances: np.ndarray,
+    starts: np.ndarray,
+    n: int | None,
+    max_distance: float | None,
+) -> list[tuple[float, int, int]]:
+    """
+    Selects the best non-overlapping spans of a text.
+
+    Every end position gives one candidate span. The candidates are taken
+    from the best, skipping empty spans and those that overlap a span
+    already taken.
+
+    Args:
+        distances (np.ndarray): The distance of the best span ending at each position.
+        starts (np.ndarray): The start of that span.
+        n (Optional[int]): The largest number of spans.
+        max_distance (Optional[float]): The largest distance of a span.
+
+    Returns:
+        list[tuple[float, int, int]]: The distance, start and end of the spans, from best to worst.
+    """
+    ends = np.arange(len(distances))
+    candidates = starts < ends
+    if max_distance is not None:
+        candidates &= distances <= max_distance
+    ends = ends[candidates]
+    starts = starts[candidates]
+    distances = distances[candidates]
+    taken = np.zeros(len(candidates), dtype=bool)
+    spans = []
+    for index in np.lexsort((ends, starts, distances)).tolist():
+        if n is not None and len(spans) >= n:
+            break
+        start, end = int(starts[index]), int(ends[index])
+        if taken[start:end].any():
+            continue
+        taken[start:end] = True
+        spans.append((float(distances[index]), start, end))
+    return spans
+
+
+def _hamming_encoded(
+    table: KanaDistanceTable, ids1: Sequence[int], ids2: Sequence[int]
+) -> float:
+    """
+    Calculates the weighted Hamming distance between two encoded words, or
+    inf if their lengths differ.
+    """
+    if len(ids1) != len(ids2):
+        return float("inf")
+    rows = table.rows
+    cost = 0.0
+    for c1, c2 in zip(ids1, ids2):
+        cost += rows[c1][c2]
+    return cost
+
+
+def _hamming_moras(
+    table: KanaDistanceTable, moras1: Sequence[str], moras2: Sequence[str]
+) -> float:
+    """
+    Calculates the weighted Hamming distance between two mora lists of the
+    same length, looking up the IDs on the fly instead of encoding the words
+    first.
+    """
+    kana2id = table.kana2id
+    rows = table.rows
+    cost = 0.0
+    try:
+        for mora1, mora2 in zip(moras1, moras2):
+            cost += rows[kana2id[mora1]][kana2id[mora2]]
+    except KeyError:
+        # encode raises the ValueError for the unknown mora
+        table.encode([*moras1, *moras2])
+        raise
+    return cost
+
+
+class _Trie:
+    """
+    A mora trie over an encoded word list, stored level by level.
+
+    The nodes of each depth d are numbered from 0, and for each of them
+    levels[d - 1] holds the number of the parent node at depth d - 1 and the
+    mora ID of the edge. terminals[d] holds the node and the position in the
+    word list of every word of length d. The root is node 0 of depth 0.
+    """
+
+    def __init__(self, offsets: np.ndarray, ids: np.ndarray, vocabulary_size: int):
+        lengths = np.diff(offsets)
+        starts = offsets[:-1]
+        # the node of every word at the current depth
+        nodes = np.zeros(len(lengths), dtype=np.int64)
+        self.levels: list[tuple[np.ndarray, np.ndarray]] = []
+        words = np.flatnonzero(lengths == 0)
+        self.terminals = [(np.zeros(len(words), dtype=np.intp), words)]
+        for depth in range(1, int(lengths.max(initial=0)) + 1):
+            words = np.flatnonzero(lengths >= depth)
+            # Words sharing the parent node and the next mora share the child.
+            keys = nodes[words] * vocabulary_size + ids[starts[words] + depth - 1]
+            unique_keys, nodes[words] = np.unique(keys, return_inverse=True)
+            self.levels.append(
+                (unique_keys // vocabulary_size, unique_keys % vocabulary_size)
+            )
+            words = words[lengths[words] == depth]
+            self.terminals.append((nodes[words].astype(np.intp), words))
+
+    @property
+    def num_nodes(self) -> int:
+        return 1 + sum(len(parents) for parents, _ in self.levels)
+
+    @classmethod
+    def from_encoded(
+        cls, encoded_words: list[list[int]], vocabulary_size: int
+    ) -> "_Trie":
+        lengths = np.fromiter(map(len, encoded_words), dtype=np.int64)
+        offsets = np.concatenate([[0], np.cumsum(lengths)])
+        ids = np.fromiter(
+            (c for ids in encoded_words for c in ids),
+            dtype=np.int64,
+            count=int(offsets[-1]),
+        )
+        return cls(offsets, ids, vocabulary_size)
+
+
+def _levenshtein_trie_search(
+    table: KanaDistanceTable, ids1: list[int], trie: _Trie, collector: "_TopN"
+) -> tuple[int, int]:
+    """
+    Feeds the weighted Levenshtein distances from one encoded word to the
+    words of a trie that may be kept by the collector.
+
+    The DP advances over the moras of the trie words, so that the column of a
+    prefix is computed once for all words sharing it. Each column holds the
+    same values as in WeightedLevenshtein. The trie is walked level by level,
+    computing the columns of all surviving nodes of a depth at once, and a
+    subtree is pruned when the minimum of its column exceeds the cutoff.
+
+    Args:
+        table (KanaDistanceTable): The kana distance table.
+        ids1 (list[int]): The mora IDs of the first word.
+        trie (_Trie): The trie of the word list.
+        collector (_TopN): The collector of the distances.
+
+    Returns:
+        tuple[int, int]: The number of words whose distance was calculated and
+            the number of DP cells evaluated.
+    """
+    matrix = table.matrix
+    sp_id = table.sp_id
+    query = np.asarray(ids1, dtype=np.intp)
+    m = len(query)
+    delete_costs = matrix[query, sp_id]
+
+    # columns[i, p] holds the distance between word1[:i] and the prefix of
+    # the node at position p of the frontier
+    columns = np.empty((m + 1, 1), dtype=np.float64)
+    columns[0] = 0.0
+    for i in range(1, m + 1):
+        np.add(columns[i - 1], delete_costs[i - 1], out=columns[i])
+    # the frontier position of every node of the previous depth, or -1
+    positions = np.zeros(1, dtype=np.intp)
+    _, words = trie.terminals[0]
+    collector.push(words, np.full(len(words), columns[m, 0]))
+    reached = len(words)
+    cells = 0
+
+    for depth, (parents, moras) in enumerate(trie.levels, 1):
+        parent_positions = positions[parents]
+        alive = np.flatnonzero(parent_positions >= 0)
+        if not len(alive):
+            break
+        prev = columns[:, parent_positions[alive]]
+        moras = moras[alive]
+        insert_costs = matrix[sp_id][moras]
+        columns = np.empty_like(prev)
+        cells += m * len(alive)
+        np.add(prev[0], insert_costs, out=columns[0])
+        if m:
+            # Replacement and insertion only depend on the previous column.
+            diagonal = np.minimum(
+                prev[:-1] + matrix[query[:, None], moras], prev[1:] + insert_costs
+            )
+            for i in range(1, m + 1):
+                np.minimum(
+                    diagonal[i - 1],
+                    columns[i - 1] + delete_costs[i - 1],
+                    out=columns[i],
+                )
+        positions = np.full(len(parents), -1, dtype=np.intp)
+        positions[alive] = np.arange(len(alive))
+
+        nodes, words = trie.terminals[depth]
+        word_positions = positions[nodes]
+        reached_words = word_positions >= 0
+        collector.push(words[reached_words], columns[m, word_positions[reached_words]])
+        reached += int(np.count_nonzero(reached_words))
+
+        cutoff = collector.cutoff
+        if cutoff is not None:
+            # Costs are non-negative, so every extension of a prefix is at
+            # least as far as the minimum of its column.
+            keep = columns.min(axis=0) <= cutoff
+            if not keep.all():
+                positions[alive] = -1
+                positions[alive[keep]] = np.arange(np.count_nonzero(keep))
+                columns = columns[:, keep]
+    return reached, cells
+
+
+def _hamming_group(
+    table: KanaDistanceTable,
+    ids1: list[int],
+    ids_matrix: np.ndarray,
+    cutoff: float | None = None,
+) -> np.ndarray:
+    """
+    Calculates the weighted Hamming distance from one encoded word to every
+    word of a group of the same length at once.
+
+    The costs are added position by position as in WeightedHamming, so the
+    results are identical. With a cutoff, words whose partial sum exceeds it
+    are abandoned and get inf.
+
+    Args:
+        table (KanaDistanceTable): The kana distance table.
+        ids1 (list[int]): The mora IDs of the first word.
+        ids_matrix (np.ndarray): The ID matrix of shape (len(ids1), k) of the group.
+        cutoff (Optional[float]): Abandon words whose distance certainly exceeds this value.
+
+    Returns:
+        np.ndarray: The k distances.
+    """
+    matrix = table.matrix
+    k = ids_matrix.shape[1]
+    totals = np.zeros(k, dtype=np.float64)
+    alive = None
+    # One gather per position is faster than gathering the whole (n, k)
+    # block at once, and adds in the same order as WeightedHamming.
+    for c1, column in zip(ids1, ids_matrix):
+        totals += matrix[c1][column if alive is None else column[alive]]
+        if cutoff is not None:
+            keep = totals <= cutoff
+            if not keep.all():
+                alive = np.flatnonzero(keep) if alive is None else alive[keep]
+                totals = totals[keep]
+                if not len(alive):
+                    break
+    if alive is None:
+        return totals
+    distances = np.full(k, np.inf)
+    distances[alive] = totals
+    return distances
+
+
+class _TopN:
+    """
+    Keeps the n best (distance, index) pairs seen so far in a bounded heap.
+
+    Pairs are ordered by distance and then by index, which reproduces a
+    stable sort of the whole list by distance. Without n, every pair within
+    max_distance is kept, and the pairs are only sorted by items.
+    """
+
+    def __init__(self, n: int | None = None, max_distance: float | None = None):
+        self.n = n
+        self.max_distance = max_distance
+        # max-heap of (-distance, -index)
+        self.heap: list[tuple[float, int]] = []
+        # the pushed arrays, without n
+        self.batches: list[tuple[np.ndarray, np.ndarray]] = []
+
+    @property
+    def cutoff(self) -> float | None:
+        """The largest distance that can still be kept, or None if any can."""
+        cutoff = self.max_distance
+        if self.n is not None and len(self.heap) >= self.n:
+            worst = -self.heap[0][0]
+            cutoff = worst if cutoff is None else min(cutoff, worst)
+        return cutoff
+
+    def push(self, indices: np.ndarray, distances: np.ndarray):
+        cutoff = self.cutoff
+        if cutoff is not None:
+            within = distances <= cutoff
+            indices, distances = indices[within], distances[within]
+        if self.n is None:
+            self.batches.append((indices, distances))
+            return
+        if len(distances) > self.n:
+            # Only the n best pairs of the batch can enter the heap; the
+            # partition keeps the ties of the n-th distance. For a large
+            # batch, the n-th distance of a strided sample is an upper bound
+            # that discards most pairs before the exact partition.
+            step = len(distances) // (64 * self.n)
+            if step > 1:
+                sample = np.partition(distances[::step], self.n - 1)
+                best = np.flatnonzero(distances <= sample[self.n - 1])
+                indices, distances = indices[best], distances[best]
+            nth = np.partition(distances, self.n - 1)[self.n - 1]
+            best = np.flatnonzero(distances <= nth)
+            indices, distances = indices[best], distances[best]
+        order = np.lexsort((indices, distances))[: self.n]
+        for distance, index in zip(distances[order].tolist(), indices[order].tolist()):
+            item = (-distance, -index)
+            if len(self.heap) < self.n:
+                heapq.heappush(self.heap, item)
+            elif item > self.heap[0]:
+                heapq.heapreplace(self.heap, item)
+            else:
+                # The rest of the batch is worse.
+                break
+
+    def items(self) -> list[tuple[float, int]]:
+        """Returns the kept (distance, index) pairs from best to worst."""
+        if self.n is None:
+            if not self.batches:
+                return []
+            indices = np.concatenate([indices for indices, _ in self.batches])
+            distances = np.concatenate([distances for _, distances in self.batches])
+            order = np.lexsort((indices, distances))
+            return list(zip(distances[order].tolist(), indices[order].tolist()))
+        return sorted((-distance, -index) for distance, index in self.heap)
+
+    def results(self, words: Sequence[str]) -> list[tuple[str, float]]:
+        """Returns the kept pairs from best to worst as (word, distance)."""
+        items = self.items()
+        positions = [index for _, index in items]
+        if isinstance(words, WordIndex):
+            found = words._decode(positions)
+        else:
+            found = [words[index] for index in positions]
+        return [(word, distance) for word, (distance, _) in zip(found, items)]
+
+
+# Number of words scored at once by the streaming methods.
+_STREAM_CHUNK_SIZE = 4096
+
+
+def _iter_words(words: "Iterable[str] | str | os.PathLike[str]") -> Iterator[str]:
+    """Yields the words of an iterable, or the lines of a file given by its path."""
+    if isinstance(words, (str, os.PathLike)):
+        with open(words, "r", encoding="utf-8") as f:
+            for line in f:
+                yield line.rstrip("\r\n")
+    else:
+        yield from words
+
+
+def _iter_chunks(
+    words: "Iterable[str] | str | os.PathLike[str]", chunk_size: int
+) -> Iterator[list[str]]:
+    if chunk_size <= 0:
+        raise ValueError("chunk_size must be positive")
+    iterator = _iter_words(words)
+    while chunk := list(islice(iterator, chunk_size)):
+        yield chunk
+
+
+def _stream_distances(
+    calculator: "WeightedLevenshtein | WeightedHamming",
+    word: str,
+    words: "Iterable[str] | str | os.PathLike[str]",
+    chunk_size: int,
+) -> Iterator[list[tuple[str, float]]]:
+    for chunk in _iter_chunks(words, chunk_size):
+        distances = np.asarray(calculator.calculate_batch([word], chunk, as_array=True))
+        yield list(zip(chunk, distances[0].tolist()))
+
+
+def _stream_topn(
+    calculator: "WeightedLevenshtein | WeightedHamming",
+    word: str,
+    words: "Iterable[str] | str | os.PathLike[str]",
+    n: int,
+    chunk_size: int,
+    search: Callable[[str, list[str], _TopN, "_StatsCall | None"], None],
+    call: "_StatsCall | None" = None,
+) -> list[tuple[str, float]]:
+    """
+    Keeps the n best words of a stream, reading chunk_size words at a time.
+
+    Each chunk is searched with the current n-th distance as its cutoff, so
+    the pruning of the search carries over from one chunk to the next. Only
+    the words in the running top n are kept, and positions in the stream
+    break ties, so the results equal get_topn on the whole list.
+    """
+    topn = _TopN(n)
+    kept: dict[int, str] = {}
+    start = 0
+    for chunk in _iter_chunks(words, chunk_size):
+        if calculator.distance_table is None:
+            batch = calculator.calculate_batch([word], chunk, as_array=True)
+            distances = np.asarray(batch)[0]
+            indices = np.arange(len(chunk))
+        else:
+            candidates = _TopN(n, max_distance=topn.cutoff)
+            search(word, chunk, candidates, call)
+            if call is not None:
+                call.searched(calculator.pruning_stats)
+            items = candidates.items()
+            indices = np.array([index for _, index in items], dtype=np.intp)
+            distances = np.array([distance for distance, _ in items])
+        topn.push(indices + start, distances)
+        positions = {-index for _, index in topn.heap}
+        kept = {i: kept[i] if i in kept else chunk[i - start] for i in positions}
+        start += len(chunk)
+    return [(kept[index], distance) for distance, index in topn.items()]
+
+
+# Default number of rows and columns of a tile of calculate_matrix.
+_MATRIX_TILE_SIZE = 1024
+
+
+def _calculate_matrix(
+    calculator: "WeightedLevenshtein | WeightedHamming",
+    words: "list[str] | WordIndex",
+    path: str,
+    dtype: "str | np.dtype",
+    tile_size: int,
+    symmetric: bool | None,
+    progress: Callable[[int, int], None] | None,
+) -> np.ndarray:
+    """
+    Computes the distances between all pairs of words tile by tile into a
+    memory-mapped .npy file.
+
+    The tiles are computed with calculate_batch in a fixed order, and after
+    each one the file is flushed and the number of completed tiles is saved
+    to path + ".progress" with a digest of the inputs. A later call with the
+    same inputs continues after the last completed tile; the progress file
+    is removed once the matrix is complete. If the distances are symmetric,
+    only the tiles on and above the diagonal are computed and mirrored.
+    """
+    dtype = np.dtype(dtype)
+    if dtype not in (np.float32, np.float64):
+        raise ValueError(f"dtype must be float32 or float64, not {dtype}")
+    if tile_size < 1:
+        raise ValueError("tile_size must be positive")
+    table = calculator.distance_table
+    if symmetric is None:
+        symmetric = table is not None and np.array_equal(table.matrix, table.matrix.T)
+    digest = hashlib.sha256(type(calculator).__name__.encode("utf-8"))
+    if table is not None:
+        # Encode the words once; the tiles are views of the index.
+        words = _as_word_index(table, calculator.preprocess_func, words)
+        digest.update(_matrix_digest(table.matrix).encode("ascii"))
+        digest.update(np.diff(words.offsets).astype("<i8").tobytes())
+        digest.update(words.ids[words.offsets[0] : words.offsets[-1]].tobytes())
+    else:
+        words = list(words)
+        for word in words:
+            digest.update(word.encode("utf-8") + b"\n")
+    size = len(words)
+    state = {
+        "digest": digest.hexdigest(),
+        "size": size,
+        "dtype": dtype.str,
+        "tile_size": tile_size,
+        "symmetric": symmetric,
+    }
+    starts = range(0, size, tile_size)
+    tiles = [(i, j) for i in starts for j in starts if not symmetric or j >= i]
+
+    progress_path = path + ".progress"
+    completed = 0
+    matrix = None
+    if os.path.exists(path) and os.path.exists(progress_path):
+        with open(progress_path, "r", encoding="utf-8") as f:
+            saved = json.load(f)
+        if saved.get("state") == state:
+            completed = saved["completed"]
+            matrix = np.lib.format.open_memmap(path, mode="r+")
+    if matrix is None:
+        matrix = np.lib.format.open_memmap(
+            path, mode="w+", dtype=dtype, shape=(size, size)
+        )
+        _save_matrix_progress(progress_path, state, completed)
+    if progress is not None:
+        progress(completed, len(tiles))
+
+    def tile_words(start: int) -> "list[str] | WordIndex":
+        stop = min(start + tile_size, size)
+        if isinstance(words, WordIndex):
+            return words._slice(start, stop)
+        return words[start:stop]
+
+    buffer = np.empty((min(tile_size, size),) * 2, dtype=np.float64)
+    for i, j in tiles[completed:]:
+        rows, columns = min(tile_size, size - i), min(tile_size, size - j)
+        distances = buffer[:rows, :columns]
+        calculator.calculate_batch(tile_words(i), tile_words(j), out=distances)
+        matrix[i : i + rows, j : j + columns] = distances
+        if symmetric and i != j:
+            matrix[j : j + columns, i : i + rows] = distances.T
+        matrix.flush()
+        completed += 1
+        _save_matrix_progress(progress_path, state, completed)
+        if progress is not None:
+            progress(completed, len(tiles))
+    del matrix
+    os.remove(progress_path)
+    return np.load(path, mmap_mode="r")
+
+
+def _save_matrix_progress(path: str, state: dict, completed: int):
+    directory = os.path.dirname(os.path.abspath(path))
+    with tempfile.NamedTemporaryFile("w", dir=directory, delete=False) as f:
+        try:
+            json.dump({"state": state, "completed": completed}, f)
+            f.close()
+            os.replace(f.name, path)
+        finally:
+            # Only left behind if writing or replacing failed.
+            if os.path.exists(f.name):
+                os.unlink(f.name)
+
+
+# Relative slack when comparing lower bounds with a cutoff. The bounds are
+# summed in a different order than the DP, so they may exceed an equal true
+# distance by a rounding error.
+_BOUND_RTOL = 1e-9
+
+
+def _levenshtein_lower_bounds(
+    table: KanaDistanceTable, ids1: list[int], ids_matrix: np.ndarray
+) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Computes two admissible lower bounds of the weighted Levenshtein distance
+    from one encoded word to every word of a same-length group.
+
+    The length bound counts the insertions (or deletions) forced by the
+    length difference, each costing at least the cheapest one among the
+    moras of the longer word. The mora bound uses the fact that every mora of
+    one word is either inserted/deleted or replaced by some mora of the
+    other, so it costs at least the cheapest of these; it is evaluated for
+    both words and the larger sum is taken.
+
+    Args:
+        table (KanaDistanceTable): The kana distance table.
+        ids1 (list[int]): The mora IDs of the first word.
+        ids_matrix (np.ndarray): The ID matrix of shape (n, k) of the group.
+
+    Returns:
+        tuple[np.ndarray, np.ndarray]: The length bounds and the mora bounds of the k words.
+    """
+    matrix = table.matrix
+    sp_id = table.sp_id
+    m = len(ids1)
+    n, k = ids_matrix.shape
+    query = np.asarray(ids1, dtype=np.intp)
+    insert_costs = matrix[sp_id][ids_matrix]
+    delete_costs = matrix[query, sp_id]
+
+    if n > m:
+        length_bounds = (n - m) * insert_costs.min(axis=0)
+    elif n < m:
+        length_bounds = np.full(k, (m - n) * delete_costs.min())
+    else:
+        length_bounds = np.zeros(k)
+
+    # cheapest way to produce each mora of the vocabulary in word2
+    best_for_word2 = matrix[sp_id]
+    if m:
+        best_for_word2 = np.minimum(best_for_word2, matrix[query].min(axis=0))
+    word2_bounds = best_for_word2[ids_matrix].sum(axis=0)
+    word1_bounds = np.zeros(k)
+    for c1, delete_cost in zip(ids1, delete_costs):
+        best = matrix[c1][ids_matrix].min(axis=0) if n else np.full(k, np.inf)
+        word1_bounds += np.minimum(best, delete_cost)
+    return length_bounds, np.maximum(word1_bounds, word2_bounds)
+
+
+def _new_pruning_stats(candidates: int) -> dict[str, int]:
+    return {
+        "candidates": candidates,
+        "length_bound": 0,
+        "mora_bound": 0,
+        "abandoned": 0,
+        "evaluated": 0,
+        "dp_cells": 0,
+    }
+
+
+def _prepare_batch_output(out: np.ndarray | None, shape: tuple[int, int]) -> np.ndarray:
+    if out is None:
+        return np.empty(shape, dtype=np.float64)
+    if out.shape != shape:
+        raise ValueError(f"out has shape {out.shape}, expected {shape}")
+    return out
+
+
+def _jamorasep_parse(text: str) -> list[str]:
+    """Splits text into moras with jamorasep.parse, importing jamorasep on first use."""
+    import jamorasep
+
+    return jamorasep.parse(text)
+
+
+def _within(distance: float, max_distance: float | None) -> float:
+    """Returns distance, or inf if it exceeds max_distance."""
+    if max_distance is not None and distance > max_distance:
+        return float("inf")
+    return distance
+
+
+# Class to calculate weighted Levenshtein distance
+class WeightedLevenshtein:
+    """
+    A class to calculate the weighted Levenshtein distance between two lists of strings.
+    The distance is calculated based on the costs of insertion, deletion, and replacement operations.
+    Custom cost functions and preprocessing functions can be provided to modify the behavior of the distance calculation.
+
+    Attributes:
+        insert_cost (float): The default cost of an insertion operation.
+        delete_cost (float): The default cost of a deletion operation.
+        replace_cost (float): The default cost of a replacement operation.
+        insert_cost_func (Optional[Callable[[str], float]]): A custom function to calculate the cost of an insertion operation.
+        delete_cost_func (Optional[Callable[[str], float]]): A custom function to calculate the cost of a deletion operation.
+        replace_cost_func (Optional[Callable[[str, str], float]]): A custom function to calculate the cost of a replacement operation.
+        preprocess_func (Optional[Callable[[str], List[str]]]): A custom function to preprocess the input lists before calculating the distance.
+        distance_table (Optional[KanaDistanceTable]): A dense distance table. If given, words are encoded into mora IDs and the costs are read from the table instead of calling the cost functions.
+        memo (Optional[MemoCache]): A bounded cache of distance calculation results, or None if memoization is disabled.
+        pruning_stats (Dict[str, int]): Counts of the last get_topn or get_within call: candidates, pruned by the length bound, pruned by the mora bound, abandoned during the DP, evaluated, and the DP cells evaluated.
+        stats (Optional[CalculatorStats]): Counters of the time and work of every call, or None if stats are disabled.
+    """
+
+    def __init__(
+        self,
+        insert_cost: float = 1.0,
+        delete_cost: float = 1.0,
+        replace_cost: float = 1.0,
+        insert_cost_func: Callable[[str], float] | None = None,
+        delete_cost_func: Callable[[str], float] | None = None,
+        replace_cost_func: Callable[[str, str], float] | None = None,
+        preprocess_func: Callable[[str], list[str]] = _jamorasep_parse,
+        distance_table: KanaDistanceTable | None = None,
+        memo: MemoCache | bool = True,
+        stats: CalculatorStats | bool = False,
+    ):
+        """
+        Initializes the WeightedLevenshtein class with the given costs and custom functions.
+
+        Args:
+            insert_cost (float): The default cost of an insertion operation.
+            delete_cost (float): The default cost of a deletion operation.
+            replace_cost (float): The default cost of a replacement operation.
+            insert_cost_func (Optional[Callable[[str], float]]): A custom function to calculate the cost of an insertion operation.
+            delete_cost_func (Optional[Callable[[str], float]]): A custom function to calculate the cost of a deletion operation.
+            replace_cost_func (Optional[Callable[[str, str], float]]): A custom function to calculate the cost of a replacement operation.
+            preprocess_func (Optional[Callable[[str], List[str]]]): A custom function to preprocess the input lists before calculating the distance.
+            distance_table (Optional[KanaDistanceTable]): A dense distance table that takes precedence over the cost functions.
+            memo (MemoCache | bool): The cache of distance calculation results. True creates a MemoCache with the default budget and False disables memoization.
+            stats (CalculatorStats | bool): The counters to update on every call. True creates a CalculatorStats. Disabled by default; when disabled, calls are not measured.
+        """
+        self.insert_cost = insert_cost
+        self.delete_cost = delete_cost
+        self.replace_cost = replace_cost
+        self.insert_cost_func = insert_cost_func
+        self.delete_cost_func = delete_cost_func
+        self.replace_cost_func = replace_cost_func
+        self.preprocess_func = preprocess_func
+        self.distance_table = distance_table
+        self.memo = _resolve_memo(memo)
+        self.stats = _resolve_stats(stats)
+        self.pruning_stats: dict[str, int] = {}
+
+    def calculate(
+        self, word1: str, word2: str, max_distance: float | None = None
+    ) -> float:
+        """
+        Calculates the weighted Levenshtein distance between two words.
+
+        Args:
+            word1 (str): The first word.
+            word2 (str): The second word.
+            max_distance (Optional[float]): If given, only distances up to this value are calculated; larger ones are returned as inf. With a distance table, the DP is limited to the diagonal band the budget allows and stops once a whole row exceeds it. Distances within the budget are exact.
+
+        Returns:
+            float: The distance.
+        """
+        call = None if self.stats is None else self.stats._start(self.memo)
+        if self.preprocess_func:
+            processed_word1 = self.preprocess_func(word1)
+            processed_word2 = self.preprocess_func(word2)
+        if call is None:
+            return self._calculate(processed_word1, processed_word2, max_distance)
+        call.preprocessed()
+        distance = self._calculate(processed_word1, processed_word2, max_distance)
+        call.end("calculate")
+        return distance
+
+    def calculate_batch(
+        self,
+        words1: "list[str] | WordIndex",
+        words2: "list[str] | WordIndex",
+        *,
+        as_array: bool = False,
+        out: np.ndarray | None = None,
+        n_jobs: int | None = None,
+        max_distance: float | None = None,
+    ) -> list[list[float]] | np.ndarray:
+        """
+        Calculates the distances between every pair of words1 and words2.
+
+        If a distance table is set, words2 is grouped by mora length and the
+        DP runs for all words of a group at once with NumPy. The results are
+        identical to those of calculate.
+
+        Args:
+            words1 (list[str] | WordIndex): The first words.
+            words2 (list[str] | WordIndex): The second words.
+            as_array (bool): If True, return a float64 array instead of nested lists.
+            out (Optional[np.ndarray]): An array of shape (len(words1), len(words2)) to write the results to. Implies as_array.
+            n_jobs (Optional[int]): The number of worker processes. Requires a distance table; the rows are split among the workers, which share the table and the encoded words through shared memory. -1 uses all CPUs. Defaults to a single process.
+            max_distance (Optional[float]): If given, distances above it are returned as inf, as in calculate.
+
+        Returns:
+            list[list[float]] | np.ndarray: The distances, where [i][j] is the distance between words1[i] and words2[j].
+        """
+        n_jobs = _resolve_n_jobs(n_jobs)
+        call = None if self.stats is None else self.stats._start(self.memo)
+        if n_jobs > 1:
+            results = _parallel_batch(
+                self, words1, words2, n_jobs, out, call, max_distance
+            )
+            if call is not None:
+                call.end("calculate_batch")
+            return results if as_array or out is not None else results.tolist()
+        if self.distance_table is not None:
+            table = self.distance_table
+            # Encode each word once instead of once per pair.
+            encoded_words1 = _encode_words(table, self.preprocess_func, words1)
+            groups = _encode_groups(table, self.preprocess_func, words2)
+            if call is not None:
+                call.preprocessed()
+            results = _prepare_batch_output(out, (len(words1), len(words2)))
+            for i, ids1 in enumerate(encoded_words1):
+                for indices, ids_matrix in groups.values():
+                    results[i, indices] = _levenshtein_group(
+                        table, ids1, ids_matrix, max_distance
+                    )
+            if max_distance is not None:
+                # The band may overestimate distances above the budget.
+                results[results > max_distance] = np.inf
+            if call is not None:
+                call.count_cells(
+                    self._batch_cells(
+                        map(len, encoded_words1),
+                        {length: len(group[0]) for length, group in groups.items()},
+                    )
+                )
+                call.end("calculate_batch")
+            return results if as_array or out is not None else results.tolist()
+        if self.preprocess_func:
+            processed_words1 = [self.preprocess_func(word1) for word1 in words1]
+            processed_words2 = [self.preprocess_func(word2) for word2 in words2]
+        if call is not None:
+            call.preprocessed()
+        results = []
+        for word1 in processed_words1:
+            result = []
+            for word2 in processed_words2:
+                result.append(self._calculate(word1, word2, max_distance))
+            results.append(result)
+        if as_array or out is not None:
+            array = _prepare_batch_output(out, (len(words1), len(words2)))
+            array[...] = np.array(results, dtype=np.float64).reshape(array.shape)
+            results = array
+        if call is not None:
+            call.end("calculate_batch")
+        return results
+
+    def calculate_matrix(
+        self,
+        words: "list[str] | WordIndex",
+        path: str,
+        *,
+        dtype: "str | np.dtype" = "float64",
+        tile_size: int = _MATRIX_TILE_SIZE,
+        symmetric: bool | None = None,
+        progress: Callable[[int, int], None] | None = None,
+    ) -> np.ndarray:
+        """
+        Calculates the distances between all pairs of words into a memory-mapped .npy file.
+
+        The matrix is computed in tiles of tile_size × tile_size words with
+        calculate_batch, so only one tile is held in memory. After every tile
+        the file is flushed and the progress is saved to path + ".progress";
+        if the call is interrupted, calling it again with the same words and
+        parameters resumes after the last completed tile.
+
+        Args:
+            words (list[str] | WordIndex): The words.
+            path (str): The path of the .npy file to write.
+            dtype (str | np.dtype): The dtype of the matrix, "float64" or "float32".
+            tile_size (int): The number of rows and columns of a tile.
+            symmetric (Optional[bool]): Whether the distances are symmetric, so that only the tiles on and above the diagonal are computed and mirrored. Defaults to whether the distance table is symmetric.
+            progress (Optional[Callable[[int, int], None]]): Called with the number of completed tiles and the total number of tiles at the start and after every tile.
+
+        Returns:
+            np.ndarray: The matrix, memory-mapped read-only from path, where [i, j] is the distance between words[i] and words[j].
+        """
+        return _calculate_matrix(
+            self, words, path, dtype, tile_size, symmetric, progress
+        )
+
+    def get_topn(
+        self,
+        word: str,
+        wordlist: "list[str] | WordIndex",
+        n: int = 10,
+        method: Literal["bounds", "trie"] = "bounds",
+        n_jobs: int | None = None,
+    ) -> list[tuple[str, float]]:
+        """
+        Get the top n similar lists from the given list.
+
+        Args:
+            word (str): The word to compare with.
+            wordlist (list[str] | WordIndex): The list of words to compare.
+            n (int): The number of similar words to get.
+            method (Literal["bounds", "trie"]): The search method used with a distance table. "bounds" evaluates words in order of a lower bound of their distance; "trie" shares the DP of common prefixes in a mora trie, which is usually faster for large lexicons. Both return the same results.
+            n_jobs (Optional[int]): The number of worker processes, each searching a contiguous part of wordlist. Requires a distance table. -1 uses all CPUs. Defaults to a single process.
+
+        Returns:
+            List[Tuple[Hashable, float]]: The top n similar lists and their distances.
+        """
+        n_jobs = _resolve_n_jobs(n_jobs)
+        if n_jobs == 1 and (self.distance_table is None or n <= 0):
+            distances = self.calculate_batch([word], wordlist)[0]
+            return sorted(zip(wordlist, distances), key=lambda x: x[1])[:n]
+        if n <= 0:
+            return []
+        call = None if self.stats is None else self.stats._start(self.memo)
+        topn = _TopN(n)
+        if n_jobs > 1:
+            _parallel_search(
+                self, word, wordlist, topn, n_jobs, {"method": method}, call
+            )
+        else:
+            self._search(word, wordlist, topn, method, call)
+        results = topn.results(wordlist)
+        if call is not None:
+            call.searched(self.pruning_stats)
+            call.end("get_topn")
+        return results
+
+    def get_within(
+        self,
+        word: str,
+        wordlist: "list[str] | WordIndex",
+        max_distance: float,
+        method: Literal["bounds", "trie"] = "bounds",
+        n_jobs: int | None = None,
+    ) -> list[tuple[str, float]]:
+        """
+        Get the words within the given distance from the given list.
+
+        Args:
+            word (str): The word to compare with.
+            wordlist (list[str] | WordIndex): The list of words to compare.
+            max_distance (float): The largest distance to include.
+            method (Literal["bounds", "trie"]): The search method used with a distance table, as in get_topn.
+            n_jobs (Optional[int]): The number of worker processes, as in get_topn.
+
+        Returns:
+            List[Tuple[str, float]]: The words within max_distance and their distances, sorted by distance.
+        """
+        n_jobs = _resolve_n_jobs(n_jobs)
+        if n_jobs == 1 and self.distance_table is None:
+            distances = self.calculate_batch([word], wordlist)[0]
+            within = [(w, d) for w, d in zip(wordlist, distances) if d <= max_distance]
+            return sorted(within, key=lambda x: x[1])
+        call = None if self.stats is None else self.stats._start(self.memo)
+        within = _TopN(max_distance=max_distance)
+        if n_jobs > 1:
+            _parallel_search(
+                self, word, wordlist, within, n_jobs, {"method": method}, call
+            )
+        else:
+            self._search(word, wordlist, within, method, call)
+        results = within.results(wordlist)
+        if call is not None:
+            call.searched(self.pruning_stats)
+            call.end("get_within")
+        return results
+
+    def align(self, word1: str, word2: str) -> list[dict]:
+        """
+        Aligns two words with the minimum total cost, to explain their distance.
+
+        The alignment is found with Hirschberg's divide-and-conquer algorithm,
+        which holds O(len(word1) + len(word2)) DP cells at a time, so long
+        words can be aligned without a quadratic table.
+
+        Args:
+            word1 (str): The first word.
+            word2 (str): The second word.
+
+        Returns:
+            List[Dict]: The steps of the alignment in order, each with "operation" ("match", "replace", "insert" or "delete"), "mora1" and "mora2" (None for an insertion and a deletion respectively), "cost", and "consonant_cost" and "vowel_cost", the parts of the cost (None unless the distance table has a vowel matrix). The costs add up to calculate(word1, word2), up to rounding.
+        """
+        return self._align(self.preprocess_func(word1), self.preprocess_func(word2))
+
+    def align_batch(
+        self, word: str, words: "list[str] | WordIndex"
+    ) -> list[list[dict]]:
+        """
+        Aligns a word with each word of a list, e.g. the results of get_topn.
+
+        With a distance table, the words of each length are aligned with one
+        vectorized DP that keeps its full tables, which are then traced back,
+        so aligning a few words costs little more than calculating their
+        distances. Words whose tables would be too large are aligned with
+        align.
+
+        Args:
+            word (str): The word to align.
+            words (list[str] | WordIndex): The words to align it with.
+
+        Returns:
+            List[List[Dict]]: The alignments in the order of words, as returned by align. With a distance table, the costs of each alignment add up to the distance exactly.
+        """
+        table = self.distance_table
+        if table is None:
+            return [self.align(word, other) for other in words]
+        moras1 = self.preprocess_func(word)
+        ids1 = table.encode(moras1)
+        alignments: list[list[dict]] = [[] for _ in range(len(words))]
+        groups = _encode_groups(table, self.preprocess_func, words)
+        for length, (positions, ids_matrix) in groups.items():
+            chunk_size = _ALIGN_BATCH_CELLS // ((len(ids1) + 1) * (length + 1))
+            if not chunk_size:
+                for position, ids2 in zip(positions.tolist(), ids_matrix.T.tolist()):
+                    moras2 = [table.kanas[c] for c in ids2]
+                    alignments[position] = self._align(moras1, moras2)
+                continue
+            for start in range(0, len(positions), chunk_size):
+                chunk = ids_matrix[:, start : start + chunk_size]
+                tables = _levenshtein_group_tables(table, ids1, chunk)
+                for t, ids2 in enumerate(chunk.T.tolist()):
+                    path = _levenshtein_traceback(
+                        table, ids1, ids2, tables[:, :, t].tolist()
+                    )
+                    moras2 = [table.kanas[c] for c in ids2]
+                    alignments[int(positions[start + t])] = self._alignment_steps(
+                        moras1, moras2, path
+                    )
+        return alignments
+
+    def find(
+        self,
+        phrase: str,
+        text: str,
+        n: int | None = None,
+        max_distance: float | None = None,
+    ) -> list[dict]:
+        """
+        Finds the spans of a text that sound like a phrase.
+
+        The phrase is aligned with the text by a semi-global weighted
+        Levenshtein DP, in which the moras before and after the span are free,
+        so all spans are scored in a single O(len(phrase) * len(text)) pass.
+        Overlapping spans are reduced to the best one. Both words are
+        preprocessed as usual, so e.g. extend_long_vowel_moras removes the
+        whitespace of the text first. Requires a distance table.
+
+        Args:
+            phrase (str): The phrase to find.
+            text (str): The text to search.
+            n (Optional[int]): The largest number of spans to return.
+            max_distance (Optional[float]): The largest distance of a span to return.
+
+        Returns:
+            List[Dict]: The spans from best to worst, each with "start" and "end" (mora positions in the preprocessed text, end exclusive), "span" (the moras of the span joined) and "distance" (equal to calculate(phrase, span)).
+        """
+        return self.find_batch(phrase, [text], n, max_distance)[0]
+
+    def find_batch(
+        self,
+        phrase: str,
+        texts: "list[str] | WordIndex",
+        n: int | None = None,
+        max_distance: float | None = None,
+    ) -> list[list[dict]]:
+        """
+        Finds the spans that sound like a phrase in each of many texts.
+
+        The texts are sorted by length and padded into blocks, and the DP of
+        find runs for all texts of a block at once with NumPy.
+
+        Args:
+            phrase (str): The phrase to find.
+            texts (list[str] | WordIndex): The texts to search.
+            n (Optional[int]): The largest number of spans to return per text.
+            max_distance (Optional[float]): The largest distance of a span to return.
+
+        Returns:
+            List[List[Dict]]: The spans of each text, as returned by find.
+        """
+        table = self.distance_table
+        if table is None:
+            raise ValueError("find requires a distance table")
+        ids1 = table.encode(self.preprocess_func(phrase))
+        encoded_texts = _encode_words(table, self.preprocess_func, texts)
+        lengths = np.array([len(ids) for ids in encoded_texts], dtype=np.intp)
+        results: list[list[dict]] = [[] for _ in encoded_texts]
+        order = np.argsort(lengths, kind="stable")
+        start = 0
+        while start < len(order):
+            # The texts are sorted, so the last text of a block is the longest.
+            stop = start + 1
+            while (
+                stop < len(order)
+                and (stop + 1 - start) * (lengths[order[stop]] + 1) <= _FIND_BATCH_CELLS
+            ):
+                stop += 1
+            width = int(lengths[order[stop - 1]])
+            block = order[start:stop].tolist()
+            ids_matrix = np.full((width, len(block)), table.sp_id, dtype=np.intp)
+            for w, position in enumerate(block):
+                ids_matrix[: lengths[position], w] = encoded_texts[position]
+            distances, starts = _semiglobal_group(table, ids1, ids_matrix)
+            for w, position in enumerate(block):
+                text_length = int(lengths[position]) + 1
+                moras = [table.kanas[c] for c in encoded_texts[position]]
+                results[position] = [
+                    {
+                        "start": span_start,
+                        "end": span_end,
+                        "span": "".join(moras[span_start:span_end]),
+                        "distance": distance,
+                    }
+                    for distance, span_start, span_end in _select_spans(
+                        distances[:text_length, w],
+                        starts[:text_length, w],
+                        n,
+                        max_distance,
+                    )
+                ]
+            start = stop
+        return results
+
+    def iter_distances(
+        self,
+        word: str,
+        words: "Iterable[str] | str | os.PathLike[str]",
+        chunk_size: int = _STREAM_CHUNK_SIZE,
+    ) -> Iterator[list[tuple[str, float]]]:
+        """
+        Calculates the distances from word to a stream of words, one chunk at a time.
+
+        Only one chunk of words is held in memory, so the stream may be larger
+        than the memory.
+
+        Args:
+            word (str): The word to compare with.
+            words (Iterable[str] | str | os.PathLike): The words, or the path of a UTF-8 file with one word per line.
+            chunk_size (int): The number of words per chunk.
+
+        Returns:
+            Iterator[list[tuple[str, float]]]: The words of each chunk and their distances, in stream order.
+        """
+        return _stream_distances(self, word, words, chunk_size)
+
+    def get_topn_stream(
+        self,
+        word: str,
+        words: "Iterable[str] | str | os.PathLike[str]",
+        n: int = 10,
+        chunk_size: int = _STREAM_CHUNK_SIZE,
+        method: Literal["bounds", "trie"] = "bounds",
+    ) -> list[tuple[str, float]]:
+        """
+        Get the top n similar words from a stream of words.
+
+        Only one chunk of words and the running top n are held in memory. The
+        results are the same as those of get_topn on the whole list.
+
+        Args:
+            word (str): The word to compare with.
+            words (Iterable[str] | str | os.PathLike): The words, or the path of a UTF-8 file with one word per line.
+            n (int): The number of similar words to get.
+            chunk_size (int): The number of words searched at once.
+            method (Literal["bounds", "trie"]): The search method used with a distance table, as in get_topn.
+
+        Returns:
+            List[Tuple[str, float]]: The top n similar words and their distances.
+        """
+        if n <= 0:
+            return []
+        # Without a table, the chunks are measured as calculate_batch calls.
+        call = None
+        if self.stats is not None and self.distance_table is not None:
+            call = self.stats._start(self.memo)
+
+        def search(
+            word: str, chunk: list[str], collector: _TopN, call: "_StatsCall | None"
+        ):
+            self._search(word, chunk, collector, method, call)
+
+        results = _stream_topn(self, word, words, n, chunk_size, search, call)
+        if call is not None:
+            call.end("get_topn_stream")
+        return results
+
+    def _search(
+        self,
+        word: str,
+        wordlist: "list[str] | WordIndex",
+        collector: _TopN,
+        method: Literal["bounds", "trie"] = "bounds",
+        call: "_StatsCall | None" = None,
+    ):
+        """
+        Feeds the distances from word to the words of wordlist that may be
+        kept by the collector.
+
+        With the "bounds" method, lower bounds are computed for the whole list
+        at once, and words are evaluated in ascending order of their bound, in
+        growing chunks. Once the bound of the next word exceeds the
+        collector's cutoff, the rest of the list is pruned. With the "trie"
+        method, the words in pruned subtrees count as abandoned. The counts
+        are stored in pruning_stats; call, if given, is marked once the words
+        are encoded.
+        """
+        assert self.distance_table is not None
+        table = self.distance_table
+        ids1 = table.encode(self.preprocess_func(word))
+        stats = _new_pruning_stats(len(wordlist))
+        self.pruning_stats = stats
+        if method == "trie":
+            if isinstance(wordlist, WordIndex):
+                wordlist._check_table(table)
+                trie = wordlist._trie
+            else:
+                trie = _Trie.from_encoded(
+                    _encode_words(table, self.preprocess_func, wordlist),
+                    len(table.kanas),
+                )
+            if call is not None:
+                call.preprocessed()
+            reached, stats["dp_cells"] = _levenshtein_trie_search(
+                table, ids1, trie, collector
+            )
+            stats["evaluated"] = len(wordlist)
+            stats["abandoned"] = len(wordlist) - reached
+            return
+        if method != "bounds":
+            raise ValueError(f"Unknown search method: {method!r}")
+        groups = list(_encode_groups(table, self.preprocess_func, wordlist).values())
+        if call is not None:
+            call.preprocessed()
+        if not groups:
+            return
+
+        # Flatten the groups: group number, position in the group and bounds
+        # of every word.
+        group_numbers = np.concatenate(
+            [np.full(len(indices), g) for g, (indices, _) in enumerate(groups)]
+        )
+        positions = np.concatenate([np.arange(len(indices)) for indices, _ in groups])
+        bounds = [_levenshtein_lower_bounds(table, ids1, ids) for _, ids in groups]
+        length_bounds = np.concatenate([length for length, _ in bounds])
+        mora_bounds = np.concatenate([mora for _, mora in bounds])
+        lower_bounds = np.maximum(length_bounds, mora_bounds)
+        order = np.argsort(lower_bounds, kind="stable")
+
+        start = 0
+        chunk_size = max(4 * (collector.n or 0), 256)
+        while start < len(order):
+            chunk = order[start : start + chunk_size]
+            cutoff = collector.cutoff
+            if cutoff is not None:
+                limit = cutoff + _BOUND_RTOL * max(1.0, abs(cutoff))
+                hopeless = np.flatnonzero(lower_bounds[chunk] > limit)
+                if len(hopeless):
+                    # The bounds are sorted, so every later word is hopeless.
+                    pruned = order[start + hopeless[0] :]
+                    by_length = int(np.count_nonzero(length_bounds[pruned] > limit))
+                    stats["length_bound"] += by_length
+                    stats["mora_bound"] += len(pruned) - by_length
+                    chunk = chunk[: hopeless[0]]
+                    start = len(order)
+            for g in np.unique(group_numbers[chunk]).tolist():
+                selected = chunk[group_numbers[chunk] == g]
+                indices, ids_matrix = groups[g]
+                in_group = positions[selected]
+                distances = _levenshtein_group(
+                    table, ids1, ids_matrix[:, in_group], collector.cutoff
+                )
+                stats["evaluated"] += len(selected)
+                stats["abandoned"] += int(np.count_nonzero(np.isinf(distances)))
+                stats["dp_cells"] += len(ids1) * len(ids_matrix) * len(selected)
+                collector.push(indices[in_group], distances)
+            start += chunk_size
+            chunk_size *= 2
+
+    def _align(self, word1: list[str], word2: list[str]) -> list[dict]:
+        """Aligns two preprocessed words with Hirschberg's algorithm."""
+        table = self.distance_table
+        if table is not None:
+            ids1 = table.encode(word1)
+            ids2 = table.encode(word2)
+            rows = table.rows
+            sp_id = table.sp_id
+
+            def replace_costs(i: int, columns: range) -> list[float]:
+                replace_row = rows[ids1[i]]
+                return [replace_row[ids2[j]] for j in columns]
+
+            delete_costs = [rows[c][sp_id] for c in ids1]
+            insert_costs = [rows[sp_id][c] for c in ids2]
+        else:
+            replace_cost_func = self.replace_cost_func
+
+            def replace_costs(i: int, columns: range) -> list[float]:
+                if not replace_cost_func:
+                    return [self.replace_cost] * len(columns)
+                return [replace_cost_func(word1[i], word2[j]) for j in columns]
+
+            delete_costs = [
+                self.delete_cost_func(c) if self.delete_cost_func else self.delete_cost
+                for c in word1
+            ]
+            insert_costs = [
+                self.insert_cost_func(c) if self.insert_cost_func else self.insert_cost
+                for c in word2
+            ]
+        path: list[tuple[int | None, int | None]] = []
+        _hirschberg(
+            replace_costs,
+            delete_costs,
+            insert_costs,
+            range(len(word1)),
+            range(len(word2)),
+            path,
+        )
+        return self._alignment_steps(word1, word2, path)
+
+    def _alignment_steps(
+        self,
+        word1: list[str],
+        word2: list[str],
+        path: list[tuple[int | None, int | None]],
+    ) -> list[dict]:
+        """Describes the steps of an alignment of two preprocessed words, as returned by align."""
+        table = self.distance_table
+        steps = []
+        for i, j in path:
+            mora1 = None if i is None else word1[i]
+            mora2 = None if j is None else word2[j]
+            if mora1 is None:
+                operation = "insert"
+            elif mora2 is None:
+                operation = "delete"
+            else:
+                operation = "match" if mora1 == mora2 else "replace"
+            vowel_cost = None
+            if table is not None:
+                id1 = table.sp_id if mora1 is None else table.kana2id[mora1]
+                id2 = table.sp_id if mora2 is None else table.kana2id[mora2]
+                cost = table.rows[id1][id2]
+                if table.vowel_matrix is not None:
+                    vowel_cost = float(table.vowel_matrix[id1, id2])
+            elif mora1 is None:
+                assert mora2 is not None
+                cost = (
+                    self.insert_cost_func(mora2)
+                    if self.insert_cost_func
+                    else self.insert_cost
+                )
+            elif mora2 is None:
+                cost = (
+                    self.delete_cost_func(mora1)
+                    if self.delete_cost_func
+                    else self.delete_cost
+                )
+            else:
+                cost = (
+                    self.replace_cost_func(mora1, mora2)
+                    if self.replace_cost_func
+                    else self.replace_cost
+                )
+            steps.append(
+                {
+                    "operation": operation,
+                    "mora1": mora1,
+                    "mora2": mora2,
+                    "cost": cost,
+                    "consonant_cost": None if vowel_cost is None else cost - vowel_cost,
+                    "vowel_cost": vowel_cost,
+                }
+            )
+        return steps
+
+    @staticmethod
+    def _batch_cells(lengths1: Iterable[int], counts2: dict[int, int]) -> int:
+        """Returns the number of DP cells of a batch, given the lengths of words1 and the number of words2 of each length."""
+        return sum(lengths1) * sum(length * count for length, count in counts2.items())
+
+    def _calculate(
+        self, word1: list[str], word2: list[str], max_distance: float | None = None
+    ) -> float:
+        """
+        Calculates the weighted Levenshtein distance between two lists of strings
+        with an iterative dynamic programming algorithm.
+
+        If a distance table is set, the words are encoded into mora IDs and
+        the table-based kernel is used instead of the cost functions.
+
+        Args:
+            word1 (str): The first word.
+            word2 (str): The second word.
+            max_distance (Optional[float]): Return inf as soon as the distance certainly exceeds this value.
+
+        Returns:
+            float: The calculated weighted Levenshtein distance.
+        """
+        if self.distance_table is not None:
+            return self._calculate_encoded(
+                self.distance_table.encode(word1),
+                self.distance_table.encode(word2),
+                max_distance,
+            )
+
+        # Check for memoized result
+        memo_key = None
+        if self.memo is not None:
+            memo_key = self.memo.make_key(word1, word2)
+            memo_value = self.memo.get(memo_key)
+            if memo_value is not None:
+                return _within(memo_value, max_distance)
+
+        m, n = len(word1), len(word2)
+        if self.stats is not None:
+            self.stats._scalar_cells += m * n
+        insert_costs = [
+            self.insert_cost_func(c) if self.insert_cost_func else self.insert_cost
+            for c in word2
+        ]
+        delete_costs = [
+            self.delete_cost_func(c) if self.delete_cost_func else self.delete_cost
+            for c in word1
+        ]
+
+        # prev[j] holds the distance between word1[:i-1] and word2[:j]
+        prev = [0.0] * (n + 1)
+        for j in range(1, n + 1):
+            prev[j] = prev[j - 1] + insert_costs[j - 1]
+
+        replace_cost_func = self.replace_cost_func
+        for i in range(1, m + 1):
+            c1 = word1[i - 1]
+            delete_cost = delete_costs[i - 1]
+            curr = [prev[0] + delete_cost] + [0.0] * n
+            for j in range(1, n + 1):
+                replace_cost = (
+                    replace_cost_func(c1, word2[j - 1])
+                    if replace_cost_func
+                    else self.replace_cost
+                )
+                curr[j] = min(
+                    prev[j - 1] + replace_cost,
+                    prev[j] + delete_cost,
+                    curr[j - 1] + insert_costs[j - 1],
+                )
+            if max_distance is not None and min(curr) > max_distance:
+                return float("inf")
+            prev = curr
+        cost = prev[n]
+
+        # Memoize the result
+        if self.memo is not None:
+            self.memo.set(memo_key, cost)
+        return _within(cost, max_distance)
+
+    def _calculate_encoded(
+        self, ids1: list[int], ids2: list[int], max_distance: float | None = None
+    ) -> float:
+        """
+        Calculates the weighted Levenshtein distance between two encoded words
+        by indexing the distance table directly.
+
+        Args:
+            ids1 (list[int]): The mora IDs of the first word.
+            ids2 (list[int]): The mora IDs of the second word.
+            max_distance (Optional[float]): If given, use the banded DP and return inf for distances above it.
+
+        Returns:
+            float: The calculated weighted Levenshtein distance.
+        """
+        assert self.distance_table is not None
+        memo_key = None
+        if self.memo is not None:
+            memo_key = self.memo.make_encoded_key(ids1, ids2)
+            memo_value = self.memo.get(memo_key)
+            if memo_value is not None:
+                return _within(memo_value, max_distance)
+
+        if max_distance is None:
+            cells = len(ids1) * len(ids2)
+            cost = _levenshtein_encoded(self.distance_table, ids1, ids2)
+        else:
+            cost, cells = _levenshtein_bounded(
+                self.distance_table, ids1, ids2, max_distance
+            )
+        if self.stats is not None:
+            self.stats._scalar_cells += cells
+
+        # Only exact distances are memoized.
+        if self.memo is not None and cost != float("inf"):
+            self.memo.set(memo_key, cost)
+        return cost
+
+
+# Function to split Katakana into moras. However, it deviates from the original definition of moras by considering long vowels as one mora.
+
+
+_HIRAGANA_TO_KATAKANA = {code: code + 0x60 for code in range(0x3041, 0x3098)}
+_MORA_CACHE_SIZE = 1 << 16
+
+
+@cache
+def _mora_tables() -> tuple[re.Pattern, dict[str, str]]:
+    """
+    Returns jamorasep's segmentation rules as tables: a pattern matching a
+    mora followed by the long vowel marks that extend it, and the full-size
+    form of each small kana.
+
+    Every two-letter mora is a kana followed by a small kana; any other small
+    kana stands for its full-size form. Grouping the two-letter moras by their
+    first kana makes the pattern much faster than listing them.
+    """
+    import jamorasep
+
+    morasep = jamorasep.Morasep()
+    small_kanas_after: dict[str, str] = {}
+    # Morasep's own attribute for these was renamed after jamorasep 0.0.1.
+    for mora in morasep.kanamap.get_2letter_morae():
+        small_kanas_after[mora[0]] = small_kanas_after.get(mora[0], "") + mora[1]
+    alternatives = [
+        f"{re.escape(kana)}[{re.escape(small_kanas)}]"
+        for kana, small_kanas in small_kanas_after.items()
+    ]
+    pattern = re.compile("(?:" + "|".join([*alternatives, "."]) + ")ー*", re.DOTALL)
+    return pattern, dict(morasep.upper)
+
+
+def _split_extended_moras(text: str) -> list[str]:
+    # Whitespace (e.g. word separators in song lyrics) carries no phonetic
+    # information, and moras containing it are not in the distance table.
+    text = "".join(text.split())
+    pattern, small_kana_upper = _mora_tables()
+    # Hiragana is matched by its katakana form but kept as is, like
+    # jamorasep.parse(..., output_format="katakana") does.
+    katakana = text.translate(_HIRAGANA_TO_KATAKANA)
+    if katakana == text:
+        moras = pattern.findall(text)
+    else:
+        moras = [
+            text[match.start() : match.end()] for match in pattern.finditer(katakana)
+        ]
+    return [
+        small_kana_upper[mora[0]] + mora[1:] if mora[0] in small_kana_upper else mora
+        for mora in moras
+    ]
+
+
+@lru_cache(maxsize=_MORA_CACHE_SIZE)
+def _split_extended_moras_cached(text: str) -> tuple[str, ...]:
+    return tuple(_split_extended_moras(text))
+
+
+def extend_long_vowel_moras(text: str) -> list[str]:
+    """
+    Splits a kana string into moras and merges each long vowel mark "ー" into
+    the preceding mora.
+
+    The moras are the same as those of jamorasep.parse with
+    output_format="katakana". Whitespace is removed first. The results of
+    recent strings are cached, since the same query words are usually
+    preprocessed many times.
+
+    Args:
+        text (str): The kana string.
+
+    Returns:
+        list[str]: The moras.
+    """
+    return list(_split_extended_moras_cached(text))
+
+
+def extend_long_vowel_moras_batch(texts: Iterable[str]) -> list[list[str]]:
+    """
+    Applies extend_long_vowel_moras to many strings at once.
+
+    Each distinct string is split once. The strings do not go through the
+    cache of extend_long_vowel_moras, so a large lexicon does not evict the
+    query words.
+
+    Args:
+        texts (Iterable[str]): The kana strings.
+
+    Returns:
+        list[list[str]]: The moras of each string.
+    """
+    splits: dict[str, list[str]] = {}
+    results = []
+    for text in texts:
+        moras = splits.get(text)
+        if moras is None:
+            moras = splits[text] = _split_extended_moras(text)
+        # a copy, so that callers may modify the lists of duplicates
+        results.append(list(moras))
+    return results
+
+
+def _preprocess_words(
+    preprocess_func: Callable[[str], list[str]], words: Iterable[str]
+) -> list[list[str]]:
+    if preprocess_func is extend_long_vowel_moras:
+        return extend_long_vowel_moras_batch(words)
+    return [preprocess_func(word) for word in words]
+
+
+# Class to calculate weighted Hamming distance
+class WeightedHamming:
+    """
+    A class to calculate the weighted Hamming distance between two strings.
+    The distance is calculated based on the costs of replacement operations.
+    Custom cost functions and preprocessing functions can be provided to modify the behavior of the distance calculation.
+
+    Attributes:
+        replace_cost (float): The default cost of a replacement operation.
+        replace_cost_func (Optional[Callable[[str, str], float]]): A custom function to calculate the cost of a replacement operation.
+        preprocess_func (Optional[Callable[[str], List[str]]]): A custom function to preprocess the input strings before calculating the distance.
+        distance_table (Optional[KanaDistanceTable]): A dense distance table. If given, words are encoded into mora IDs and the costs are read from the table instead of calling the cost function.
+        memo (Optional[MemoCache]): A bounded cache of distance calculation results, or None if memoization is disabled.
+        pruning_stats (Dict[str, int]): Counts of the last get_topn or get_within call: candidates, pruned by the length bound, pruned by the mora bound, abandoned during the DP, evaluated, and the DP cells evaluated.
+        stats (Optional[CalculatorStats]): Counters of the time and work of every call, or None if stats are disabled.
+    """
+
+    def __init__(
+        self,
+        replace_cost: float = 1.0,
+        replace_cost_func: Callable[[str, str], float] | None = None,
+        preprocess_func: Callable[[str], list[str]] = _jamorasep_parse,
+        distance_table: KanaDistanceTable | None = None,
+        memo: MemoCache | bool = False,
+        stats: CalculatorStats | bool = False,
+    ):
+        """
+        Initializes the WeightedHamming class with the given costs and custom functions.
+
+        Args:
+            replace_cost (float): The default cost of a replacement operation.
+            replace_cost_func (Optional[Callable[[str, str], float]]): A custom function to calculate the cost of a replacement operation.
+            preprocess_func (Optional[Callable[[str], List[str]]]): A custom function to preprocess the input strings before calculating the distance.
+            distance_table (Optional[KanaDistanceTable]): A dense distance table that takes precedence over the cost function.
+            memo (MemoCache | bool): The cache of distance calculation results. True creates a MemoCache with the default budget. Disabled by default, since a Hamming distance is cheaper to compute than to look up.
+            stats (CalculatorStats | bool): The counters to update on every call. True creates a CalculatorStats. Disabled by default; when disabled, calls are not measured.
+        """
+        self.replace_cost = replace_cost
+        self.replace_cost_func = replace_cost_func
+        self.preprocess_func = preprocess_func
+        self.distance_table = distance_table
+        self.memo = _resolve_memo(memo)
+        self.stats = _resolve_stats(stats)
+        self.pruning_stats: dict[str, int] = {}
+
+    def calculate(
+        self, word1: str, word2: str, max_distance: float | None = None
+    ) -> float:
+        """
+        Calculates the weighted Hamming distance between two words.
+
+        Args:
+            word1 (str): The first word.
+            word2 (str): The second word.
+            max_distance (Optional[float]): If given, distances above it are returned as inf.
+
+        Returns:
+            float: The distance, or inf if the lengths differ.
+        """
+        call = None if self.stats is None else self.stats._start(self.memo)
+        if self.preprocess_func:
+            processed_word1 = self.preprocess_func(word1)
+            processed_word2 = self.preprocess_func(word2)
+        if call is None:
+            return _within(
+                self._calculate(processed_word1, processed_word2), max_distance
+            )
+        call.preprocessed()
+        distance = _within(
+            self._calculate(processed_word1, processed_word2), max_distance
+        )
+        call.end("calculate")
+        return distance
 
     def calculate_batch(
-        self, words1: list[str], words2: list[str]
-    ) -> list[list[float]]:
+        self,
+        words1: "list[str] | WordIndex",
+        words2: "list[str] | WordIndex",
+        *,
+        as_array: bool = False,
+        out: np.ndarray | None = None,
+        n_jobs: int | None = None,
+        max_distance: float | None = None,
+    ) -> list[list[float]] | np.ndarray:
+        """
+        Calculates the distances between every pair of words1 and words2.
+
+        Args:
+            words1 (list[str] | WordIndex): The first words.
+            words2 (list[str] | WordIndex): The second words.
+            as_array (bool): If True, return a float64 array instead of nested lists.
+            out (Optional[np.ndarray]): An array of shape (len(words1), len(words2)) to write the results to. Implies as_array.
+            n_jobs (Optional[int]): The number of worker processes. Requires a distance table; the rows are split among the workers, which share the table and the encoded words through shared memory. -1 uses all CPUs. Defaults to a single process.
+            max_distance (Optional[float]): If given, distances above it are returned as inf. With a distance table, words are abandoned as soon as their partial sum exceeds it.
+
+        Returns:
+            list[list[float]] | np.ndarray: The distances, where [i][j] is the distance between words1[i] and words2[j].
+        """
+        n_jobs = _resolve_n_jobs(n_jobs)
+        call = None if self.stats is None else self.stats._start(self.memo)
+        if n_jobs > 1:
+            results = _parallel_batch(
+                self, words1, words2, n_jobs, out, call, max_distance
+            )
+            if call is not None:
+                call.end("calculate_batch")
+            return results if as_array or out is not None else results.tolist()
+        if self.distance_table is not None:
+            table = self.distance_table
+            # Encode each word once instead of once per pair, and score the
+            # words2 of the same length as each word1 at once.
+            encoded_words1 = _encode_words(table, self.preprocess_func, words1)
+            groups = _encode_groups(table, self.preprocess_func, words2)
+            if call is not None:
+                call.preprocessed()
+            results = _prepare_batch_output(out, (len(words1), len(words2)))
+            results[...] = np.inf
+            for i, ids1 in enumerate(encoded_words1):
+                if len(ids1) in groups:
+                    indices, ids_matrix = groups[len(ids1)]
+                    results[i, indices] = _hamming_group(
+                        table, ids1, ids_matrix, max_distance
+                    )
+            if max_distance is not None:
+                # empty words are never compared with the cutoff
+                results[results > max_distance] = np.inf
+            if call is not None:
+                call.count_cells(
+                    self._batch_cells(
+                        map(len, encoded_words1),
+                        {length: len(group[0]) for length, group in groups.items()},
+                    )
+                )
+                call.end("calculate_batch")
+            return results if as_array or out is not None else results.tolist()
         if self.preprocess_func:
             processed_words1 = [self.preprocess_func(word1) for word1 in words1]
             processed_words2 = [self.preprocess_func(word2) for word2 in words2]
+        if call is not None:
+            call.preprocessed()
         results = []
         for word1 in processed_words1:
             result = []
             for word2 in processed_words2:
-                result.append(self._calculate(word1, word2))
+                result.append(_within(self._calculate(word1, word2), max_distance))
             results.append(result)
+        if as_array or out is not None:
+            array = _prepare_batch_output(out, (len(words1), len(words2)))
+            array[...] = np.array(results, dtype=np.float64).reshape(array.shape)
+            results = array
+        if call is not None:
+            call.end("calculate_batch")
         return results
 
+    def calculate_matrix(
+        self,
+        words: "list[str] | WordIndex",
+        path: str,
+        *,
+        dtype: "str | np.dtype" = "float64",
+        tile_size: int = _MATRIX_TILE_SIZE,
+        symmetric: bool | None = None,
+        progress: Callable[[int, int], None] | None = None,
+    ) -> np.ndarray:
+        """
+        Calculates the distances between all pairs of words into a memory-mapped .npy file.
+
+        The matrix is computed in tiles of tile_size × tile_size words with
+        calculate_batch, so only one tile is held in memory. After every tile
+        the file is flushed and the progress is saved to path + ".progress";
+        if the call is interrupted, calling it again with the same words and
+        parameters resumes after the last completed tile.
+
+        Args:
+            words (list[str] | WordIndex): The words.
+            path (str): The path of the .npy file to write.
+            dtype (str | np.dtype): The dtype of the matrix, "float64" or "float32".
+            tile_size (int): The number of rows and columns of a tile.
+            symmetric (Optional[bool]): Whether the distances are symmetric, so that only the tiles on and above the diagonal are computed and mirrored. Defaults to whether the distance table is symmetric.
+            progress (Optional[Callable[[int, int], None]]): Called with the number of completed tiles and the total number of tiles at the start and after every tile.
+
+        Returns:
+            np.ndarray: The matrix, memory-mapped read-only from path, where [i, j] is the distance between words[i] and words[j].
+        """
+        return _calculate_matrix(
+            self, words, path, dtype, tile_size, symmetric, progress
+        )
+
     def get_topn(
-        self, word: str, wordlist: list[str], n: int = 10
+        self,
+        word: str,
+        wordlist: "list[str] | WordIndex",
+        n: int = 10,
+        n_jobs: int | None = None,
     ) -> list[tuple[str, float]]:
         """
         Get the top n similar words from the given list based on weighted Hamming distance.
 
         Args:
             word (str): The word to compare with.
-            wordlist (list[str]): The list of words to compare.
+            wordlist (list[str] | WordIndex): The list of words to compare.
+            n (int): The number of similar words to get.
+            n_jobs (Optional[int]): The number of worker processes, each searching a contiguous part of wordlist. Requires a distance table. -1 uses all CPUs. Defaults to a single process.
+
+        Returns:
+            List[Tuple[str, float]]: The top n similar words and their distances.
+        """
+        n_jobs = _resolve_n_jobs(n_jobs)
+        if n_jobs == 1 and (self.distance_table is None or n <= 0):
+            distances = self.calculate_batch([word], wordlist)[0]
+            return sorted(zip(wordlist, distances), key=lambda x: x[1])[:n]
+        if n <= 0:
+            return []
+        call = None if self.stats is None else self.stats._start(self.memo)
+        topn = _TopN(n)
+        if n_jobs > 1:
+            _parallel_search(self, word, wordlist, topn, n_jobs, {}, call)
+        else:
+            self._search(word, wordlist, topn, call)
+        results = topn.results(wordlist)
+        if call is not None:
+            call.searched(self.pruning_stats)
+            call.end("get_topn")
+        return results
+
+    def get_within(
+        self,
+        word: str,
+        wordlist: "list[str] | WordIndex",
+        max_distance: float,
+        n_jobs: int | None = None,
+    ) -> list[tuple[str, float]]:
+        """
+        Get the words within the given weighted Hamming distance from the given list.
+
+        Args:
+            word (str): The word to compare with.
+            wordlist (list[str] | WordIndex): The list of words to compare.
+            max_distance (float): The largest distance to include.
+            n_jobs (Optional[int]): The number of worker processes, as in get_topn.
+
+        Returns:
+            List[Tuple[str, float]]: The words within max_distance and their distances, sorted by distance.
+        """
+        n_jobs = _resolve_n_jobs(n_jobs)
+        if n_jobs == 1 and self.distance_table is None:
+            distances = self.calculate_batch([word], wordlist)[0]
+            within = [(w, d) for w, d in zip(wordlist, distances) if d <= max_distance]
+            return sorted(within, key=lambda x: x[1])
+        call = None if self.stats is None else self.stats._start(self.memo)
+        within = _TopN(max_distance=max_distance)
+        if n_jobs > 1:
+            _parallel_search(self, word, wordlist, within, n_jobs, {}, call)
+        else:
+            self._search(word, wordlist, within, call)
+        results = within.results(wordlist)
+        if call is not None:
+            call.searched(self.pruning_stats)
+            call.end("get_within")
+        return results
+
+    def iter_distances(
+        self,
+        word: str,
+        words: "Iterable[str] | str | os.PathLike[str]",
+        chunk_size: int = _STREAM_CHUNK_SIZE,
+    ) -> Iterator[list[tuple[str, float]]]:
+        """
+        Calculates the distances from word to a stream of words, one chunk at a time.
+
+        Only one chunk of words is held in memory, so the stream may be larger
+        than the memory.
+
+        Args:
+            word (str): The word to compare with.
+            words (Iterable[str] | str | os.PathLike): The words, or the path of a UTF-8 file with one word per line.
+            chunk_size (int): The number of words per chunk.
+
+        Returns:
+            Iterator[list[tuple[str, float]]]: The words of each chunk and their distances, in stream order.
+        """
+        return _stream_distances(self, word, words, chunk_size)
+
+    def get_topn_stream(
+        self,
+        word: str,
+        words: "Iterable[str] | str | os.PathLike[str]",
+        n: int = 10,
+        chunk_size: int = _STREAM_CHUNK_SIZE,
+    ) -> list[tuple[str, float]]:
+        """
+        Get the top n similar words from a stream of words based on weighted Hamming distance.
+
+        Only one chunk of words and the running top n are held in memory. The
+        results are the same as those of get_topn on the whole list.
+
+        Args:
+            word (str): The word to compare with.
+            words (Iterable[str] | str | os.PathLike): The words, or the path of a UTF-8 file with one word per line.
+            n (int): The number of similar words to get.
+            chunk_size (int): The number of words searched at once.
+
+        Returns:
+            List[Tuple[str, float]]: The top n similar words and their distances.
+        """
+        if n <= 0:
+            return []
+        # Without a table, the chunks are measured as calculate_batch calls.
+        call = None
+        if self.stats is not None and self.distance_table is not None:
+            call = self.stats._start(self.memo)
+        results = _stream_topn(self, word, words, n, chunk_size, self._search, call)
+        if call is not None:
+            call.end("get_topn_stream")
+        return results
+
+    def _search(
+        self,
+        word: str,
+        wordlist: "list[str] | WordIndex",
+        collector: _TopN,
+        call: "_StatsCall | None" = None,
+    ):
+        """
+        Feeds the distances from word to the words of wordlist that may be
+        kept by the collector. Only words of the same length are evaluated;
+        the others count as pruned by the length bound. call, if given, is
+        marked once the words are encoded.
+        """
+        assert self.distance_table is not None
+        table = self.distance_table
+        ids1 = table.encode(self.preprocess_func(word))
+        groups = _encode_groups(table, self.preprocess_func, wordlist)
+        if call is not None:
+            call.preprocessed()
+        stats = _new_pruning_stats(len(wordlist))
+        self.pruning_stats = stats
+        if len(ids1) in groups:
+            indices, ids_matrix = groups.pop(len(ids1))
+            distances = _hamming_group(table, ids1, ids_matrix, collector.cutoff)
+            stats["evaluated"] += len(indices)
+            stats["abandoned"] += int(np.count_nonzero(np.isinf(distances)))
+            stats["dp_cells"] += len(ids1) * len(indices)
+            collector.push(indices, distances)
+        cutoff = collector.cutoff
+        if cutoff is None or cutoff == float("inf"):
+            # Words of other lengths are at distance inf and only fill the
+            # remaining places, in list order.
+            for indices, _ in groups.values():
+                collector.push(indices, np.full(len(indices), np.inf))
+        stats["length_bound"] += sum(len(indices) for indices, _ in groups.values())
+
+    @staticmethod
+    def _batch_cells(lengths1: Iterable[int], counts2: dict[int, int]) -> int:
+        """Returns the number of DP cells of a batch, given the lengths of words1 and the number of words2 of each length."""
+        return sum(length * counts2.get(length, 0) for length in lengths1)
+
+    def _calculate(self, word1: list[str], word2: list[str]) -> float:
+        """
+        Calculates the weighted Hamming distance between two strings.
+
+        Args:
+            word1 (str): The first word.
+            word2 (str): The second word.
+
+        Returns:
+            float: The calculated weighted Hamming distance.
+        """
+        if len(word1) != len(word2):
+            return float("inf")
+        if self.distance_table is not None:
+            if self.memo is None:
+                if self.stats is not None:
+                    self.stats._scalar_cells += len(word1)
+                return _hamming_moras(self.distance_table, word1, word2)
+            return self._calculate_encoded(
+                self.distance_table.encode(word1), self.distance_table.encode(word2)
+            )
+        return self._calculate_helper(word1, word2, len(word1))
+
+    def _calculate_encoded(self, ids1: list[int], ids2: list[int]) -> float:
+        """
+        Calculates the weighted Hamming distance between two encoded words
+        by indexing the distance table directly.
+
+        Args:
+            ids1 (list[int]): The mora IDs of the first word.
+            ids2 (list[int]): The mora IDs of the second word.
+
+        Returns:
+            float: The calculated weighted Hamming distance.
+        """
+        assert self.distance_table is not None
+        memo_key = None
+        if self.memo is not None:
+            memo_key = self.memo.make_encoded_key(ids1, ids2)
+            memo_value = self.memo.get(memo_key)
+            if memo_value is not None:
+                return memo_value
+
+        if self.stats is not None:
+            self.stats._scalar_cells += len(ids1)
+        cost = _hamming_encoded(self.distance_table, ids1, ids2)
+
+        if self.memo is not None:
+            self.memo.set(memo_key, cost)
+        return cost
+
+    def _calculate_helper(
+        self, word1: list[str], word2: list[str], length: int
+    ) -> float:
+        """
+        A helper function to calculate the weighted Hamming distance between two strings.
+
+        Args:
+            word1 (str): The first word.
+            word2 (str): The second word.
+            length (int): The length of the words.
+
+        Returns:
+            float: The calculated weighted Hamming distance.
+        """
+        # Check for memoized result
+        memo_key = None
+        if self.memo is not None:
+            memo_key = self.memo.make_key(word1, word2)
+            memo_value = self.memo.get(memo_key)
+            if memo_value is not None:
+                return memo_value
+
+        if self.stats is not None:
+            self.stats._scalar_cells += length
+        cost = 0.0
+        for i in range(length):
+            if self.replace_cost_func:
+                cost += self.replace_cost_func(word1[i], word2[i])
+            else:
+                if word1[i] != word2[i]:
+                    cost += self.replace_cost
+
+        # Memoize the result
+        if self.memo is not None:
+            self.memo.set(memo_key, cost)
+        return cost
+
+
+def _resolve_n_jobs(n_jobs: int | None) -> int:
+    """Returns the number of worker processes; negative values count back from the number of CPUs."""
+    if n_jobs is None:
+        return 1
+    if n_jobs == 0:
+        raise ValueError("n_jobs must not be 0")
+    if n_jobs < 0:
+        return max(1, (os.cpu_count() or 1) + 1 + n_jobs)
+    return n_jobs
+
+
+def _as_word_index(
+    table: KanaDistanceTable,
+    preprocess_func: Callable[[str], list[str]],
+    words: "Sequence[str] | WordIndex",
+) -> "WordIndex":
+    if isinstance(words, WordIndex):
+        words._check_table(table)
+        return words
+    return WordIndex.build(words, table, preprocess_func)
+
+
+class _SharedArrays:
+    """
+    Arrays copied once into shared memory blocks, so that the processes of a
+    pool map them instead of receiving pickled copies with every task.
+
+    specs describes the blocks for _init_worker. Use as a context
+    manager; the blocks are freed on exit.
+    """
+
+    def __init__(self):
+        self.specs: dict[str, tuple[str, tuple[int, ...], str]] = {}
+        self._blocks: list[shared_memory.SharedMemory] = []
+
+    def add(self, name: str, array: np.ndarray):
+        from multiprocessing import shared_memory
+
+        array = np.ascontiguousarray(array)
+        block = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+        self._blocks.append(block)
+        np.ndarray(array.shape, array.dtype, buffer=block.buf)[...] = array
+        self.specs[name] = (block.name, array.shape, array.dtype.str)
+
+    def __enter__(self) -> Self:
+        return self
+
+    def __exit__(self, *exc_info):
+        for block in self._blocks:
+            block.close()
+            block.unlink()
+        self._blocks.clear()
+
+
+# The arrays and objects a pool worker attached to in _init_worker.
+_worker_state: dict = {}
+
+
+def _init_worker(
+    calculator_class: type,
+    kanas: list[str],
+    specs: dict[str, tuple[str, tuple[int, ...], str]],
+):
+    from multiprocessing import shared_memory
+
+    blocks = []
+    arrays = {}
+    for name, (block_name, shape, dtype) in specs.items():
+        block = shared_memory.SharedMemory(name=block_name)
+        blocks.append(block)
+        arrays[name] = np.ndarray(shape, dtype, buffer=block.buf)
+    table = KanaDistanceTable(kanas, arrays["matrix"])
+
+    def index(prefix: str) -> WordIndex | None:
+        if prefix + "offsets" not in arrays:
+            return None
+        offsets = arrays[prefix + "offsets"]
+        # The surface strings stay in the parent; results refer to positions.
+        return WordIndex(
+            kanas,
+            offsets,
+            arrays[prefix + "ids"],
+            np.zeros(len(offsets), dtype=np.int64),
+            np.empty(0, dtype=np.uint8),
+        )
+
+    words2 = index("words2_")
+    _worker_state.update(
+        # keeps the mappings open for the lifetime of the worker
+        blocks=blocks,
+        # The parent sends preprocessed words, so they are only listed.
+        calculator=calculator_class(
+            preprocess_func=list, distance_table=table, memo=False
+        ),
+        words1=index("words1_") or words2,
+        words2=words2,
+    )
+
+
+def _batch_worker(
+    task: tuple[int, int, float | None],
+) -> tuple[int, np.ndarray]:
+    start, stop, max_distance = task
+    calculator = _worker_state["calculator"]
+    words1 = _worker_state["words1"]._slice(start, stop)
+    return start, calculator.calculate_batch(
+        words1, _worker_state["words2"], as_array=True, max_distance=max_distance
+    )
+
+
+def _search_worker(
+    task: tuple[int, int, list[str], int | None, float | None, dict],
+) -> tuple[np.ndarray, np.ndarray, dict[str, int]]:
+    start, stop, moras, n, max_distance, search_kwargs = task
+    calculator = _worker_state["calculator"]
+    collector = _TopN(n, max_distance)
+    calculator._search(
+        moras, _worker_state["words2"]._slice(start, stop), collector, **search_kwargs
+    )
+    items = collector.items()
+    indices = np.array([index for _, index in items], dtype=np.intp) + start
+    distances = np.array([distance for distance, _ in items], dtype=np.float64)
+    return indices, distances, calculator.pruning_stats
+
+
+def _process_pool(
+    calculator: "WeightedLevenshtein | WeightedHamming",
+    shared: _SharedArrays,
+    n_jobs: int,
+) -> "ProcessPoolExecutor":
+    from concurrent.futures import ProcessPoolExecutor
+
+    assert calculator.distance_table is not None
+    return ProcessPoolExecutor(
+        max_workers=n_jobs,
+        initializer=_init_worker,
+        initargs=(type(calculator), calculator.distance_table.kanas, shared.specs),
+    )
+
+
+# Upper bound of the distances returned by one task of _parallel_batch, so
+# that the results in flight stay small for large word lists.
+_PARALLEL_BATCH_CELLS = 1 << 22
+
+
+def _parallel_batch(
+    calculator: "WeightedLevenshtein | WeightedHamming",
+    words1: "list[str] | WordIndex",
+    words2: "list[str] | WordIndex",
+    n_jobs: int,
+    out: np.ndarray | None,
+    call: _StatsCall | None = None,
+    max_distance: float | None = None,
+) -> np.ndarray:
+    """
+    Runs calculate_batch of the calculator over blocks of rows in a process
+    pool.
+
+    The distance matrix and the encoded words are put into shared memory once;
+    each worker maps them and computes whole rows with the serial kernels, so
+    the results are identical to the serial ones and are written back in
+    order.
+    """
+    table = calculator.distance_table
+    if table is None:
+        raise ValueError("n_jobs requires a distance table")
+    index2 = _as_word_index(table, calculator.preprocess_func, words2)
+    index1 = index2
+    if words1 is not words2:
+        index1 = _as_word_index(table, calculator.preprocess_func, words1)
+    if call is not None:
+        call.preprocessed()
+        lengths2, counts2 = np.unique(index2.lengths, return_counts=True)
+        call.count_cells(
+            calculator._batch_cells(
+                index1.lengths.tolist(), dict(zip(lengths2.tolist(), counts2.tolist()))
+            )
+        )
+    results = _prepare_batch_output(out, (len(words1), len(words2)))
+    with _SharedArrays() as shared:
+        shared.add("matrix", table.matrix)
+        shared.add("words2_offsets", index2.offsets)
+        shared.add("words2_ids", index2.ids)
+        if index1 is not index2:
+            shared.add("words1_offsets", index1.offsets)
+            shared.add("words1_ids", index1.ids)
+        # several blocks per worker to balance the load
+        rows_per_task = max(
+            1,
+            min(
+                -(-len(words1) // (4 * n_jobs)),
+                _PARALLEL_BATCH_CELLS // max(1, len(words2)),
+            ),
+        )
+        tasks = [
+            (start, min(start + rows_per_task, len(words1)), max_distance)
+            for start in range(0, len(words1), rows_per_task)
+        ]
+        with _process_pool(calculator, shared, n_jobs) as pool:
+            for start, distances in pool.map(_batch_worker, tasks):
+                results[start : start + len(distances)] = distances
+    return results
+
+
+def _parallel_search(
+    calculator: "WeightedLevenshtein | WeightedHamming",
+    word: str,
+    wordlist: "list[str] | WordIndex",
+    collector: _TopN,
+    n_jobs: int,
+    search_kwargs: dict,
+    call: _StatsCall | None = None,
+):
+    """
+    Splits wordlist into one contiguous shard per worker, searches the shards
+    in a process pool and feeds the kept pairs of every shard to collector.
+
+    Every pair kept by the whole search is kept by the search of its shard,
+    and the collector orders pairs by distance and then by position, so the
+    results are identical to a serial search. The pruning statistics are
+    summed over the shards.
+    """
+    table = calculator.distance_table
+    if table is None:
+        raise ValueError("n_jobs requires a distance table")
+    moras = calculator.preprocess_func(word)
+    # Fail before starting the pool if the word cannot be encoded.
+    table.encode(moras)
+    index = _as_word_index(table, calculator.preprocess_func, wordlist)
+    if call is not None:
+        call.preprocessed()
+    bounds = np.linspace(0, len(index), n_jobs + 1).astype(int).tolist()
+    tasks = [
+        (start, stop, moras, collector.n, collector.max_distance, search_kwargs)
+        for start, stop in pairwise(bounds)
+        if start < stop
+    ]
+    stats = _new_pruning_stats(len(index))
+    calculator.pruning_stats = stats
+    with _SharedArrays() as shared:
+        shared.add("matrix", table.matrix)
+        shared.add("words2_offsets", index.offsets)
+        shared.add("words2_ids", index.ids)
+        with _process_pool(calculator, shared, n_jobs) as pool:
+            for indices, distances, shard_stats in pool.map(_search_worker, tasks):
+                collector.push(indices, distances)
+                for key in (
+                    "length_bound",
+                    "mora_bound",
+                    "abandoned",
+                    "evaluated",
+                    "dp_cells",
+                ):
+                    stats[key] += shard_stats[key]
+
+
+_METRIC_INDEX_MAGIC = b"KANAVPT1"
+
+
+def _levenshtein_to_words(
+    table: KanaDistanceTable,
+    ids1: list[int],
+    words: WordIndex,
+    indices: np.ndarray,
+    cutoff: float | None = None,
+) -> np.ndarray:
+    """
+    Calculates the weighted Levenshtein distances from one encoded word to
+    the words of an index at the given positions, grouped by length.
+    """
+    lengths = words.lengths[indices]
+    starts = words.offsets[indices]
+    distances = np.empty(len(indices), dtype=np.float64)
+    for length in np.unique(lengths).tolist():
+        selected = np.flatnonzero(lengths == length)
+        ids_matrix = words.ids[starts[selected] + np.arange(length)[:, None]]
+        distances[selected] = _levenshtein_group(table, ids1, ids_matrix, cutoff)
+    return distances
+
+
+class MetricIndex:
+    """
+    A vantage-point tree over a word list for searches with a symmetric
+    weighted Levenshtein calculator.
+
+    Each internal node holds a vantage word and the median of the distances
+    from it to the words below: the words within the median go to the inside
+    subtree and the others to the outside one. Leaves hold small buckets of
+    words that are evaluated at once. If the distance satisfies the triangle
+    inequality, the distance from the query to a vantage word bounds the
+    distance to every word of its subtrees, so that subtrees that cannot
+    improve the result are skipped and the results are identical to those of
+    the calculator.
+
+    The inequality is verified on the distance table when the index is built.
+    If it does not hold, the index can only be built in approximate mode: the
+    same pruning may then miss neighbors, and the recall of get_topn is
+    measured on sample queries from the word list.
+
+    Attributes:
+        calculator (WeightedLevenshtein): The calculator whose distances are searched.
+        words (WordIndex): The indexed words.
+        exact (bool): Whether the triangle inequality holds, so that the results are exact.
+        triangle_violation (float): The largest violation of the triangle inequality in the distance table.
+        recall (Optional[float]): In approximate mode, the mean recall of get_topn measured when the index was built.
+        pruning_stats (Dict[str, int]): Counts of the last search: candidates, pruned by the triangle inequality, abandoned during the DP, and evaluated.
+    """
+
+    def __init__(
+        self,
+        calculator: "WeightedLevenshtein",
+        words: WordIndex,
+        tree: dict[str, np.ndarray],
+        triangle_violation: float,
+        recall: float | None = None,
+    ):
+        """
+        Initializes the MetricIndex with an already built tree. Use build or load to create one.
+
+        Args:
+            calculator (WeightedLevenshtein): The calculator whose distances are searched.
+            words (WordIndex): The indexed words.
+            tree (dict[str, np.ndarray]): The arrays of the tree nodes.
+            triangle_violation (float): The largest violation of the triangle inequality in the distance table.
+            recall (Optional[float]): The measured recall in approximate mode.
+        """
+        self.calculator = calculator
+        self.table = _metric_distance_table(calculator)
+        words._check_table(self.table)
+        self.words = words
+        self.tree = tree
+        self.triangle_violation = triangle_violation
+        self.exact = triangle_violation <= _BOUND_RTOL * max(
+            1.0, float(self.table.matrix.max())
+        )
+        self.recall = recall
+        self.pruning_stats: dict[str, int] = {}
+
+    @classmethod
+    def build(
+        cls,
+        calculator: "WeightedLevenshtein",
+        wordlist: "list[str] | WordIndex",
+        leaf_size: int = 256,
+        approximate: bool = False,
+        recall_n: int = 10,
+        recall_queries: int = 50,
+        seed: int = 0,
+    ) -> "MetricIndex":
+        """
+        Builds the tree over the given words.
+
+        Args:
+            calculator (WeightedLevenshtein): A calculator created with symmetric=True.
+            wordlist (list[str] | WordIndex): The words to index.
+            leaf_size (int): The largest number of words in a leaf.
+            approximate (bool): Allow building the index when the triangle inequality does not hold.
+            recall_n (int): In approximate mode, the number of neighbors used to measure the recall.
+            recall_queries (int): In approximate mode, the number of words of the list used as queries to measure the recall.
+            seed (int): The seed of the choice of vantage words and recall queries.
+
+        Returns:
+            MetricIndex: The index.
+
+        Raises:
+            ValueError: If the calculator is not symmetric, or if the triangle inequality does not hold and approximate is False.
+        """
+        table = _metric_distance_table(calculator)
+        triangle_violation = table.triangle_violation()
+        if isinstance(wordlist, WordIndex):
+            words = wordlist
+        else:
+            words = WordIndex.build(wordlist, table, calculator.preprocess_func)
+        rng = np.random.default_rng(seed)
+        index = cls(
+            calculator,
+            words,
+            _build_vantage_point_tree(table, words, leaf_size, rng),
+            triangle_violation,
+        )
+        if not index.exact:
+            if not approximate:
+                raise ValueError(
+                    "The distance table violates the triangle inequality by "
+                    f"{triangle_violation}; pass approximate=True to build an "
+                    "approximate index"
+                )
+            queries = rng.choice(
+                len(words), size=min(recall_queries, len(words)), replace=False
+            )
+            index.recall = index.measure_recall(
+                [words[i] for i in queries.tolist()], recall_n
+            )
+        return index
+
+    def save(self, path: str):
+        """
+        Saves the words and the tree to a binary file that load can memory-map.
+
+        Args:
+            path (str): The path of the file.
+        """
+        words = self.words
+        _save_arrays(
+            path,
+            _METRIC_INDEX_MAGIC,
+            {
+                "kanas": words.kanas,
+                "table_digest": _matrix_digest(self.table.matrix),
+                "triangle_violation": self.triangle_violation,
+                "recall": self.recall,
+            },
+            {
+                "offsets": words.offsets.astype(np.int64, copy=False),
+                "text_offsets": words._text_offsets.astype(np.int64, copy=False),
+                "ids": words.ids.astype(np.uint16, copy=False),
+                "text": words._text,
+                **self.tree,
+            },
+        )
+
+    @classmethod
+    def load(
+        cls, path: str, calculator: "WeightedLevenshtein", mmap: bool = False
+    ) -> "MetricIndex":
+        """
+        Loads an index saved with save.
+
+        Args:
+            path (str): The path of the file.
+            calculator (WeightedLevenshtein): A calculator with the same distance table as the one used to build the index.
+            mmap (bool): If True, memory-map the arrays instead of reading them.
+
+        Returns:
+            MetricIndex: The index.
+
+        Raises:
+            ValueError: If the file is not a metric index, or if it was built with another distance table.
+        """
+        header, arrays = _load_arrays(path, _METRIC_INDEX_MAGIC, mmap)
+        table = _metric_distance_table(calculator)
+        if header["table_digest"] != _matrix_digest(table.matrix):
+            raise ValueError(
+                "The metric index was built with a different kana distance table"
+            )
+        words = WordIndex(
+            header["kanas"],
+            arrays.pop("offsets"),
+            arrays.pop("ids"),
+            arrays.pop("text_offsets"),
+            arrays.pop("text"),
+        )
+        return cls(
+            calculator, words, arrays, header["triangle_violation"], header["recall"]
+        )
+
+    def get_topn(self, word: str, n: int = 10) -> list[tuple[str, float]]:
+        """
+        Get the top n similar words of the index.
+
+        Args:
+            word (str): The word to compare with.
             n (int): The number of similar words to get.
 
         Returns:
             List[Tuple[str, float]]: The top n similar words and their distances.
         """
-        distances = self.calculate_batch([word], wordlist)[0]
-        return sorted(zip(wordlist, distances), key=lambda x: x[1])[:n]
+        if n <= 0:
+            return []
+        topn = _TopN(n)
+        self._search(word, topn)
+        return topn.results(self.words)
 
-    def _calculate(self, word1: list[str], word2: list[str]) -> float:
+    def get_within(self, word: str, max_distance: float) -> list[tuple[str, float]]:
         """
-        Calculates the weighted Hamming distance between two strings.
+        Get the words of the index within the given distance.
 
         Args:
-            word1 (str): The first word.
-            word2 (str): The second word.
+            word (str): The word to compare with.
+            max_distance (float): The largest distance to include.
 
         Returns:
-            float: The calculated weighted Hamming distance.
+            List[Tuple[str, float]]: The words within max_distance and their distances, sorted by distance.
         """
-        if len(word1) != len(word2):
-            return float("inf")
-        return self._calculate_helper(word1, word2, len(word1))
+        within = _TopN(max_distance=max_distance)
+        self._search(word, within)
+        return within.results(self.words)
 
-    def _calculate_helper(
-        self, word1: list[str], word2: list[str], length: int
+    def measure_recall(self, queries: list[str], n: int = 10) -> float:
+        """
+        Measures the recall of get_topn against an exhaustive search.
+
+        A result counts as found if the distance is within the n-th smallest
+        distance, so that ties do not lower the recall.
+
+        Args:
+            queries (list[str]): The query words.
+            n (int): The number of neighbors.
+
+        Returns:
+            float: The mean fraction of the true top n found by get_topn.
+        """
+        recalls = []
+        for query in queries:
+            expected = self.calculator.get_topn(query, self.words, n=n)
+            if not expected:
+                continue
+            worst = expected[-1][1]
+            found = sum(
+                1 for _, distance in self.get_topn(query, n) if distance <= worst
+            )
+            recalls.append(found / len(expected))
+        return sum(recalls) / len(recalls) if recalls else 1.0
+
+    def _search(self, word: str, collector: _TopN):
+        """
+        Visits the tree best-first in ascending order of the lower bound of
+        each subtree, and stops once the bound exceeds the collector's cutoff.
+        """
+        table = self.table
+        words = self.words
+        tree = self.tree
+        ids1 = table.encode(self.calculator.preprocess_func(word))
+        stats = _new_metric_stats(len(words))
+        self.pruning_stats = stats
+        heap: list[tuple[float, int]] = [(0.0, 0)] if len(words) else []
+        while heap:
+            bound, node = heapq.heappop(heap)
+            cutoff = collector.cutoff
+            if cutoff is not None and bound > cutoff + _BOUND_RTOL * max(
+                1.0, abs(cutoff)
+            ):
+                break
+            vantage = int(tree["vantage"][node])
+            if vantage < 0:
+                bucket = tree["items"][
+                    tree["bucket_start"][node] : tree["bucket_end"][node]
+                ]
+                distances = _levenshtein_to_words(
+                    table, ids1, words, bucket, collector.cutoff
+                )
+                stats["evaluated"] += len(bucket)
+                stats["abandoned"] += int(np.count_nonzero(np.isinf(distances)))
+                collector.push(bucket, distances)
+                continue
+            distance = _levenshtein_encoded(table, ids1, words.encoded(vantage))
+            stats["evaluated"] += 1
+            collector.push(np.array([vantage]), np.array([distance]))
+            # Words inside are within radius of the vantage word, the others
+            # beyond it.
+            radius = float(tree["radius"][node])
+            inside, outside = int(tree["inside"][node]), int(tree["outside"][node])
+            if inside >= 0:
+                heapq.heappush(heap, (max(bound, distance - radius), inside))
+            if outside >= 0:
+                heapq.heappush(heap, (max(bound, radius - distance), outside))
+        stats["triangle_bound"] = len(words) - stats["evaluated"]
+
+
+def _new_metric_stats(candidates: int) -> dict[str, int]:
+    return {
+        "candidates": candidates,
+        "triangle_bound": 0,
+        "abandoned": 0,
+        "evaluated": 0,
+    }
+
+
+def _metric_distance_table(calculator: "WeightedLevenshtein") -> KanaDistanceTable:
+    if (
+        not isinstance(calculator, WeightedLevenshtein)
+        or calculator.distance_table is None
+    ):
+        raise ValueError(
+            "MetricIndex requires a WeightedLevenshtein calculator with a distance table"
+        )
+    table = calculator.distance_table
+    if not np.array_equal(table.matrix, table.matrix.T):
+        raise ValueError(
+            "MetricIndex requires a symmetric distance table; "
+            "create the calculator with symmetric=True"
+        )
+    return table
+
+
+def _matrix_digest(matrix: np.ndarray) -> str:
+    return hashlib.sha256(matrix.astype("<f8", copy=False).tobytes()).hexdigest()
+
+
+def _build_vantage_point_tree(
+    table: KanaDistanceTable,
+    words: WordIndex,
+    leaf_size: int,
+    rng: "np.random.Generator",
+) -> dict[str, np.ndarray]:
+    """
+    Builds a vantage-point tree over the words.
+
+    Returns:
+        dict[str, np.ndarray]: For each node, the vantage word (-1 for a leaf), the median distance, the inside and outside children (-1 if none), and the range of the leaf in items, the positions of the words of all leaves.
+    """
+    lengths = words.lengths
+    nodes: list[list] = []
+    items: list[np.ndarray] = []
+    num_items = 0
+    stack = [(0, np.arange(len(words)))]
+    nodes.append([-1, 0.0, -1, -1, 0, 0])
+    while stack:
+        node, subset = stack.pop()
+        if len(subset) > leaf_size:
+            vantage = int(subset[rng.integers(len(subset))])
+            rest = subset[subset != vantage]
+            distances = _levenshtein_to_words(
+                table, words.encoded(vantage), words, rest
+            )
+            radius = float(np.median(distances))
+            inside = distances <= radius
+            # If every word is inside, e.g. duplicates, splitting does not help.
+            if not inside.all():
+                nodes[node][:2] = [vantage, radius]
+                for child, children in [(2, rest[inside]), (3, rest[~inside])]:
+                    nodes[node][child] = len(nodes)
+                    stack.append((len(nodes), children))
+                    nodes.append([-1, 0.0, -1, -1, 0, 0])
+                continue
+        # Words of the same length are contiguous, so that a leaf is
+        # evaluated with one kernel call per length.
+        subset = subset[np.argsort(lengths[subset], kind="stable")]
+        nodes[node][4:] = [num_items, num_items + len(subset)]
+        items.append(subset)
+        num_items += len(subset)
+    columns = list(zip(*nodes))
+    return {
+        "vantage": np.array(columns[0], dtype=np.int64),
+        "radius": np.array(columns[1], dtype=np.float64),
+        "inside": np.array(columns[2], dtype=np.int64),
+        "outside": np.array(columns[3], dtype=np.int64),
+        "bucket_start": np.array(columns[4], dtype=np.int64),
+        "bucket_end": np.array(columns[5], dtype=np.int64),
+        "items": np.concatenate(items).astype(np.int64)
+        if items
+        else np.zeros(0, np.int64),
+    }
+
+
+_GRAPH_MAGIC = b"KANAKNN1"
+# The number of DP cells of the word pairs evaluated at once.
+_GRAPH_BATCH_CELLS = 1 << 22
+# The number of candidate pairs of a local join processed, and of candidate
+# neighbors merged, at once.
+_GRAPH_JOIN_PAIRS = 1 << 22
+# The smallest number of neighbors kept per word while the graph is built.
+_GRAPH_MIN_POOL = 10
+
+
+class NeighborGraph:
+    """
+    An approximate k-nearest-neighbor graph of a word list.
+
+    Row i of neighbors holds the positions of the k words closest to the
+    i-th word (other than itself) in ascending order of distance, and the
+    same row of distances the distances from the i-th word to them. Rows of
+    words with fewer than k finite distances are padded with -1 and inf.
+
+    The graph is built with NN-descent: starting from random neighbors, the
+    neighbors of neighbors of every word are compared with each other, and
+    the graph is updated until few neighbors change. The word pairs of each
+    step are evaluated at once, grouped by their lengths, so a lexicon of
+    N words needs a few dozen distances per word instead of N. The result is
+    approximate; its recall against an exhaustive search is measured on a
+    sample of words when the graph is built.
+
+    Attributes:
+        words (WordIndex): The words of the graph.
+        k (int): The number of neighbors of every word.
+        neighbors (np.ndarray): An int32 array of shape (len(words), k) with the positions of the neighbors.
+        distances (np.ndarray): A float32 array of shape (len(words), k) with the distances to the neighbors.
+        recall (Optional[float]): The mean recall measured when the graph was built, or None if it was not measured.
+        iterations (int): The number of NN-descent iterations run.
+    """
+
+    def __init__(
+        self,
+        words: WordIndex,
+        neighbors: np.ndarray,
+        distances: np.ndarray,
+        recall: float | None = None,
+        iterations: int = 0,
+    ):
+        """
+        Initializes the NeighborGraph with already computed neighbors. Use build or load to create one.
+
+        Args:
+            words (WordIndex): The words of the graph.
+            neighbors (np.ndarray): The positions of the neighbors, of shape (len(words), k).
+            distances (np.ndarray): The distances to the neighbors, of the same shape.
+            recall (Optional[float]): The measured recall.
+            iterations (int): The number of NN-descent iterations run.
+        """
+        if neighbors.shape != distances.shape or len(neighbors) != len(words):
+            raise ValueError(
+                "neighbors and distances must have shape (len(words), k), not "
+                f"{neighbors.shape} and {distances.shape}"
+            )
+        self.words = words
+        self.k = neighbors.shape[1]
+        self.neighbors = neighbors
+        self.distances = distances
+        self.recall = recall
+        self.iterations = iterations
+
+    @classmethod
+    def build(
+        cls,
+        calculator: "WeightedLevenshtein | WeightedHamming",
+        wordlist: "list[str] | WordIndex",
+        k: int = 10,
+        max_iterations: int = 20,
+        sample_rate: float = 1.0,
+        delta: float = 0.001,
+        recall_queries: int = 100,
+        seed: int = 0,
+        progress: Callable[[int, int], None] | None = None,
+    ) -> "NeighborGraph":
+        """
+        Builds the graph of the given words with NN-descent.
+
+        Args:
+            calculator (WeightedLevenshtein | WeightedHamming): A calculator with a distance table.
+            wordlist (list[str] | WordIndex): The words.
+            k (int): The number of neighbors of every word.
+            max_iterations (int): The largest number of iterations.
+            sample_rate (float): The fraction of k of the new neighbors of every word that are joined in an iteration. Smaller values are faster but may lower the recall.
+            delta (float): Stop once fewer than delta * len(words) * k neighbors change in an iteration.
+            recall_queries (int): The number of words whose neighbors are compared with an exhaustive search to measure the recall. 0 skips the measurement.
+            seed (int): The seed of the random initial neighbors, the sampling and the recall queries.
+            progress (Optional[Callable[[int, int], None]]): Called with the number of the iteration and the number of neighbors it changed after every iteration.
+
+        Returns:
+            NeighborGraph: The graph.
+
+        Raises:
+            ValueError: If the calculator has no distance table, or if k or sample_rate is out of range.
+        """
+        table = _graph_distance_table(calculator)
+        if k < 1:
+            raise ValueError("k must be positive")
+        if not 0.0 < sample_rate <= 1.0:
+            raise ValueError("sample_rate must be in (0, 1]")
+        words = _as_word_index(table, calculator.preprocess_func, wordlist)
+        rng = np.random.default_rng(seed)
+        # NN-descent converges poorly with few neighbors, so small graphs are
+        # built with more and truncated.
+        pool = max(k, _GRAPH_MIN_POOL)
+        neighbors, distances, iterations = _nn_descent(
+            calculator,
+            words,
+            pool,
+            max_iterations,
+            max(1, round(sample_rate * pool)),
+            delta,
+            rng,
+            progress,
+        )
+        graph = cls(
+            words,
+            neighbors[:, :k].astype(np.int32),
+            distances[:, :k].astype(np.float32),
+            iterations=iterations,
+        )
+        if recall_queries > 0 and len(words):
+            graph.recall = graph.measure_recall(
+                calculator, recall_queries, int(rng.integers(2**32))
+            )
+        return graph
+
+    def save(self, path: str):
+        """
+        Saves the words and the edges to a binary file that load can memory-map.
+
+        The edges are stored as k int32 neighbor positions and k float32
+        distances per word, 8 bytes per edge; the source of an edge is given
+        by its position.
+
+        Args:
+            path (str): The path of the file.
+        """
+        words = self.words
+        _save_arrays(
+            path,
+            _GRAPH_MAGIC,
+            {
+                "kanas": words.kanas,
+                "k": self.k,
+                "recall": self.recall,
+                "iterations": self.iterations,
+            },
+            {
+                "offsets": words.offsets.astype(np.int64, copy=False),
+                "text_offsets": words._text_offsets.astype(np.int64, copy=False),
+                "ids": words.ids.astype(np.uint16, copy=False),
+                "text": words._text,
+                "neighbors": self.neighbors.astype(np.int32, copy=False).ravel(),
+                "distances": self.distances.astype(np.float32, copy=False).ravel(),
+            },
+        )
+
+    @classmethod
+    def load(cls, path: str, mmap: bool = False) -> "NeighborGraph":
+        """
+        Loads a graph saved with save.
+
+        Args:
+            path (str): The path of the file.
+            mmap (bool): If True, memory-map the arrays instead of reading them.
+
+        Returns:
+            NeighborGraph: The graph.
+
+        Raises:
+            ValueError: If the file is not a neighbor graph.
+        """
+        header, arrays = _load_arrays(path, _GRAPH_MAGIC, mmap)
+        words = WordIndex(
+            header["kanas"],
+            arrays["offsets"],
+            arrays["ids"],
+            arrays["text_offsets"],
+            arrays["text"],
+        )
+        shape = (len(words), header["k"])
+        return cls(
+            words,
+            arrays["neighbors"].reshape(shape),
+            arrays["distances"].reshape(shape),
+            header["recall"],
+            header["iterations"],
+        )
+
+    def get_neighbors(self, i: int) -> list[tuple[str, float]]:
+        """
+        Get the neighbors of the i-th word.
+
+        Args:
+            i (int): The position of the word.
+
+        Returns:
+            List[Tuple[str, float]]: The neighbors and their distances, sorted by distance.
+        """
+        row = self.neighbors[i]
+        found = row >= 0
+        distances = self.distances[i][found].tolist()
+        return list(zip(self.words._decode(row[found].tolist()), distances))
+
+    def edges(self) -> Iterator[tuple[int, int, float]]:
+        """
+        Iterates over the edges of the graph.
+
+        Yields:
+            Tuple[int, int, float]: The position of a word, the position of one of its neighbors and the distance between them.
+        """
+        for i in range(len(self.words)):
+            row = self.neighbors[i]
+            found = row >= 0
+            yield from zip(
+                [i] * int(found.sum()),
+                row[found].tolist(),
+                self.distances[i][found].tolist(),
+            )
+
+    def measure_recall(
+        self,
+        calculator: "WeightedLevenshtein | WeightedHamming",
+        queries: int = 100,
+        seed: int = 0,
     ) -> float:
         """
-        A helper function to calculate the weighted Hamming distance between two strings.
+        Measures the recall of the neighbors against an exhaustive search.
+
+        The distances from randomly chosen words to all words are calculated
+        with calculate_batch. A neighbor counts as found if its distance is
+        within the k-th smallest distance, so that ties do not lower the
+        recall.
 
         Args:
-            word1 (str): The first word.
-            word2 (str): The second word.
-            length (int): The length of the words.
+            calculator (WeightedLevenshtein | WeightedHamming): The calculator the graph was built with.
+            queries (int): The number of words to check.
+            seed (int): The seed of the choice of words.
 
         Returns:
-            float: The calculated weighted Hamming distance.
+            float: The mean fraction of the true k nearest neighbors found in the graph.
         """
-        # Check for memoized result
-        memo_value = self.memo.get(word1[:length], word2[:length])
-        if memo_value is not None:
-            return memo_value
+        words = self.words
+        rng = np.random.default_rng(seed)
+        positions = rng.choice(len(words), size=min(queries, len(words)), replace=False)
+        recalls = []
+        for i in positions.tolist():
+            row = calculator.calculate_batch([words[i]], words, as_array=True)[0]
+            row[i] = np.inf
+            expected = min(self.k, int(np.count_nonzero(np.isfinite(row))))
+            if not expected:
+                continue
+            worst = np.partition(row, expected - 1)[expected - 1]
+            found = self.neighbors[i][self.neighbors[i] >= 0]
+            recalls.append(np.count_nonzero(row[found] <= worst) / expected)
+        return sum(recalls) / len(recalls) if recalls else 1.0
 
-        cost = 0.0
-        for i in range(length):
-            if self.replace_cost_func:
-                cost += self.replace_cost_func(word1[i], word2[i])
+
+def _graph_distance_table(
+    calculator: "WeightedLevenshtein | WeightedHamming",
+) -> KanaDistanceTable:
+    if (
+        not isinstance(calculator, (WeightedLevenshtein, WeightedHamming))
+        or calculator.distance_table is None
+    ):
+        raise ValueError("NeighborGraph requires a calculator with a distance table")
+    return calculator.distance_table
+
+
+def _nn_descent(
+    calculator: "WeightedLevenshtein | WeightedHamming",
+    words: WordIndex,
+    k: int,
+    max_iterations: int,
+    sample_size: int,
+    delta: float,
+    rng: "np.random.Generator",
+    progress: Callable[[int, int], None] | None,
+) -> tuple[np.ndarray, np.ndarray, int]:
+    """
+    Builds a k-nearest-neighbor graph with NN-descent (Dong et al., 2011).
+
+    Every word starts with random neighbors, half of them drawn near it in
+    the order of mora length, which is where close words are. In every
+    iteration, up to sample_size of the neighbors of each word that were not
+    joined yet, and as many of the words that have it as a neighbor, are
+    compared with each other and with its other neighbors; a word pair that
+    is closer than the current k-th neighbor replaces it.
+
+    Returns:
+        tuple[np.ndarray, np.ndarray, int]: The neighbors, the float64 distances, and the number of iterations run.
+    """
+    table = calculator.distance_table
+    assert table is not None
+    hamming = isinstance(calculator, WeightedHamming)
+    symmetric = np.array_equal(table.matrix, table.matrix.T)
+    size = len(words)
+    neighbors = np.full((size, k), -1, dtype=np.int64)
+    distances = np.full((size, k), np.inf)
+    # whether a neighbor was added since its word was last joined
+    is_new = np.zeros((size, k), dtype=bool)
+    count = min(k, size - 1)
+    if count <= 0:
+        return neighbors, distances, 0
+
+    local = (count + 1) // 2
+    order = np.lexsort((rng.random(size), words.lengths))
+    rank = np.empty(size, dtype=np.int64)
+    rank[order] = np.arange(size)
+    offsets = rng.integers(-count, count, size=(size, local))
+    offsets += offsets >= 0
+    # wrapping around, so that no word is its own neighbor
+    nearby = order[(rank[:, None] + offsets) % size]
+    uniform = rng.integers(0, size - 1, size=(size, count - local))
+    uniform += uniform >= np.arange(size)[:, None]
+    targets = np.concatenate([nearby, uniform], axis=1).ravel()
+    sources = np.repeat(np.arange(size), count)
+    distinct = sources != targets
+    sources, targets = sources[distinct], targets[distinct]
+    _merge_neighbors(
+        neighbors,
+        distances,
+        is_new,
+        sources,
+        targets,
+        _pair_distances(table, words, sources, targets, hamming),
+    )
+
+    iteration = 0
+    while iteration < max_iterations:
+        iteration += 1
+        valid = neighbors >= 0
+        priority = np.where(is_new & valid, rng.random((size, k)), np.inf)
+        ranks = np.argsort(np.argsort(priority, axis=1), axis=1)
+        sampled = np.isfinite(priority) & (ranks < sample_size)
+        old = valid & ~is_new
+        is_new &= ~sampled
+        new_sources, columns = np.nonzero(sampled)
+        new_targets = neighbors[new_sources, columns]
+        old_sources, columns = np.nonzero(old)
+        old_targets = neighbors[old_sources, columns]
+        # The reverse neighbors, i.e. the words that have a word as a neighbor.
+        reverse_new = _sample_per_word(new_targets, new_sources, sample_size, rng)
+        reverse_old = _sample_per_word(old_targets, old_sources, sample_size, rng)
+        new_lists = _padded_lists(
+            size,
+            np.concatenate([new_sources, reverse_new[0]]),
+            np.concatenate([new_targets, reverse_new[1]]),
+        )
+        old_lists = _padded_lists(
+            size,
+            np.concatenate([old_sources, reverse_old[0]]),
+            np.concatenate([old_targets, reverse_old[1]]),
+        )
+        pairs_per_word = new_lists.shape[1] * (new_lists.shape[1] + old_lists.shape[1])
+        chunk = max(1, _GRAPH_JOIN_PAIRS // max(1, pairs_per_word))
+        # The candidates closer than the current k-th neighbor are collected
+        # over several chunks and merged at once.
+        candidates = []
+        pending = 0
+        updates = 0
+        for start in range(0, size, chunk):
+            first, second = _local_join(
+                size, new_lists[start : start + chunk], old_lists[start : start + chunk]
+            )
+            forward = _pair_distances(table, words, first, second, hamming)
+            backward = (
+                forward
+                if symmetric
+                else _pair_distances(table, words, second, first, hamming)
+            )
+            sources = np.concatenate([first, second])
+            targets = np.concatenate([second, first])
+            found = np.concatenate([forward, backward])
+            closer = found < distances[sources, -1]
+            candidates.append((sources[closer], targets[closer], found[closer]))
+            pending += int(np.count_nonzero(closer))
+            if pending >= _GRAPH_JOIN_PAIRS or start + chunk >= size:
+                updates += _merge_neighbors(
+                    neighbors,
+                    distances,
+                    is_new,
+                    *(np.concatenate(arrays) for arrays in zip(*candidates)),
+                )
+                candidates = []
+                pending = 0
+        if progress is not None:
+            progress(iteration, updates)
+        if updates <= delta * size * k:
+            break
+    return neighbors, distances, iteration
+
+
+def _sample_per_word(
+    sources: np.ndarray, targets: np.ndarray, limit: int, rng: "np.random.Generator"
+) -> tuple[np.ndarray, np.ndarray]:
+    """Keeps up to limit randomly chosen targets of every source."""
+    order = rng.permutation(len(sources))
+    order = order[np.argsort(sources[order], kind="stable")]
+    sorted_sources = sources[order]
+    ranks = np.arange(len(order)) - np.searchsorted(sorted_sources, sorted_sources)
+    order = order[ranks < limit]
+    return sources[order], targets[order]
+
+
+def _padded_lists(size: int, sources: np.ndarray, targets: np.ndarray) -> np.ndarray:
+    """
+    Collects the distinct targets of every source into the rows of an array
+    of shape (size, longest list), padded with -1.
+    """
+    keys = _distinct(sources * size + targets)
+    sources, targets = keys // size, keys % size
+    ranks = np.arange(len(keys)) - np.searchsorted(sources, sources)
+    lists = np.full((size, int(ranks.max(initial=-1)) + 1), -1, dtype=np.int64)
+    lists[sources, ranks] = targets
+    return lists
+
+
+def _local_join(
+    size: int, new_lists: np.ndarray, old_lists: np.ndarray
+) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Returns the distinct word pairs, with the smaller position first, of the
+    new neighbors of each word with each other and with its old neighbors.
+    """
+    first = new_lists[:, :, None]
+    keys = []
+    for second in (new_lists[:, None, :], old_lists[:, None, :]):
+        shape = np.broadcast_shapes(first.shape, second.shape)
+        pair = (first >= 0) & (second >= 0) & (first != second)
+        low = np.broadcast_to(np.minimum(first, second), shape)[pair]
+        high = np.broadcast_to(np.maximum(first, second), shape)[pair]
+        keys.append(low * size + high)
+    keys = _distinct(np.concatenate(keys))
+    return keys // size, keys % size
+
+
+def _pair_distances(
+    table: KanaDistanceTable,
+    words: WordIndex,
+    sources: np.ndarray,
+    targets: np.ndarray,
+    hamming: bool,
+) -> np.ndarray:
+    """
+    Calculates the distances from words[sources[i]] to words[targets[i]],
+    evaluating the pairs of the same lengths at once.
+    """
+    lengths = words.lengths
+    starts = words.offsets[:-1]
+    source_lengths = lengths[sources]
+    target_lengths = lengths[targets]
+    distances = np.full(len(sources), np.inf)
+    keys = source_lengths * (int(lengths.max(initial=0)) + 1) + target_lengths
+    if hamming:
+        keys[source_lengths != target_lengths] = -1
+    order = np.argsort(keys)
+    sorted_keys = keys[order]
+    boundaries = np.flatnonzero(np.diff(sorted_keys)) + 1
+    for group in np.split(order, boundaries):
+        if not len(group) or keys[group[0]] < 0:
+            continue
+        m = int(source_lengths[group[0]])
+        n = int(target_lengths[group[0]])
+        chunk = max(1, _GRAPH_BATCH_CELLS // ((m + 1) * (n + 1)))
+        for start in range(0, len(group), chunk):
+            part = group[start : start + chunk]
+            ids1 = words.ids[starts[sources[part]] + np.arange(m)[:, None]]
+            ids2 = words.ids[starts[targets[part]] + np.arange(n)[:, None]]
+            ids1, ids2 = ids1.astype(np.intp), ids2.astype(np.intp)
+            if hamming:
+                distances[part] = _hamming_pairs(table, ids1, ids2)
             else:
-                if word1[i] != word2[i]:
-                    cost += self.replace_cost
+                distances[part] = _levenshtein_pairs(table, ids1, ids2)
+    return distances
 
-        # Memoize the result
-        self.memo.set(word1[:length], word2[:length], cost)
-        return cost
+
+def _levenshtein_pairs(
+    table: KanaDistanceTable, ids1: np.ndarray, ids2: np.ndarray
+) -> np.ndarray:
+    """
+    Calculates the weighted Levenshtein distances between the word pairs in
+    the columns of two ID matrices of shapes (m, k) and (n, k).
+
+    The DP is the one of _levenshtein_group, with a different first word in
+    every column, so the results are identical to those of calculate.
+    """
+    matrix = table.matrix
+    sp_id = table.sp_id
+    n, k = ids2.shape
+    insert_costs = matrix[sp_id][ids2]
+
+    # prev[j] holds the distances between word1[:i-1] and word2[:j]
+    prev = np.empty((n + 1, k), dtype=np.float64)
+    prev[0] = 0.0
+    for j in range(1, n + 1):
+        np.add(prev[j - 1], insert_costs[j - 1], out=prev[j])
+    curr = np.empty_like(prev)
+    for c1 in ids1:
+        delete_costs = matrix[c1, sp_id]
+        replace_costs = matrix[c1, ids2]
+        diagonal = np.minimum(prev[:-1] + replace_costs, prev[1:] + delete_costs)
+        curr[0] = prev[0] + delete_costs
+        for j in range(1, n + 1):
+            np.minimum(diagonal[j - 1], curr[j - 1] + insert_costs[j - 1], out=curr[j])
+        prev, curr = curr, prev
+    return prev[n].copy()
+
+
+def _hamming_pairs(
+    table: KanaDistanceTable, ids1: np.ndarray, ids2: np.ndarray
+) -> np.ndarray:
+    """
+    Calculates the weighted Hamming distances between the word pairs in the
+    columns of two ID matrices of the same shape, adding the costs in the
+    same order as _hamming_group.
+    """
+    matrix = table.matrix
+    totals = np.zeros(ids1.shape[1], dtype=np.float64)
+    for c1, c2 in zip(ids1, ids2):
+        totals += matrix[c1, c2]
+    return totals
+
+
+def _merge_neighbors(
+    neighbors: np.ndarray,
+    distances: np.ndarray,
+    is_new: np.ndarray,
+    sources: np.ndarray,
+    targets: np.ndarray,
+    candidate_distances: np.ndarray,
+) -> int:
+    """
+    Adds the candidate neighbors that are closer than the current k-th
+    neighbor of their source word, in place.
+
+    Returns:
+        int: The number of candidates added.
+    """
+    size, k = neighbors.shape
+    closer = candidate_distances < distances[sources, -1]
+    if not closer.any():
+        return 0
+    sources = sources[closer]
+    rows = _distinct(sources)
+    count = len(rows)
+    entry_rows = np.concatenate(
+        [np.repeat(np.arange(count), k), np.searchsorted(rows, sources)]
+    )
+    entry_targets = np.concatenate([neighbors[rows].ravel(), targets[closer]])
+    entry_distances = np.concatenate(
+        [distances[rows].ravel(), candidate_distances[closer]]
+    )
+    entry_new = np.concatenate([is_new[rows].ravel(), np.ones(len(sources), bool)])
+    candidate = np.arange(len(entry_rows)) >= count * k
+    # Drop the padding and the candidates that are already neighbors: sorted
+    # by this key, the current entry of a word comes before its candidates.
+    keys = (entry_rows * size + entry_targets) * 2 + candidate
+    order = np.argsort(keys)
+    order = order[entry_targets[order] >= 0]
+    pairs = keys[order] >> 1
+    order = order[np.concatenate([[True], pairs[1:] != pairs[:-1]])]
+    # by row, then by distance; two plain sorts are faster than stable ones
+    by_distance = np.empty(len(order), dtype=np.int64)
+    by_distance[np.argsort(entry_distances[order])] = np.arange(len(order))
+    order = order[np.argsort(entry_rows[order] * len(order) + by_distance)]
+    sorted_rows = entry_rows[order]
+    ranks = np.arange(len(order)) - np.searchsorted(sorted_rows, sorted_rows)
+    kept = ranks < k
+    order, ranks = order[kept], ranks[kept]
+    merged_neighbors = np.full((count, k), -1, dtype=neighbors.dtype)
+    merged_distances = np.full((count, k), np.inf)
+    merged_new = np.zeros((count, k), dtype=bool)
+    merged_neighbors[entry_rows[order], ranks] = entry_targets[order]
+    merged_distances[entry_rows[order], ranks] = entry_distances[order]
+    merged_new[entry_rows[order], ranks] = entry_new[order]
+    neighbors[rows] = merged_neighbors
+    distances[rows] = merged_distances
+    is_new[rows] = merged_new
+    return int(np.count_nonzero(candidate[order]))
+
+
+def _distinct(keys: np.ndarray) -> np.ndarray:
+    """Returns the sorted distinct values; faster than np.unique for integers."""
+    keys = np.sort(keys)
+    return keys[np.concatenate([[True], keys[1:] != keys[:-1]])] if len(keys) else keys
 
 
 _DATA_DIR = os.path.join(os.path.dirname(__file__), "data")
@@ -451,7 +4842,7 @@ _DEFAULT_DISTANCE_CSVS: dict[str, tuple[str, str]] = {
 }
 
 
-def create_kana_distance_calculator(
+def create_kana_distance_table(
     *,
     kana2phonome_csv: str = os.path.join(_DATA_DIR, "biphone/kana2phonome_bi.csv"),
     distance_consonants_csv: str | None = None,
@@ -461,8 +4852,6 @@ def create_kana_distance_calculator(
     replace_penalty: float = 1.0,
     vowel_ratio: float = 0.5,
     non_syllabic_penalty: float = 0.2,
-    preprocess_func: Callable[[str], list[str]] = extend_long_vowel_moras,
-    distance_type: Literal["levenshtein", "hamming"] = "levenshtein",
     same_phonome_offset: bool = True,
     consonant_binary: bool = False,
     vowel_binary: bool = False,
@@ -470,7 +4859,22 @@ def create_kana_distance_calculator(
     phoneme_unit: Literal["biphone", "mono"] = "biphone",
     consonant_distance: Literal["acoustic", "features"] = "acoustic",
     symmetric: bool = False,
-) -> WeightedLevenshtein | WeightedHamming:
+    cache_dir: str | None = None,
+) -> KanaDistanceTable:
+    """
+    Creates the dense kana distance table used by create_kana_distance_calculator.
+
+    The arguments are the same as those of create_kana_distance_calculator.
+    If a cache directory is given (or set with the KANASIM_CACHE_DIR
+    environment variable), the table is saved there in a binary file named
+    after a hash of the parameters and of the path, modification time and
+    size of the source CSVs, and later calls with the same inputs load that
+    file without reading the CSVs. Editing a CSV changes the hash, so stale
+    files are never used.
+
+    Returns:
+        KanaDistanceTable: The kana distance table.
+    """
     default_consonants_csv, default_vowels_csv = _DEFAULT_DISTANCE_CSVS[phoneme_unit]
     if consonant_distance == "features":
         # The distinctive-feature table is keyed by monophone labels.
@@ -481,10 +4885,134 @@ def create_kana_distance_calculator(
         default_consonants_csv = os.path.join(
             _DATA_DIR, "features/distance_consonants_mono_features.csv"
         )
-    distance_list = create_kana_distance_list(
+    distance_consonants_csv = distance_consonants_csv or default_consonants_csv
+    distance_vowels_csv = distance_vowels_csv or default_vowels_csv
+
+    parameters = {
+        "insert_penalty": insert_penalty,
+        "delete_penalty": delete_penalty,
+        "replace_penalty": replace_penalty,
+        "vowel_ratio": vowel_ratio,
+        "non_syllabic_penalty": non_syllabic_penalty,
+        "same_phonome_offset": same_phonome_offset,
+        "consonant_binary": consonant_binary,
+        "vowel_binary": vowel_binary,
+        "normalize": normalize,
+        "phoneme_unit": phoneme_unit,
+        "symmetric": symmetric,
+    }
+    csv_paths = [kana2phonome_csv, distance_consonants_csv, distance_vowels_csv]
+    # Tables are shared within the process. The file identities make an
+    # edited CSV produce a new entry.
+    registry_key = (
+        tuple(sorted(parameters.items())),
+        tuple(_file_identity(path) for path in csv_paths),
+    )
+    with _TABLE_REGISTRY_LOCK:
+        table = _TABLE_REGISTRY.get(registry_key)
+        if table is None:
+            table = _load_or_build_kana_distance_table(
+                parameters, csv_paths, cache_dir or os.environ.get("KANASIM_CACHE_DIR")
+            )
+            _TABLE_REGISTRY[registry_key] = table
+    return table
+
+
+def clear_kana_distance_table_cache():
+    """
+    Releases the kana distance tables and parsed CSVs shared within the process.
+
+    Calculators created before keep their tables; later calls to
+    create_kana_distance_table and create_kana_distance_calculator build or
+    load the tables again.
+    """
+    with _TABLE_REGISTRY_LOCK:
+        _TABLE_REGISTRY.clear()
+        _PARSED_CSV_REGISTRY.clear()
+
+
+_TABLE_REGISTRY: dict[tuple, KanaDistanceTable] = {}
+_PARSED_CSV_REGISTRY: dict[tuple, object] = {}
+_TABLE_REGISTRY_LOCK = threading.RLock()
+
+
+def _file_identity(path: str) -> tuple[str, int, int]:
+    stat = os.stat(path)
+    return os.path.abspath(path), stat.st_mtime_ns, stat.st_size
+
+
+def _load_shared(name: str, loader: Callable[[str], _T], path: str) -> _T:
+    """
+    Parses a CSV once per process and file version, sharing the result.
+
+    The results are registered under name, which identifies the loader.
+    """
+    key = (name, _file_identity(path))
+    with _TABLE_REGISTRY_LOCK:
+        if key not in _PARSED_CSV_REGISTRY:
+            _PARSED_CSV_REGISTRY[key] = loader(path)
+        return cast(_T, _PARSED_CSV_REGISTRY[key])
+
+
+def _load_or_build_kana_distance_table(
+    parameters: dict, csv_paths: list[str], cache_dir: str | None
+) -> KanaDistanceTable:
+    cache_path = None
+    if cache_dir:
+        key = _table_cache_key(parameters, csv_paths)
+        cache_path = os.path.join(
+            os.path.expanduser(cache_dir), f"kana_distance_{key}.bin"
+        )
+        try:
+            return KanaDistanceTable.load(cache_path)
+        except (OSError, ValueError):
+            # Missing or unreadable: build the table and (re)write the file.
+            pass
+
+    kana2phonome_csv, distance_consonants_csv, distance_vowels_csv = csv_paths
+    table = _build_kana_distance_table(
+        kana2phonome_csv=kana2phonome_csv,
+        distance_consonants_csv=distance_consonants_csv,
+        distance_vowels_csv=distance_vowels_csv,
+        **parameters,
+    )
+    if cache_path is not None:
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        table.save(cache_path)
+    return table
+
+
+def _table_cache_key(parameters: dict, csv_paths: list[str]) -> str:
+    # The CSVs are identified by path, modification time and size, so that a
+    # cache hit does not read them; editing a CSV changes the key.
+    digest = hashlib.sha256(_TABLE_MAGIC)
+    digest.update(json.dumps(parameters, sort_keys=True).encode("utf-8"))
+    for path in csv_paths:
+        digest.update(json.dumps(_file_identity(path)).encode("utf-8"))
+    return digest.hexdigest()[:32]
+
+
+def _build_kana_distance_table(
+    *,
+    kana2phonome_csv: str,
+    distance_consonants_csv: str,
+    distance_vowels_csv: str,
+    insert_penalty: float,
+    delete_penalty: float,
+    replace_penalty: float,
+    vowel_ratio: float,
+    non_syllabic_penalty: float,
+    same_phonome_offset: bool,
+    consonant_binary: bool,
+    vowel_binary: bool,
+    normalize: bool,
+    phoneme_unit: Literal["biphone", "mono"],
+    symmetric: bool,
+) -> KanaDistanceTable:
+    kanas, matrix, vowel_matrix = _kana_distance_matrix(
         kana2phonome_csv=kana2phonome_csv,
-        distance_consonants_csv=distance_consonants_csv or default_consonants_csv,
-        distance_vowels_csv=distance_vowels_csv or default_vowels_csv,
+        distance_consonants_csv=distance_consonants_csv,
+        distance_vowels_csv=distance_vowels_csv,
         insert_penalty=insert_penalty,
         delete_penalty=delete_penalty,
         replace_penalty=replace_penalty,
@@ -496,39 +5024,67 @@ def create_kana_distance_calculator(
         normalize=normalize,
         phoneme_unit=phoneme_unit,
     )
-    distance_dict = {}
-    for row in distance_list:
-        kana1 = row["kana1"]
-        kana2 = row["kana2"]
-        distance = row["distance"]
-        distance_dict[(kana1, kana2)] = distance
-
     if symmetric:
         # The likelihood-based tables are asymmetric (d(a,b) != d(b,a)).
         # Averaging with the transpose makes the resulting kana distance
         # direction-independent, including insert vs. delete costs.
-        distance_dict = {
-            (kana1, kana2): (distance + distance_dict[(kana2, kana1)]) / 2
-            for (kana1, kana2), distance in distance_dict.items()
-        }
+        matrix = (matrix + matrix.T) / 2
+        vowel_matrix = (vowel_matrix + vowel_matrix.T) / 2
+    return KanaDistanceTable(kanas, matrix, vowel_matrix)
 
-    def lookup_distance(kana1: str, kana2: str) -> float:
-        try:
-            return distance_dict[(kana1, kana2)]
-        except KeyError:
-            raise ValueError(
-                f"Mora not found in the kana distance table: {(kana1, kana2)!r}. "
-                "Input must consist of katakana convertible to phonemes."
-            ) from None
 
+def create_kana_distance_calculator(
+    *,
+    kana2phonome_csv: str = os.path.join(_DATA_DIR, "biphone/kana2phonome_bi.csv"),
+    distance_consonants_csv: str | None = None,
+    distance_vowels_csv: str | None = None,
+    insert_penalty: float = 1.0,
+    delete_penalty: float = 1.0,
+    replace_penalty: float = 1.0,
+    vowel_ratio: float = 0.5,
+    non_syllabic_penalty: float = 0.2,
+    preprocess_func: Callable[[str], list[str]] = extend_long_vowel_moras,
+    distance_type: Literal["levenshtein", "hamming"] = "levenshtein",
+    same_phonome_offset: bool = True,
+    consonant_binary: bool = False,
+    vowel_binary: bool = False,
+    normalize: bool = False,
+    phoneme_unit: Literal["biphone", "mono"] = "biphone",
+    consonant_distance: Literal["acoustic", "features"] = "acoustic",
+    symmetric: bool = False,
+    memo: MemoCache | bool | None = None,
+    stats: CalculatorStats | bool = False,
+    cache_dir: str | None = None,
+) -> WeightedLevenshtein | WeightedHamming:
+    table = create_kana_distance_table(
+        kana2phonome_csv=kana2phonome_csv,
+        distance_consonants_csv=distance_consonants_csv,
+        distance_vowels_csv=distance_vowels_csv,
+        insert_penalty=insert_penalty,
+        delete_penalty=delete_penalty,
+        replace_penalty=replace_penalty,
+        vowel_ratio=vowel_ratio,
+        non_syllabic_penalty=non_syllabic_penalty,
+        same_phonome_offset=same_phonome_offset,
+        consonant_binary=consonant_binary,
+        vowel_binary=vowel_binary,
+        normalize=normalize,
+        phoneme_unit=phoneme_unit,
+        consonant_distance=consonant_distance,
+        symmetric=symmetric,
+        cache_dir=cache_dir,
+    )
+
+    # The cost functions are kept for callers that inspect them; the
+    # calculators themselves index the table directly.
     def insert_cost_func(kana: str) -> float:
-        return lookup_distance("sp", kana)
+        return table.distance("sp", kana)
 
     def delete_cost_func(kana: str) -> float:
-        return lookup_distance(kana, "sp")
+        return table.distance(kana, "sp")
 
     def replace_cost_func(kana1: str, kana2: str) -> float:
-        return lookup_distance(kana1, kana2)
+        return table.distance(kana1, kana2)
 
     if distance_type == "levenshtein":
         return WeightedLevenshtein(
@@ -536,9 +5092,15 @@ def create_kana_distance_calculator(
             delete_cost_func=delete_cost_func,
             replace_cost_func=replace_cost_func,
             preprocess_func=preprocess_func,
+            distance_table=table,
+            memo=True if memo is None else memo,
+            stats=stats,
         )
     elif distance_type == "hamming":
         return WeightedHamming(
             replace_cost_func=replace_cost_func,
             preprocess_func=preprocess_func,
+            distance_table=table,
+            memo=False if memo is None else memo,
+            stats=stats,
         )
@@ -0,0 +1,507 @@
+"""
+A local HTTP/JSON server answering similarity queries against one lexicon.
+
+The server loads a calculator and a word list once, and answers the
+following requests (JSON bodies and responses):
+
+- POST /topn {"word": "カナダ", "n": 10}: the n most similar words, as
+  {"results": [[word, distance], ...]}. Infinite distances are null.
+- POST /within {"word": "カナダ", "max_distance": 5.0}: the words within the
+  distance, in the same format.
+- GET /health: whether the server is up, and the size of the lexicon.
+- GET /config: the calculator and batching settings.
+- GET /latency: a histogram of the request latencies.
+
+Queries that arrive within batch_window seconds of each other are evaluated
+together in one job of a worker thread, so that the event loop keeps
+accepting requests while the calculator runs. The distances from the
+distinct words of a batch to the lexicon are calculated in one
+calculate_batch pass, and every query of the batch selects its results from
+the distances of its word.
+
+Run it with::
+
+    python -m kanasim.server -w wordlist.txt --port 8000
+"""
+
+import asyncio
+import json
+import logging
+import math
+import time
+from bisect import bisect_left
+from http import HTTPStatus
+from typing import Any, Literal
+
+import numpy as np
+
+from .kanasim import (
+    WeightedHamming,
+    WeightedLevenshtein,
+    WordIndex,
+    _TopN,
+    create_kana_distance_calculator,
+)
+
+logger = logging.getLogger(__name__)
+
+# Upper bounds of the latency histogram buckets, in milliseconds.
+_LATENCY_BUCKETS_MS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000)
+
+# Largest accepted request body, in bytes.
+_MAX_BODY_SIZE = 1 << 16
+
+# Largest number of distances of a batch held at once.
+_BATCH_DISTANCES = 1 << 22
+
+
+class LatencyHistogram:
+    """
+    Counts durations in buckets with fixed upper bounds.
+
+    Attributes:
+        bounds (tuple[float, ...]): The upper bounds of the buckets in milliseconds. Longer durations fall into a last, unbounded bucket.
+        counts (list[int]): The number of durations in each bucket.
+        total_ms (float): The sum of all durations in milliseconds.
+    """
+
+    def __init__(self, bounds: tuple[float, ...] = _LATENCY_BUCKETS_MS):
+        self.bounds = tuple(bounds)
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.total_ms = 0.0
+
+    def observe(self, seconds: float):
+        milliseconds = seconds * 1000
+        self.counts[bisect_left(self.bounds, milliseconds)] += 1
+        self.total_ms += milliseconds
+
+    def snapshot(self) -> dict:
+        """
+        Returns the histogram as a JSON-serializable dict.
+
+        Returns:
+            dict: The number of durations ("count"), their sum ("sum_ms"), and the buckets as a list of {"le": bound, "count": count}, where the last bound is "inf".
+        """
+        bounds: list[float | str] = [*self.bounds, "inf"]
+        return {
+            "count": sum(self.counts),
+            "sum_ms": self.total_ms,
+            "buckets": [
+                {"le": bound, "count": count}
+                for bound, count in zip(bounds, self.counts)
+            ],
+        }
+
+
+class QueryServer:
+    """
+    An asyncio HTTP/JSON server for get_topn and get_within queries.
+
+    Attributes:
+        calculator (WeightedLevenshtein | WeightedHamming): The calculator. It is only used from one worker thread at a time.
+        index (WordIndex): The lexicon, encoded once at startup.
+        batch_window (float): How long the first query of a batch waits for others, in seconds.
+        max_batch_size (int): The largest number of queries evaluated together.
+        method (Literal["bounds", "trie"]): The search method of WeightedLevenshtein.
+        latency (LatencyHistogram): The latencies of the answered requests.
+        batches (int): The number of evaluated batches.
+        queries (int): The number of evaluated queries.
+    """
+
+    def __init__(
+        self,
+        calculator: WeightedLevenshtein | WeightedHamming,
+        wordlist: "list[str] | WordIndex",
+        *,
+        host: str = "127.0.0.1",
+        port: int = 8000,
+        batch_window: float = 0.002,
+        max_batch_size: int = 64,
+        method: Literal["bounds", "trie"] = "trie",
+    ):
+        """
+        Initializes the QueryServer and encodes the word list.
+
+        Args:
+            calculator (WeightedLevenshtein | WeightedHamming): A calculator with a distance table.
+            wordlist (list[str] | WordIndex): The lexicon to search.
+            host (str): The address to listen on.
+            port (int): The port to listen on. 0 picks a free port, available from start.
+            batch_window (float): How long the first query of a batch waits for others, in seconds.
+            max_batch_size (int): The largest number of queries evaluated together.
+            method (Literal["bounds", "trie"]): The search method passed to WeightedLevenshtein.get_topn and get_within.
+        """
+        if calculator.distance_table is None:
+            raise ValueError("The calculator needs a distance table")
+        self.calculator = calculator
+        if isinstance(wordlist, WordIndex):
+            self.index = wordlist
+        else:
+            self.index = WordIndex.build(
+                wordlist, calculator.distance_table, calculator.preprocess_func
+            )
+        self.host = host
+        self.port = port
+        self.batch_window = batch_window
+        self.max_batch_size = max_batch_size
+        self.method = method
+        self.latency = LatencyHistogram()
+        self.batches = 0
+        self.queries = 0
+        self._server: asyncio.Server | None = None
+        self._queue: asyncio.Queue | None = None
+        self._batcher: asyncio.Task | None = None
+
+    async def start(self) -> int:
+        """
+        Starts listening and evaluating queries.
+
+        Returns:
+            int: The port the server listens on.
+        """
+        self._queue = asyncio.Queue()
+        self._batcher = asyncio.create_task(self._run_batches())
+        self._server = await asyncio.start_server(self._handle, self.host, self.port)
+        self.port = self._server.sockets[0].getsockname()[1]
+        return self.port
+
+    async def stop(self):
+        """Stops listening and cancels the pending queries."""
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+        if self._batcher is not None:
+            self._batcher.cancel()
+            try:
+                await self._batcher
+            except asyncio.CancelledError:
+                pass
+            self._batcher = None
+        while self._queue is not None and not self._queue.empty():
+            _, future = self._queue.get_nowait()
+            future.cancel()
+
+    async def serve_forever(self):
+        """Starts the server and runs until cancelled."""
+        await self.start()
+        try:
+            await asyncio.Event().wait()
+        finally:
+            await self.stop()
+
+    async def topn(self, word: str, n: int = 10) -> list[tuple[str, float]]:
+        """
+        Queues a get_topn query and waits for its batch.
+
+        Args:
+            word (str): The word to compare with.
+            n (int): The number of similar words to get.
+
+        Returns:
+            list[tuple[str, float]]: The top n similar words and their distances.
+        """
+        return await self._submit(("topn", word, n))
+
+    async def within(self, word: str, max_distance: float) -> list[tuple[str, float]]:
+        """
+        Queues a get_within query and waits for its batch.
+
+        Args:
+            word (str): The word to compare with.
+            max_distance (float): The largest distance to include.
+
+        Returns:
+            list[tuple[str, float]]: The words within max_distance and their distances, sorted by distance.
+        """
+        return await self._submit(("within", word, max_distance))
+
+    def config(self) -> dict:
+        """Returns the settings reported by /config."""
+        table = self.calculator.distance_table
+        assert table is not None
+        return {
+            "distance_type": (
+                "hamming"
+                if isinstance(self.calculator, WeightedHamming)
+                else "levenshtein"
+            ),
+            "method": self.method,
+            "kanas": len(table.kanas),
+            "words": len(self.index),
+            "batch_window": self.batch_window,
+            "max_batch_size": self.max_batch_size,
+        }
+
+    async def _submit(self, query: tuple) -> list[tuple[str, float]]:
+        if self._queue is None:
+            raise RuntimeError("The server is not started")
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((query, future))
+        return await future
+
+    async def _run_batches(self):
+        assert self._queue is not None
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+            deadline = loop.time() + self.batch_window
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+                except TimeoutError:
+                    break
+            batch = [(query, future) for query, future in batch if not future.done()]
+            if not batch:
+                continue
+            # One job per batch also keeps the calculator on a single thread.
+            try:
+                results = await loop.run_in_executor(
+                    None, self._evaluate, [query for query, _ in batch]
+                )
+            except Exception as e:
+                # The queries of the batch fail, but the batcher keeps running.
+                logger.exception("failed to evaluate a batch of %d queries", len(batch))
+                results = {query: e for query, _ in batch}
+            self.batches += 1
+            self.queries += len(batch)
+            for query, future in batch:
+                if future.done():
+                    continue
+                result = results[query]
+                if isinstance(result, Exception):
+                    future.set_exception(result)
+                else:
+                    future.set_result(result)
+
+    def _evaluate(self, queries: list[tuple]) -> dict:
+        """
+        Evaluates the distinct queries of a batch.
+
+        A batch with a single distinct word is searched with get_topn or
+        get_within, which prune the lexicon. Otherwise the distances from all
+        distinct words to the lexicon are calculated with calculate_batch,
+        in chunks of rows, and each query selects its results from the row
+        of its word like the searches do. Words only queried with /within
+        are calculated with the largest of their distance budgets.
+
+        Returns:
+            dict: The results of every query, or the exception it raised.
+        """
+        calculator = self.calculator
+        table = calculator.distance_table
+        assert table is not None
+        results: dict[tuple, Any] = {}
+        # the largest max_distance of each word, or None if a query needs all distances
+        budgets: dict[str, float | None] = {}
+        for query in dict.fromkeys(queries):
+            kind, word, parameter = query
+            try:
+                table.encode(calculator.preprocess_func(word))
+            except ValueError as e:
+                results[query] = e
+                continue
+            budget = None if kind == "topn" else parameter
+            if word not in budgets:
+                budgets[word] = budget
+            else:
+                previous = budgets[word]
+                budgets[word] = (
+                    None
+                    if budget is None or previous is None
+                    else max(previous, budget)
+                )
+        pending = [query for query in dict.fromkeys(queries) if query not in results]
+        if len(budgets) == 1:
+            for query in pending:
+                results[query] = self._search(query)
+            return results
+
+        by_word: dict[str, list[tuple]] = {}
+        for query in pending:
+            by_word.setdefault(query[1], []).append(query)
+        size = len(self.index)
+        chunk = max(1, _BATCH_DISTANCES // max(1, size))
+        positions = np.arange(size)
+        for bounded in (False, True):
+            words = [w for w, budget in budgets.items() if (budget is None) != bounded]
+            max_distance = (
+                max(budget for budget in budgets.values() if budget is not None)
+                if bounded and words
+                else None
+            )
+            for start in range(0, len(words), chunk):
+                rows = words[start : start + chunk]
+                distances = calculator.calculate_batch(
+                    rows, self.index, as_array=True, max_distance=max_distance
+                )
+                assert isinstance(distances, np.ndarray)
+                for word, row in zip(rows, distances):
+                    for query in by_word[word]:
+                        kind, _, parameter = query
+                        if kind == "topn":
+                            if parameter <= 0:
+                                results[query] = []
+                                continue
+                            collector = _TopN(parameter)
+                        else:
+                            collector = _TopN(max_distance=parameter)
+                        collector.push(positions, row)
+                        results[query] = collector.results(self.index)
+        return results
+
+    def _search(self, query: tuple) -> Any:
+        """Evaluates one query with the pruned search, or returns its exception."""
+        kwargs: dict[str, Any] = {}
+        if isinstance(self.calculator, WeightedLevenshtein):
+            kwargs["method"] = self.method
+        kind, word, parameter = query
+        try:
+            if kind == "topn":
+                return self.calculator.get_topn(word, self.index, n=parameter, **kwargs)
+            return self.calculator.get_within(word, self.index, parameter, **kwargs)
+        except ValueError as e:
+            return e
+        except Exception as e:
+            logger.exception("failed to evaluate %r", query)
+            return e
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        start = time.perf_counter()
+        try:
+            try:
+                status, body = await self._respond(reader)
+            except (asyncio.IncompleteReadError, ConnectionError):
+                return
+            except Exception as e:
+                # Any other failure of a query is answered, not left hanging.
+                logger.exception("failed to answer a request")
+                status, body = HTTPStatus.INTERNAL_SERVER_ERROR, {"error": str(e)}
+            payload = json.dumps(body, ensure_ascii=False).encode("utf-8")
+            writer.write(
+                f"HTTP/1.1 {status.value} {status.phrase}\r\n"
+                "Content-Type: application/json; charset=utf-8\r\n"
+                f"Content-Length: {len(payload)}\r\n"
+                "Connection: close\r\n\r\n".encode("latin-1")
+                + payload
+            )
+            try:
+                await writer.drain()
+            except ConnectionError:
+                pass
+        finally:
+            writer.close()
+        self.latency.observe(time.perf_counter() - start)
+
+    async def _respond(self, reader: asyncio.StreamReader) -> tuple[HTTPStatus, dict]:
+        request_line = (await reader.readline()).decode("latin-1").split()
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+            name, _, value = line.decode("latin-1").partition(":")
+            headers[name.strip().lower()] = value.strip()
+        if len(request_line) != 3:
+            return HTTPStatus.BAD_REQUEST, {"error": "malformed request line"}
+        method, path, _ = request_line
+        path = path.split("?", 1)[0]
+
+        if path in ("/health", "/config", "/latency"):
+            if method != "GET":
+                return HTTPStatus.METHOD_NOT_ALLOWED, {"error": "use GET"}
+            if path == "/health":
+                return HTTPStatus.OK, {"status": "ok", "words": len(self.index)}
+            if path == "/config":
+                return HTTPStatus.OK, self.config()
+            return HTTPStatus.OK, {
+                **self.latency.snapshot(),
+                "batches": self.batches,
+                "queries": self.queries,
+            }
+        if path not in ("/topn", "/within"):
+            return HTTPStatus.NOT_FOUND, {"error": f"unknown path {path}"}
+        if method != "POST":
+            return HTTPStatus.METHOD_NOT_ALLOWED, {"error": "use POST"}
+
+        try:
+            length = int(headers.get("content-length", "0") or 0)
+            if length < 0:
+                raise ValueError("negative content-length")
+            if length > _MAX_BODY_SIZE:
+                return HTTPStatus.REQUEST_ENTITY_TOO_LARGE, {"error": "body too large"}
+            request = json.loads(await reader.readexactly(length))
+            word = request["word"]
+            if not isinstance(word, str):
+                raise TypeError("word must be a string")
+            if path == "/topn":
+                results = await self.topn(word, int(request.get("n", 10)))
+            else:
+                results = await self.within(word, float(request["max_distance"]))
+        except (ValueError, KeyError, TypeError) as e:
+            return HTTPStatus.BAD_REQUEST, {"error": str(e)}
+        # JSON has no infinity; unreachable words get null.
+        return HTTPStatus.OK, {
+            "results": [[w, None if math.isinf(d) else d] for w, d in results]
+        }
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description="Serve similarity queries against a word list over HTTP."
+    )
+    parser.add_argument("-w", "--wordlist", type=str, help="Path to the word list file")
+    parser.add_argument(
+        "-i",
+        "--index",
+        type=str,
+        default=None,
+        help="Path to a word index file, used instead of the word list",
+    )
+    parser.add_argument(
+        "-d",
+        "--distance_type",
+        type=str,
+        default="levenshtein",
+        choices=["levenshtein", "hamming"],
+        help="Distance type",
+    )
+    parser.add_argument("--host", type=str, default="127.0.0.1", help="Host")
+    parser.add_argument("--port", type=int, default=8000, help="Port")
+    parser.add_argument(
+        "--batch_window",
+        type=float,
+        default=0.002,
+        help="Seconds the first query of a batch waits for others",
+    )
+    parser.add_argument(
+        "--max_batch_size", type=int, default=64, help="Largest batch of queries"
+    )
+    args = parser.parse_args()
+    if args.wordlist is None and args.index is None:
+        parser.error("either --wordlist or --index is required")
+
+    calculator = create_kana_distance_calculator(distance_type=args.distance_type)
+    if args.index is not None:
+        wordlist = WordIndex.load(args.index, mmap=True)
+    else:
+        with open(args.wordlist, "r", encoding="utf-8") as f:
+            wordlist = f.read().splitlines()
+    server = QueryServer(
+        calculator,
+        wordlist,
+        host=args.host,
+        port=args.port,
+        batch_window=args.batch_window,
+        max_batch_size=args.max_batch_size,
+    )
+    print(f"Serving {len(server.index)} words on http://{args.host}:{args.port}")
+    try:
+        asyncio.run(server.serve_forever())
+    except KeyboardInterrupt:
+        pass
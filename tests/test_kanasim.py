@@ -1,12 +1,24 @@
 import random
 import time
+from typing import Any, cast
 
+import numpy as np
 import pytest
 
 from kanasim import (
+    CalculatorStats,
+    KanaDistanceTable,
+    MemoCache,
+    MetricIndex,
+    NeighborGraph,
     WeightedLevenshtein,
+    WordIndex,
+    clear_kana_distance_table_cache,
     create_kana_distance_calculator,
+    create_kana_distance_list,
+    create_kana_distance_table,
     extend_long_vowel_moras,
+    extend_long_vowel_moras_batch,
 )
 
 
@@ -32,6 +44,36 @@ def test_extend_long_vowel_moras_ignores_whitespace():
     assert extend_long_vowel_moras("カ ーン") == ["カー", "ン"]
 
 
+def _reference_extend_long_vowel_moras(text):
+    # the implementation on top of jamorasep.parse
+    import jamorasep
+
+    parsed_moras = jamorasep.parse("".join(text.split()), output_format="katakana")
+    extended_moras = []
+    for mora in parsed_moras:
+        if mora == "ー" and extended_moras:
+            extended_moras[-1] += mora
+        else:
+            extended_moras.append(mora)
+    return extended_moras
+
+
+def test_extend_long_vowel_moras_matches_jamorasep():
+    import os
+
+    path = os.path.join(os.path.dirname(__file__), "../data/sample/pronunciation.txt")
+    with open(path, encoding="utf-8") as f:
+        words = f.read().splitlines()
+    # small kana without a two-letter mora, hiragana, symbols and whitespace
+    rng = random.Random(0)
+    alphabet = "アカキャシュヴァィゥヮぁゃゎかきしょゔゖーッン ・a"
+    words += ["".join(rng.choices(alphabet, k=rng.randint(0, 8))) for _ in range(3000)]
+    expected = [_reference_extend_long_vowel_moras(word) for word in words]
+    assert [extend_long_vowel_moras(word) for word in words] == expected
+    assert extend_long_vowel_moras_batch(words) == expected
+    assert extend_long_vowel_moras_batch(iter(["カー", "カー"])) == [["カー"], ["カー"]]
+
+
 def test_calculate_with_whitespace():
     calculator = create_kana_distance_calculator()
     assert calculator.calculate("ウェンザ ナイ", "ウェンザナイ") == 0
@@ -217,6 +259,896 @@ def test_calculate_matches_reference_implementation():
         assert calculator.calculate(word1, word2) == pytest.approx(expected)
 
 
+def test_kana_distance_table():
+    table = create_kana_distance_table()
+    assert isinstance(table, KanaDistanceTable)
+    assert table.matrix.shape == (len(table.kanas), len(table.kanas))
+    assert table.kanas[table.sp_id] == "sp"
+    ids = table.encode(["カー", "ン", "シャ"])
+    assert [table.kanas[i] for i in ids] == ["カー", "ン", "シャ"]
+    assert table.matrix[ids[0], ids[2]] == table.distance("カー", "シャ")
+    with pytest.raises(ValueError, match="distance table"):
+        table.encode(["カ", "ａ"])
+
+
+def test_calculator_uses_distance_table():
+    calculator = create_kana_distance_calculator()
+    assert isinstance(calculator, WeightedLevenshtein)
+    table = calculator.distance_table
+    insert_cost_func = calculator.insert_cost_func
+    delete_cost_func = calculator.delete_cost_func
+    replace_cost_func = calculator.replace_cost_func
+    assert table is not None
+    assert insert_cost_func is not None and delete_cost_func is not None
+    assert replace_cost_func is not None
+    # the compatibility cost functions read the same table
+    assert insert_cost_func("カ") == table.distance("sp", "カ")
+    assert delete_cost_func("カ") == table.distance("カ", "sp")
+    assert replace_cost_func("カ", "サ") == table.distance("カ", "サ")
+    # the table-based kernel matches the cost-function-based one exactly
+    generic = WeightedLevenshtein(
+        insert_cost_func=insert_cost_func,
+        delete_cost_func=delete_cost_func,
+        replace_cost_func=replace_cost_func,
+        preprocess_func=extend_long_vowel_moras,
+    )
+    for word1, word2 in [("カナダ", "バハマ"), ("ウェンザ", "ウェザー"), ("", "カ")]:
+        assert calculator.calculate(word1, word2) == generic.calculate(word1, word2)
+
+
+def _random_katakana_words(seed, count, max_length=6):
+    rng = random.Random(seed)
+    katakana = (
+        "アイウエオカキクケコサシスセソタチツテトナニヌネノハヒフヘホヤユヨランッー"
+    )
+    return [
+        "".join(rng.choices(katakana, k=rng.randint(0, max_length))).lstrip("ー")
+        for _ in range(count)
+    ]
+
+
+def test_calculate_batch_matches_calculate():
+    calculator = create_kana_distance_calculator()
+    words1 = _random_katakana_words(1, 8)
+    words2 = _random_katakana_words(2, 50)
+    results = calculator.calculate_batch(words1, words2)
+    for i, word1 in enumerate(words1):
+        for j, word2 in enumerate(words2):
+            assert results[i][j] == calculator.calculate(word1, word2)
+
+
+def test_calculate_batch_array_output():
+    calculator = create_kana_distance_calculator()
+    words1 = ["カナダ", "タハラ"]
+    words2 = ["カナダ", "バハマ", "カナタ", "ア", ""]
+    expected = calculator.calculate_batch(words1, words2)
+    array = calculator.calculate_batch(words1, words2, as_array=True)
+    assert isinstance(array, np.ndarray)
+    assert array.dtype == np.float64
+    assert array.tolist() == expected
+    out = np.full((2, 5), -1.0)
+    assert calculator.calculate_batch(words1, words2, out=out) is out
+    assert out.tolist() == expected
+    with pytest.raises(ValueError, match="shape"):
+        calculator.calculate_batch(words1, words2, out=np.empty((5, 2)))
+
+
+def test_memo_cache_evicts_least_recently_used():
+    memo = MemoCache(max_entries=2)
+    key1 = memo.make_encoded_key([1, 2], [3])
+    key2 = memo.make_encoded_key([1], [2, 3])
+    key3 = memo.make_encoded_key([4], [5])
+    assert key1 != key2
+    memo.set(key1, 1.0)
+    memo.set(key2, 2.0)
+    assert memo.get(key1) == 1.0  # key2 is now the least recently used
+    memo.set(key3, 3.0)
+    assert memo.get(key2) is None
+    assert memo.get(key3) == 3.0
+    assert memo.stats() == {
+        "entries": 2,
+        "nbytes": memo.nbytes,
+        "hits": 2,
+        "misses": 1,
+        "evictions": 1,
+    }
+    memo.clear()
+    assert len(memo) == 0
+    assert memo.nbytes == 0
+
+
+def test_memo_cache_byte_budget():
+    memo = MemoCache(max_entries=None, max_bytes=2000)
+    for i in range(100):
+        memo.set(memo.make_encoded_key([i], [i]), float(i))
+    assert 0 < memo.nbytes <= 2000
+    assert memo.evictions == 100 - len(memo)
+
+
+def test_calculator_memo_options():
+    memo = MemoCache(max_entries=10)
+    calculator = create_kana_distance_calculator(memo=memo)
+    assert calculator.memo is memo
+    first = calculator.calculate("カナダ", "バハマ")
+    assert calculator.calculate("カナダ", "バハマ") == first
+    assert memo.hits == 1
+    assert memo.misses == 1
+    disabled = create_kana_distance_calculator(memo=False)
+    assert disabled.memo is None
+    assert disabled.calculate("カナダ", "バハマ") == first
+
+
+def test_hamming_memo_is_opt_in():
+    calculator = create_kana_distance_calculator(distance_type="hamming")
+    assert calculator.memo is None
+    expected = calculator.calculate("カナダ", "バハマ")
+    memo = MemoCache(max_entries=10)
+    memoized = create_kana_distance_calculator(distance_type="hamming", memo=memo)
+    assert memoized.calculate("カナダ", "バハマ") == expected
+    assert memoized.calculate("カナダ", "バハマ") == expected
+    assert (memo.hits, memo.misses) == (1, 1)
+    assert calculator.calculate("カナダ", "バハ") == float("inf")
+    with pytest.raises(ValueError):
+        calculator.calculate("カナダ", "カナa")
+
+
+def test_kana_distance_table_save_and_load(tmp_path, monkeypatch):
+    import os
+
+    table = create_kana_distance_table(symmetric=True)
+    path = str(tmp_path / "table.bin")
+    table.save(path)
+    for mmap in (False, True):
+        loaded = KanaDistanceTable.load(path, mmap=mmap)
+        assert loaded.kanas == table.kanas
+        assert np.array_equal(loaded.matrix, table.matrix)
+        assert loaded.vowel_matrix is not None and table.vowel_matrix is not None
+        assert np.array_equal(loaded.vowel_matrix, table.vowel_matrix)
+    KanaDistanceTable(table.kanas, table.matrix).save(path)
+    assert KanaDistanceTable.load(path).vowel_matrix is None
+    (tmp_path / "broken.bin").write_bytes(b"not a table")
+    with pytest.raises(ValueError, match="not a kana distance table"):
+        KanaDistanceTable.load(str(tmp_path / "broken.bin"))
+
+    # a failed write leaves neither a partial file nor a temporary one
+    def fail(src, dst):
+        raise OSError("disk full")
+
+    files = sorted(tmp_path.iterdir())
+    with monkeypatch.context() as m:
+        m.setattr(os, "replace", fail)
+        with pytest.raises(OSError):
+            table.save(str(tmp_path / "failed.bin"))
+    assert sorted(tmp_path.iterdir()) == files
+
+
+def test_kana_distance_table_cache(tmp_path, monkeypatch):
+    import os
+    import shutil
+
+    import kanasim
+
+    data_dir = os.path.join(os.path.dirname(kanasim.__file__), "data/biphone")
+    for name in ["kana2phonome_bi.csv", "distance_vowels_bi.csv"]:
+        shutil.copy(os.path.join(data_dir, name), tmp_path / name)
+    cache_dir = tmp_path / "cache"
+
+    def create(
+        cache_dir: str | None = str(cache_dir), vowel_ratio: float = 0.5
+    ) -> KanaDistanceTable:
+        return create_kana_distance_table(
+            kana2phonome_csv=str(tmp_path / "kana2phonome_bi.csv"),
+            distance_vowels_csv=str(tmp_path / "distance_vowels_bi.csv"),
+            vowel_ratio=vowel_ratio,
+            cache_dir=cache_dir,
+        )
+
+    built = create()
+    assert len(list(cache_dir.iterdir())) == 1
+
+    # A second call with the same inputs loads the file without parsing the CSVs.
+    def fail(**kwargs):
+        raise AssertionError("the cached table should have been used")
+
+    clear_kana_distance_table_cache()
+    with monkeypatch.context() as m:
+        m.setattr(kanasim.kanasim, "_kana_distance_matrix", fail)
+        cached = create()
+        assert np.array_equal(cached.matrix, built.matrix)
+        # the environment variable enables the cache as well
+        m.setenv("KANASIM_CACHE_DIR", str(cache_dir))
+        clear_kana_distance_table_cache()
+        create(cache_dir=None)
+
+    # Changing a parameter or a source CSV invalidates the cached table.
+    create(vowel_ratio=0.3)
+    assert len(list(cache_dir.iterdir())) == 2
+    with open(tmp_path / "distance_vowels_bi.csv", "a", encoding="utf-8") as f:
+        f.write("x-a,x-a,1.0\n")
+    create()
+    assert len(list(cache_dir.iterdir())) == 3
+
+
+def test_create_kana_distance_list():
+    import os
+
+    import kanasim
+
+    data_dir = os.path.join(os.path.dirname(kanasim.__file__), "data/biphone")
+    distance_list = create_kana_distance_list(
+        kana2phonome_csv=os.path.join(data_dir, "kana2phonome_bi.csv"),
+        distance_consonants_csv=os.path.join(data_dir, "distance_consonants_bi.csv"),
+        distance_vowels_csv=os.path.join(data_dir, "distance_vowels_bi.csv"),
+        vowel_ratio=0.5,
+        non_syllabic_penalty=0.2,
+        insert_penalty=2.0,
+        delete_penalty=1.0,
+        replace_penalty=1.0,
+        same_phonome_offset=True,
+        consonant_binary=False,
+        vowel_binary=False,
+    )
+
+    def create(
+        insert_penalty: float = 2.0, non_syllabic_penalty: float = 0.2
+    ) -> KanaDistanceTable:
+        return create_kana_distance_table(
+            vowel_ratio=0.5,
+            non_syllabic_penalty=non_syllabic_penalty,
+            insert_penalty=insert_penalty,
+            delete_penalty=1.0,
+            replace_penalty=1.0,
+            same_phonome_offset=True,
+            consonant_binary=False,
+            vowel_binary=False,
+        )
+
+    table = create()
+    n = len(table.kanas)
+    assert len(distance_list) == n * n
+    rows = list(distance_list)
+    assert rows[n + 2] == distance_list[n + 2]
+    assert distance_list[n + 2] == {
+        "kana1": table.kanas[1],
+        "kana2": table.kanas[2],
+        "distance": table.matrix[1, 2],
+    }
+    assert distance_list[-1] == rows[-1]
+    assert distance_list[3:6] == rows[3:6]
+    assert distance_list == rows
+    assert np.array_equal(
+        KanaDistanceTable.from_distance_list(rows).matrix, table.matrix
+    )
+    # a missing pair is not read as a perfect match
+    with pytest.raises(ValueError, match="missing"):
+        KanaDistanceTable.from_distance_list(rows[1:])
+
+    # the penalties of insertions and of non-syllabic pairs
+    plain = create(insert_penalty=1.0)
+    assert table.distance("sp", "カ") == 2 * plain.distance("sp", "カ")
+    assert table.distance("カ", "sp") == plain.distance("カ", "sp")
+    unpenalized = create(insert_penalty=1.0, non_syllabic_penalty=1.0)
+    assert table.distance("ン", "ッ") == pytest.approx(
+        0.2 * unpenalized.distance("ン", "ッ")
+    )
+    assert table.distance("sp", "sp") == unpenalized.distance("sp", "sp")
+
+
+def test_calculators_share_distance_tables():
+    levenshtein = create_kana_distance_calculator(vowel_ratio=0.3)
+    hamming = create_kana_distance_calculator(vowel_ratio=0.3, distance_type="hamming")
+    other = create_kana_distance_calculator(vowel_ratio=0.4)
+    assert levenshtein.distance_table is hamming.distance_table
+    assert levenshtein.distance_table is not other.distance_table
+    table = levenshtein.distance_table
+    assert table is not None
+    with pytest.raises(ValueError):
+        table.matrix[0, 0] = 1.0
+    clear_kana_distance_table_cache()
+    rebuilt = create_kana_distance_calculator(vowel_ratio=0.3)
+    assert rebuilt.distance_table is not table
+    assert levenshtein.calculate("カナダ", "バハマ") == rebuilt.calculate(
+        "カナダ", "バハマ"
+    )
+
+
+@pytest.mark.parametrize("distance_type", ["levenshtein", "hamming"])
+def test_get_topn_matches_full_sort(distance_type):
+    calculator = create_kana_distance_calculator(distance_type=distance_type)
+    # duplicates produce ties, which must keep the list order
+    wordlist = _random_katakana_words(3, 150, max_length=4) * 2
+    for word in ["カナダ", "ア", "", wordlist[7]]:
+        distances = calculator.calculate_batch([word], wordlist)[0]
+        expected = sorted(zip(wordlist, distances), key=lambda x: x[1])
+        for n in [1, 3, 10, len(wordlist) + 5]:
+            assert calculator.get_topn(word, wordlist, n=n) == expected[:n]
+
+
+@pytest.mark.parametrize("distance_type", ["levenshtein", "hamming"])
+def test_get_within_matches_filtering(distance_type):
+    calculator = create_kana_distance_calculator(distance_type=distance_type)
+    wordlist = _random_katakana_words(4, 150, max_length=4) * 2
+    for word in ["カナダ", "ア", wordlist[3]]:
+        distances = calculator.calculate_batch([word], wordlist)[0]
+        for max_distance in [0.0, 5.0, 20.0, float("inf")]:
+            expected = sorted(
+                [(w, d) for w, d in zip(wordlist, distances) if d <= max_distance],
+                key=lambda x: x[1],
+            )
+            assert calculator.get_within(word, wordlist, max_distance) == expected
+            stats = calculator.pruning_stats
+            assert stats["candidates"] == len(wordlist)
+            pruned = stats["length_bound"] + stats["mora_bound"]
+            assert pruned + stats["evaluated"] == len(wordlist)
+            assert stats["abandoned"] <= stats["evaluated"]
+
+
+def test_get_topn_prunes_by_lower_bounds():
+    calculator = create_kana_distance_calculator()
+    rng = random.Random(5)
+    wordlist = [
+        "".join(rng.choices("アイウエオカキクケコサシスセソタチツテトナニヌネノ", k=k))
+        for k in rng.choices(range(1, 9), k=2000)
+    ]
+    calculator.get_topn("カナダ", wordlist, n=5)
+    stats = calculator.pruning_stats
+    assert stats["length_bound"] + stats["mora_bound"] > 0
+    assert stats["evaluated"] < len(wordlist)
+
+
+@pytest.mark.parametrize("distance_type", ["levenshtein", "hamming"])
+def test_word_index(tmp_path, distance_type):
+    calculator = create_kana_distance_calculator(distance_type=distance_type)
+    wordlist = [
+        "カナダ",
+        "バハマ",
+        "タバタ",
+        "",
+        "カナタ",
+        "カラダ",
+        "カドマ",
+        "ラーメン",
+    ]
+    table = calculator.distance_table
+    assert table is not None
+    index = WordIndex.build(wordlist, table, calculator.preprocess_func)
+    path = str(tmp_path / "words.bin")
+    index.save(path)
+    for loaded in [index, WordIndex.load(path), WordIndex.load(path, mmap=True)]:
+        assert list(loaded) == wordlist
+        assert loaded[-1] == "ラーメン"
+        assert loaded.lengths.tolist() == [3, 3, 3, 0, 3, 3, 3, 3]
+        assert calculator.calculate_batch(
+            ["カナダ", "ア"], loaded
+        ) == calculator.calculate_batch(["カナダ", "ア"], wordlist)
+        assert calculator.get_topn("カナダ", loaded, n=3) == calculator.get_topn(
+            "カナダ", wordlist, n=3
+        )
+        assert calculator.get_within("カナダ", loaded, 10.0) == calculator.get_within(
+            "カナダ", wordlist, 10.0
+        )
+
+    # an index encoded with another table is rejected
+    table = KanaDistanceTable(["sp", "カ", "ナ", "ダ"], np.zeros((4, 4)))
+    with pytest.raises(ValueError):
+        calculator.get_topn("カナダ", WordIndex.build(["カナダ"], table))
+
+
+def test_trie_search_matches_full_sort():
+    calculator = create_kana_distance_calculator()
+    assert isinstance(calculator, WeightedLevenshtein)
+    # shared prefixes, duplicates and the empty word
+    wordlist = _random_katakana_words(6, 150, max_length=4) * 2
+    wordlist += [w + "カ" for w in wordlist[:50]] + [""]
+    table = calculator.distance_table
+    assert table is not None
+    index = WordIndex.build(wordlist, table, calculator.preprocess_func)
+    for word in ["カナダ", "ア", "", wordlist[7]]:
+        distances = calculator.calculate_batch([word], wordlist)[0]
+        expected = sorted(zip(wordlist, distances), key=lambda x: x[1])
+        for words in [wordlist, index]:
+            for n in [1, 3, 10, len(wordlist) + 5]:
+                topn = calculator.get_topn(word, words, n=n, method="trie")
+                assert topn == expected[:n]
+            within = calculator.get_within(word, words, 8.0, method="trie")
+            assert within == [x for x in expected if x[1] <= 8.0]
+    with pytest.raises(ValueError):
+        calculator.get_topn("カナダ", wordlist, method=cast(Any, "unknown"))
+
+
+@pytest.mark.parametrize("distance_type", ["levenshtein", "hamming"])
+def test_max_distance(distance_type):
+    calculator = create_kana_distance_calculator(distance_type=distance_type)
+    words1 = _random_katakana_words(3, 10)
+    words2 = _random_katakana_words(3, 100)
+    distances = calculator.calculate_batch(words1, words2, as_array=True)
+    assert isinstance(distances, np.ndarray)
+    finite = distances[np.isfinite(distances)]
+    for max_distance in [0.0, 5.0, float(np.median(finite)), float(finite.max())]:
+        expected = np.where(distances <= max_distance, distances, np.inf)
+        bounded = calculator.calculate_batch(
+            words1, words2, as_array=True, max_distance=max_distance
+        )
+        assert np.array_equal(bounded, expected)
+        for i, word1 in enumerate(words1[:3]):
+            for j, word2 in enumerate(words2):
+                distance = calculator.calculate(word1, word2, max_distance)
+                assert distance == expected[i, j]
+
+
+def test_max_distance_long_input():
+    calculator = create_kana_distance_calculator(memo=False)
+    word1 = "カ" * 300 + "ナ" * 300
+    word2 = "カ" * 300 + "サ" * 300
+    distance = calculator.calculate(word1, word2)
+    assert calculator.calculate(word1, word2, max_distance=distance) == distance
+    assert calculator.calculate(word1, word2, max_distance=distance / 2) == np.inf
+    assert calculator.calculate(word1, word1 * 2, max_distance=distance) == np.inf
+
+
+def test_find():
+    calculator = create_kana_distance_calculator()
+    assert isinstance(calculator, WeightedLevenshtein)
+    spans = calculator.find("カナダ", "カナダト カラダト サカナダ")
+    # whitespace is removed, and overlapping spans are reduced to the best one
+    assert spans == [
+        {"start": 0, "end": 3, "span": "カナダ", "distance": 0.0},
+        {"start": 9, "end": 12, "span": "カナダ", "distance": 0.0},
+        {"start": 4, "end": 7, "span": "カラダ", "distance": 3.967136},
+    ]
+    assert len(calculator.find("カナダ", "カナダト カラダト サカナダ", n=2)) == 2
+    within = calculator.find("カナダ", "カナダト カラダト サカナダ", max_distance=5.0)
+    assert [span["span"] for span in within] == ["カナダ", "カナダ", "カラダ"]
+
+    words = _random_katakana_words(3, 100)
+    texts = ["".join(words[i : i + 8]) for i in range(0, 100, 8)] + [""]
+    phrase = "カナダノ"
+    results = calculator.find_batch(phrase, texts, n=3)
+    for text, spans in zip(texts, results):
+        assert calculator.find(phrase, text, n=3) == spans
+        moras = extend_long_vowel_moras(text)
+        for span in spans:
+            assert span["span"] == "".join(moras[span["start"] : span["end"]])
+            assert calculator.calculate(phrase, span["span"]) == span["distance"]
+        if moras:
+            # no substring is closer than the best span
+            best = min(
+                calculator.calculate(phrase, "".join(moras[start:end]))
+                for start in range(len(moras))
+                for end in range(start + 1, len(moras) + 1)
+            )
+            assert spans[0]["distance"] == best
+    assert results[-1] == []
+
+
+def test_align():
+    calculator = create_kana_distance_calculator()
+    assert isinstance(calculator, WeightedLevenshtein)
+    steps = calculator.align("カナダ", "カラダ")
+    assert [step["operation"] for step in steps] == ["match", "replace", "match"]
+    assert (steps[1]["mora1"], steps[1]["mora2"]) == ("ナ", "ラ")
+    for step in steps:
+        assert step["consonant_cost"] + step["vowel_cost"] == pytest.approx(
+            step["cost"]
+        )
+
+    word = "カナダ"
+    wordlist = _random_katakana_words(3, 100) + ["", word]
+    distances = calculator.calculate_batch([word], wordlist)[0]
+    alignments = calculator.align_batch(word, wordlist)
+    for other, distance, steps in zip(wordlist, distances, alignments):
+        # the batch alignments repeat the additions of the DP
+        total = 0.0
+        for step in steps:
+            total += step["cost"]
+        assert total == distance
+        assert sum(step["mora2"] is not None for step in steps) == len(
+            extend_long_vowel_moras(other)
+        )
+        linear = calculator.align(word, other)
+        assert sum(step["cost"] for step in linear) == pytest.approx(distance)
+
+    # linear space, beyond the size of a full DP table
+    steps = calculator.align("カ" * 600, "サ" * 600)
+    assert len(steps) == 600
+    assert sum(step["cost"] for step in steps) == pytest.approx(
+        calculator.calculate("カ" * 600, "サ" * 600)
+    )
+
+    plain = WeightedLevenshtein(
+        preprocess_func=list,
+        replace_cost_func=lambda a, b: 0.0 if a == b else 1.0,
+    )
+    steps = plain.align("kitten", "sitting")
+    assert sum(step["cost"] for step in steps) == 3.0
+    assert steps[0]["vowel_cost"] is None
+    assert plain.align_batch("kitten", ["sitting"]) == [steps]
+
+
+def test_metric_index(tmp_path):
+    wordlist = _random_katakana_words(1, 300, max_length=5) * 2
+    # binary distances satisfy the triangle inequality
+    calculator = create_kana_distance_calculator(
+        symmetric=True, vowel_binary=True, consonant_binary=True
+    )
+    assert isinstance(calculator, WeightedLevenshtein)
+    index = MetricIndex.build(calculator, wordlist, leaf_size=8)
+    assert index.exact and index.triangle_violation == 0.0
+    path = str(tmp_path / "metric.bin")
+    index.save(path)
+    loaded = MetricIndex.load(path, calculator, mmap=True)
+    for word in ["カナダ", "ア", "", wordlist[3]]:
+        for metric_index in [index, loaded]:
+            topn = metric_index.get_topn(word, n=5)
+            assert topn == calculator.get_topn(word, wordlist, n=5)
+            within = metric_index.get_within(word, 2.0)
+            assert within == calculator.get_within(word, wordlist, 2.0)
+        stats = index.pruning_stats
+        assert stats["triangle_bound"] + stats["evaluated"] == len(wordlist)
+
+    calculator = create_kana_distance_calculator(symmetric=True)
+    assert isinstance(calculator, WeightedLevenshtein)
+    with pytest.raises(ValueError):
+        MetricIndex.build(calculator, wordlist)
+    index = MetricIndex.build(calculator, wordlist, leaf_size=8, approximate=True)
+    assert not index.exact
+    assert index.recall is not None and 0.0 <= index.recall <= 1.0
+    with pytest.raises(ValueError):
+        MetricIndex.load(path, calculator)
+    calculator = create_kana_distance_calculator()
+    assert isinstance(calculator, WeightedLevenshtein)
+    with pytest.raises(ValueError):
+        MetricIndex.build(calculator, wordlist)
+
+
+def test_neighbor_graph(tmp_path):
+    wordlist = _random_katakana_words(1, 300)
+    for calculator in [
+        create_kana_distance_calculator(),
+        create_kana_distance_calculator(distance_type="hamming"),
+    ]:
+        graph = NeighborGraph.build(
+            calculator, wordlist, k=5, recall_queries=len(wordlist)
+        )
+        assert graph.neighbors.shape == graph.distances.shape == (300, 5)
+        assert graph.recall is not None and graph.recall >= 0.9
+        for i in [0, 7, 42]:
+            neighbors = graph.get_neighbors(i)
+            assert neighbors
+            distances = [distance for _, distance in neighbors]
+            assert distances == sorted(distances)
+            for word, distance in neighbors:
+                expected = calculator.calculate(wordlist[i], word)
+                assert distance == pytest.approx(expected, rel=1e-6)
+
+    path = str(tmp_path / "graph.bin")
+    graph.save(path)
+    loaded = NeighborGraph.load(path, mmap=True)
+    assert np.array_equal(loaded.neighbors, graph.neighbors)
+    assert np.array_equal(loaded.distances, graph.distances)
+    assert loaded.recall == graph.recall
+    assert list(loaded.edges()) == list(graph.edges())
+    assert len(list(graph.edges())) == np.count_nonzero(graph.neighbors >= 0)
+
+    # fewer words than neighbors
+    calculator = create_kana_distance_calculator()
+    graph = NeighborGraph.build(calculator, ["カナダ", "カナタ", "サラダ"], k=5)
+    assert graph.recall == 1.0
+    assert [len(graph.get_neighbors(i)) for i in range(3)] == [2, 2, 2]
+    with pytest.raises(ValueError):
+        NeighborGraph.build(WeightedLevenshtein(), wordlist)
+
+
+def test_hamming_search_large_bucket():
+    calculator = create_kana_distance_calculator(distance_type="hamming")
+    rng = random.Random(8)
+    # a large bucket of one length with many ties, and a few other lengths
+    wordlist = ["".join(rng.choices("カナダタラ", k=3)) for _ in range(3000)]
+    wordlist += ["カナ", "カナダカ", ""]
+    table = calculator.distance_table
+    assert table is not None
+    index = WordIndex.build(wordlist, table, calculator.preprocess_func)
+    distances = calculator.calculate_batch(["カナダ"], wordlist)[0]
+    expected = sorted(zip(wordlist, distances), key=lambda x: x[1])
+    for words in [wordlist, index]:
+        for n in [1, 5, 40, len(wordlist)]:
+            assert calculator.get_topn("カナダ", words, n=n) == expected[:n]
+        within = calculator.get_within("カナダ", words, 3.0)
+        assert within == [x for x in expected if x[1] <= 3.0]
+        assert calculator.pruning_stats["length_bound"] == 3
+
+
+@pytest.mark.parametrize("distance_type", ["levenshtein", "hamming"])
+def test_n_jobs_matches_serial(distance_type):
+    calculator = create_kana_distance_calculator(distance_type=distance_type)
+    wordlist = _random_katakana_words(3, 150, max_length=4) * 2
+    table = calculator.distance_table
+    assert table is not None
+    index = WordIndex.build(wordlist, table, calculator.preprocess_func)
+    expected = calculator.calculate_batch(wordlist[:20], wordlist)
+    assert calculator.calculate_batch(wordlist[:20], wordlist, n_jobs=2) == expected
+    out = np.empty((len(index), len(index)))
+    calculator.calculate_batch(index, index, out=out, n_jobs=3)
+    assert out[:20].tolist() == expected
+    for words in [wordlist, index]:
+        for word in ["カナダ", "ア", wordlist[7]]:
+            topn = calculator.get_topn(word, words, n=5, n_jobs=2)
+            assert topn == calculator.get_topn(word, words, n=5)
+            assert calculator.pruning_stats["candidates"] == len(wordlist)
+            within = calculator.get_within(word, words, 5.0, n_jobs=2)
+            assert within == calculator.get_within(word, words, 5.0)
+    with pytest.raises(ValueError):
+        calculator.get_topn("カナa", wordlist, n_jobs=2)
+
+
+@pytest.mark.parametrize("distance_type", ["levenshtein", "hamming"])
+def test_streaming(tmp_path, distance_type):
+    calculator = create_kana_distance_calculator(distance_type=distance_type)
+    wordlist = _random_katakana_words(3, 150, max_length=4) * 2
+    path = tmp_path / "words.txt"
+    path.write_text("\n".join(wordlist) + "\n", encoding="utf-8")
+    for word in ["カナダ", "ア", wordlist[7]]:
+        for n in [1, 5, len(wordlist) + 5]:
+            expected = calculator.get_topn(word, wordlist, n=n)
+            for words in [str(path), path, iter(wordlist)]:
+                topn = calculator.get_topn_stream(word, words, n=n, chunk_size=16)
+                assert topn == expected
+    chunks = list(calculator.iter_distances("カナダ", path, chunk_size=100))
+    assert [len(chunk) for chunk in chunks] == [100, 100, 100]
+    distances = calculator.calculate_batch(["カナダ"], wordlist)[0]
+    assert [pair for chunk in chunks for pair in chunk] == list(
+        zip(wordlist, distances)
+    )
+
+
+@pytest.mark.parametrize("distance_type", ["levenshtein", "hamming"])
+def test_calculator_stats(distance_type):
+    assert create_kana_distance_calculator(distance_type=distance_type).stats is None
+    records = []
+    stats = CalculatorStats(on_record=records.append)
+    calculator = create_kana_distance_calculator(
+        distance_type=distance_type, memo=True, stats=stats
+    )
+    cells = 9 if distance_type == "levenshtein" else 3
+    calculator.calculate("カナダ", "カラダ")
+    assert records[-1]["operation"] == "calculate"
+    assert records[-1]["dp_cells"] == cells
+    assert records[-1]["memo_misses"] == 1
+    calculator.calculate("カナダ", "カラダ")
+    assert records[-1]["dp_cells"] == 0
+    assert records[-1]["memo_hits"] == 1
+
+    wordlist = _random_katakana_words(3, 150, max_length=4)
+    lengths = [len(calculator.preprocess_func(word)) for word in wordlist]
+    calculator.calculate_batch(["カナダ"], wordlist)
+    if distance_type == "levenshtein":
+        assert records[-1]["dp_cells"] == 3 * sum(lengths)
+    else:
+        assert records[-1]["dp_cells"] == 3 * lengths.count(3)
+    calculator.calculate_batch(["カナダ"], wordlist, n_jobs=2)
+    assert records[-1]["dp_cells"] == records[-2]["dp_cells"]
+    for word in ["カナダ", wordlist[7]]:
+        calculator.get_topn(word, wordlist, n=5)
+        pruning_stats = calculator.pruning_stats
+        assert records[-1]["operation"] == "get_topn"
+        assert records[-1]["candidates"] == len(wordlist)
+        assert records[-1]["dp_cells"] == pruning_stats["dp_cells"]
+        assert records[-1]["pruned"] == (
+            len(wordlist) - pruning_stats["evaluated"] + pruning_stats["abandoned"]
+        )
+    calculator.get_within("カナダ", wordlist, 5.0)
+    calculator.get_topn_stream("カナダ", wordlist, n=5, chunk_size=16)
+    assert records[-1]["operation"] == "get_topn_stream"
+    assert records[-1]["candidates"] == len(wordlist)
+
+    assert stats.last is records[-1]
+    assert stats.calls == len(records) == 8
+    totals = stats.snapshot()
+    for name in ["dp_cells", "memo_hits", "candidates", "pruned"]:
+        assert totals[name] == sum(record[name] for record in records)
+    assert totals["preprocess_time"] > 0
+    assert totals["dp_time"] > 0
+    stats.reset()
+    assert stats.calls == 0
+    assert stats.dp_cells == 0
+
+
+def test_calculate_matrix(tmp_path):
+    words = _random_katakana_words(1, 150)
+    path = str(tmp_path / "matrix.npy")
+    for symmetric in [False, True]:
+        calculator = create_kana_distance_calculator(symmetric=symmetric)
+        expected = calculator.calculate_batch(words, words, as_array=True)
+        assert isinstance(expected, np.ndarray)
+        calls = []
+        matrix = calculator.calculate_matrix(
+            words,
+            path,
+            tile_size=32,
+            progress=lambda *args, calls=calls: calls.append(args),
+        )
+        assert np.array_equal(matrix, expected)
+        # only the upper triangle of the 5 x 5 tiles when symmetric
+        assert calls[-1] == ((15, 15) if symmetric else (25, 25))
+        assert np.array_equal(np.load(path), expected)
+    matrix = calculator.calculate_matrix(words, path, dtype="float32")
+    assert matrix.dtype == np.float32
+    assert np.array_equal(matrix, expected.astype(np.float32))
+
+    class Interrupted(Exception):
+        pass
+
+    def interrupt(completed, total):
+        if completed == 4:
+            raise Interrupted
+
+    with pytest.raises(Interrupted):
+        calculator.calculate_matrix(words, path, tile_size=32, progress=interrupt)
+    calls = []
+    matrix = calculator.calculate_matrix(
+        words, path, tile_size=32, progress=lambda *args: calls.append(args)
+    )
+    assert calls[0] == (4, 15)
+    assert np.array_equal(matrix, expected)
+    assert not (tmp_path / "matrix.npy.progress").exists()
+
+
+def test_query_server(monkeypatch):
+    import asyncio
+    import json
+    import urllib.error
+    import urllib.request
+
+    from kanasim.server import QueryServer
+
+    calculator = create_kana_distance_calculator()
+    wordlist = _random_katakana_words(3, 150, max_length=4)
+
+    def request(port, path, body=None):
+        data = None if body is None else json.dumps(body).encode("utf-8")
+        url = f"http://127.0.0.1:{port}{path}"
+        try:
+            with urllib.request.urlopen(url, data=data, timeout=10) as response:
+                return response.status, json.loads(response.read())
+        except urllib.error.HTTPError as e:
+            return e.code, json.loads(e.read())
+
+    async def main():
+        server = QueryServer(calculator, wordlist, port=0, batch_window=0.01)
+        port = await server.start()
+        loop = asyncio.get_running_loop()
+
+        def call(path, body=None):
+            return loop.run_in_executor(None, request, port, path, body)
+
+        try:
+            # queries queued together are evaluated in one batch
+            words = ["カナダ", "ア", "カナダ"]
+            results = await asyncio.gather(*[server.topn(w, n=3) for w in words])
+            assert (
+                results[0] == results[2] == calculator.get_topn("カナダ", wordlist, n=3)
+            )
+            assert (server.batches, server.queries) == (1, 3)
+
+            # distinct words of a batch share one calculate_batch pass
+            queries = [
+                server.topn("カナダ", n=5),
+                server.within("アメリカ", 6.0),
+                server.topn("アメリカ", n=2),
+                server.within("カナダ", 4.0),
+                server.topn("ア", n=0),
+            ]
+            batched = await asyncio.gather(*queries)
+            assert batched == [
+                calculator.get_topn("カナダ", wordlist, n=5),
+                calculator.get_within("アメリカ", wordlist, 6.0),
+                calculator.get_topn("アメリカ", wordlist, n=2),
+                calculator.get_within("カナダ", wordlist, 4.0),
+                [],
+            ]
+            assert (server.batches, server.queries) == (2, 8)
+            with pytest.raises(ValueError):
+                await asyncio.gather(server.topn("カナa"), server.topn("カナダ"))
+
+            # a failing batch does not stop the batcher
+            monkeypatch.setattr(server, "_evaluate", lambda queries: 1 / 0)
+            with pytest.raises(ZeroDivisionError):
+                await server.topn("カナダ")
+            monkeypatch.undo()
+            assert await server.topn("カナダ", n=3) == results[0]
+
+            status, body = await call("/topn", {"word": "カナダ", "n": 3})
+            assert status == 200
+            assert [tuple(x) for x in body["results"]] == results[0]
+            status, body = await call(
+                "/within", {"word": "カナダ", "max_distance": 5.0}
+            )
+            expected = calculator.get_within("カナダ", wordlist, 5.0)
+            assert [tuple(x) for x in body["results"]] == expected
+            assert await call("/health") == (200, {"status": "ok", "words": 150})
+            assert (await call("/config"))[1]["distance_type"] == "levenshtein"
+            status, latency = await call("/latency")
+            assert latency["count"] == 4
+            assert sum(bucket["count"] for bucket in latency["buckets"]) == 4
+            assert (await call("/topn", {"word": "カナa"}))[0] == 400
+            assert (await call("/topn", {"n": 3}))[0] == 400
+            assert (await call("/health", {}))[0] == 405
+            assert (await call("/missing"))[0] == 404
+
+            # an unexpected error of the calculator is answered with 500
+            def overflow(*args, **kwargs):
+                raise OverflowError("too long")
+
+            monkeypatch.setattr(calculator, "get_topn", overflow)
+            assert await call("/topn", {"word": "カナダ"}) == (
+                500,
+                {"error": "too long"},
+            )
+            monkeypatch.undo()
+
+            # a malformed content-length is answered, not dropped
+            reader, writer = await asyncio.open_connection("127.0.0.1", port)
+            writer.write(b"POST /topn HTTP/1.1\r\ncontent-length: x\r\n\r\n")
+            await writer.drain()
+            assert (await reader.readline()).startswith(b"HTTP/1.1 400")
+            writer.close()
+        finally:
+            await server.stop()
+
+    asyncio.run(main())
+
+
+def test_import_defers_dependencies():
+    import json
+    import subprocess
+    import sys
+
+    # `import kanasim` imports no third-party module; NumPy is imported when
+    # a name of the package is first used, and jamorasep and the process
+    # pool only when they are needed.
+    code = """
+import json, sys
+import kanasim
+package_modules = sorted({"numpy", "jamorasep", "kanasim.kanasim"} & set(sys.modules))
+kanasim.create_kana_distance_table()
+deferred = {"jamorasep", "concurrent.futures", "multiprocessing.shared_memory"}
+print(json.dumps([package_modules, sorted(deferred & set(sys.modules))]))
+"""
+    output = subprocess.run(
+        [sys.executable, "-c", code], capture_output=True, text=True, check=True
+    ).stdout
+    package_modules, table_modules = json.loads(output)
+    assert package_modules == []
+    assert table_modules == []
+
+
+# Budget for `import kanasim` alone, in seconds. It is generous, and the best
+# of several runs is compared, so that a busy machine does not fail the test.
+_IMPORT_TIME_BUDGET = 0.1
+
+
+def test_import_time_budget():
+    import subprocess
+    import sys
+
+    times = []
+    for _ in range(5):
+        # -X importtime reports the cumulative time of each import in
+        # microseconds, without the startup of the interpreter.
+        stderr = subprocess.run(
+            [sys.executable, "-X", "importtime", "-c", "import kanasim"],
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stderr
+        for line in stderr.splitlines():
+            fields = [field.strip() for field in line.split("|")]
+            if fields[-1] == "kanasim":
+                times.append(int(fields[1]) / 1e6)
+    assert len(times) == 5
+    assert min(times) < _IMPORT_TIME_BUDGET
+
+
 def test_calculate_long_input():
     # The previous recursive implementation hit Python's recursion limit
     # around 1000 moras in total.
@@ -224,6 +1156,16 @@ def test_calculate_long_input():
     assert calculator.calculate("カ" * 600, "サ" * 600) > 0
 
 
+def test_calculate_memo_long_word():
+    # The memo key used to hold the length of the first word in two bytes.
+    calculator = create_kana_distance_calculator()
+    unmemoized = create_kana_distance_calculator(memo=False)
+    expected = unmemoized.calculate("ア" * 70000, "ア")
+    assert calculator.calculate("ア" * 70000, "ア") == expected
+    assert calculator.calculate("ア" * 70000, "ア") == expected
+    assert calculator.memo is not None and calculator.memo.hits == 1
+
+
 def test_calculate_batch_speed():
     calculator = create_kana_distance_calculator()
     katakana = "アイウエオカキクケコサシスセソタチツテトナニヌネノハヒフヘホマミムメモヤユヨラリルレロワンガギグゲゴザジズゼゾダジヅデドバビブベボパピプペポ"
@@ -232,6 +1174,7 @@ def test_calculate_batch_speed():
     start = time.time()
     calculator.calculate_batch(wordlist1, wordlist2)
     total_time = time.time() - start
-    # Guards against a memoization regression (without memoization this takes
-    # seconds). Loose enough not to flake on slow CI runners.
+    # Guards against a regression of the vectorized batch kernel (the original
+    # pure-Python DP without memoization took seconds). Loose enough not to
+    # flake on slow CI runners.
     assert total_time < 0.5